@@ -0,0 +1,201 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+""" Synthetic BMP stream generator
+
+  Builds the stream a router sends when it starts monitoring its peers: an
+  Initiation message, a Peer Up per peer, each peer's full table as route
+  monitoring updates ending with End-of-RIB, with statistics reports mixed in.
+  The tables have the prefix length mix of the IPv4 table, and the prefixes
+  share a configurable number of distinct path attribute sets (AS paths,
+  MEDs, communities).  Streams are deterministic for a given seed.
+
+  Run on its own it writes a stream to a file, e.g. for parse_bench.py -f:
+
+    bench/bmpgen.py -o stream.bmp -p 4 -n 100000
+"""
+from __future__ import print_function
+import os
+import sys
+import getopt
+import random
+import struct
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bgpparse import encode_prefixes, encode_update, BGP_marker, BGP_header_length, BGP_OPEN
+from bmpparse import (encode_BMP_message, BMP_common_header_length, BMP_Route_Monitoring,
+                      BMP_Statistics_Report, BMP_Peer_Up_Notification, BMP_Initiation_Message)
+
+# Peer Type, Peer Flags, Peer Distinguisher, Peer Address (IPv4 in the last 4 bytes),
+# Peer AS, Peer BGP ID, Timestamp seconds, Timestamp microseconds
+_per_peer_header = struct.Struct('!BBQ12xIIIII')
+_timestamp = struct.Struct('!II')
+
+# offset of the per-peer header timestamp in a BMP message
+TIMESTAMP_OFFSET = BMP_common_header_length + 34
+
+# statistics report counters (RFC 7854 4.8): rejected prefixes, duplicate
+# advertisements, withdraws of unknown prefixes, updates invalidated by AS_PATH
+# loop, and the 64 bit gauge of routes in the Adj-RIB-In
+STAT_REJECTED = 0
+STAT_DUPLICATE_PREFIX = 1
+STAT_DUPLICATE_WITHDRAW = 2
+STAT_AS_PATH_LOOP = 4
+STAT_ADJ_RIB_IN = 7
+
+# prefix lengths in roughly their proportion in the IPv4 table
+PREFIX_LENGTHS = [24] * 60 + [23] * 8 + [22] * 12 + [21] * 5 + [20] * 5 + [19] * 4 + [16] * 4 + [18, 17]
+
+
+def per_peer_header(address, asn, bgp_id, flags=0, timestamp=0.0):
+    """ A per-peer header for an IPv4 peer of a global instance """
+    seconds = int(timestamp)
+    return _per_peer_header.pack(0, flags, 0, address, asn, bgp_id, seconds,
+                                 int((timestamp - seconds) * 1e6))
+
+
+def initiation(name, description):
+    """ An Initiation message with the sysName and sysDescr information TLVs """
+    body = b''
+    for (tlv_type, value) in ((2, name), (1, description)):
+        value = value.encode('ascii')
+        body += struct.pack('!HH', tlv_type, len(value)) + value
+    return encode_BMP_message(BMP_Initiation_Message, body)
+
+
+def bgp_open(asn, bgp_id, hold_time=180):
+    """ A BGP OPEN message advertising the 4 byte AS capability """
+    capability = struct.pack('!BBBBI', 2, 6, 65, 4, asn)
+    body = struct.pack('!BHHIB', 4, asn if asn < 0x10000 else 23456, hold_time, bgp_id, len(capability)) + capability
+    return struct.pack('!16sHB', BGP_marker, BGP_header_length + len(body), BGP_OPEN) + body
+
+
+def peer_up(peer_header, local_address, local_asn, local_id, peer_asn, peer_id):
+    """ A Peer Up notification carrying the OPEN messages sent and received """
+    body = peer_header + struct.pack('!12xIHH', local_address, 179, 40000 + (peer_id & 0xffff))
+    body += bgp_open(local_asn, local_id) + bgp_open(peer_asn, peer_id)
+    return encode_BMP_message(BMP_Peer_Up_Notification, body)
+
+
+def route_monitoring(peer_header, withdrawn=b'', attributes=b'', nlri=b''):
+    """ A route monitoring message from encoded prefix and attribute blocks """
+    return encode_BMP_message(BMP_Route_Monitoring, peer_header + encode_update(withdrawn, attributes, nlri))
+
+
+def statistics_report(peer_header, stats):
+    """ A statistics report of (type, value) counters """
+    body = peer_header + struct.pack('!I', len(stats))
+    for (stat_type, value) in stats:
+        if stat_type == STAT_ADJ_RIB_IN:
+            body += struct.pack('!HHQ', stat_type, 8, value)
+        else:
+            body += struct.pack('!HHI', stat_type, 4, value)
+    return encode_BMP_message(BMP_Statistics_Report, body)
+
+
+def stamp(buf, offset, seconds, microseconds):
+    """ Set the per-peer header timestamp of the message at offset in bytearray buf """
+    _timestamp.pack_into(buf, offset + TIMESTAMP_OFFSET, seconds, microseconds)
+
+
+def full_table(routes, rng):
+    """ routes distinct (length, prefix) IPv4 prefixes, in table order """
+    table = set()
+    while len(table) < routes:
+        length = rng.choice(PREFIX_LENGTHS)
+        table.add((length, rng.getrandbits(32) & ((0xffffffff << (32 - length)) & 0xffffffff)))
+    return sorted(table, key=lambda p: (p[1], p[0]))
+
+
+def attribute_sets(count, peer_asn, next_hop, rng):
+    """ count distinct encoded path attribute blocks as a peer would send them """
+    sets = []
+    for i in range(count):
+        path = [peer_asn] + [rng.randint(1, 400000) for j in range(rng.randint(1, 7))]
+        if rng.random() < 0.1:
+            path[1:1] = [peer_asn] * rng.randint(1, 3)     # prepending
+        segment = struct.pack('!BB', 2, len(path)) + b''.join(struct.pack('!I', asn) for asn in path)
+        attrs = struct.pack('!BBBB', 0x40, 1, 1, rng.choice((0, 0, 0, 2)))
+        attrs += struct.pack('!BBB', 0x40, 2, len(segment)) + segment
+        attrs += struct.pack('!BBBI', 0x40, 3, 4, next_hop)
+        if rng.random() < 0.3:
+            attrs += struct.pack('!BBBI', 0x80, 4, 4, rng.randint(0, 1000))
+        communities = [struct.pack('!HH', peer_asn & 0xffff, i & 0xffff)]
+        communities += [struct.pack('!HH', rng.randint(1, 65535), rng.randint(0, 65535))
+                        for j in range(rng.randint(0, 5))]
+        communities = b''.join(communities)
+        attrs += struct.pack('!BBB', 0xc0, 8, len(communities)) + communities
+        sets.append(attrs)
+    return sets
+
+
+def router_stream(router=0, peers=2, routes=10000, attributes=1000, max_prefixes=20, stats_interval=1000,
+                  seed=0):
+    """ The messages a router sends when it starts monitoring its peers
+
+        :param router:          Router number, giving the addresses and ASes used
+        :param peers:           Number of monitored peers
+        :param routes:          Routes in the table of each peer
+        :param attributes:      Distinct path attribute sets per peer
+        :param max_prefixes:    Most prefixes in one update, each has 1 to max_prefixes
+        :param stats_interval:  A statistics report is sent after this many updates of a peer
+        :param seed:            Random seed
+
+        :return: generator of raw BMP messages
+    """
+    rng = random.Random(seed * 1000 + router)
+    local_address = 0x0a000000 | (router << 8) | 1
+    local_asn = 64512 + router
+    yield initiation("router%d" % router, "bmp-proxy benchmark stream generator")
+
+    headers = []
+    for peer in range(peers):
+        address = 0xac100000 | (router << 8) | (peer + 1)
+        asn = 65000 + 100 * peer + router
+        header = per_peer_header(address, asn, address)
+        headers.append((header, address, asn))
+        yield peer_up(header, local_address, local_asn, local_address, asn, address)
+
+    for (header, address, asn) in headers:
+        table = full_table(routes, rng)
+        sets = attribute_sets(attributes, asn, address, rng)
+        updates = 0
+        offset = 0
+        while offset < len(table):
+            count = rng.randint(1, max_prefixes)
+            yield route_monitoring(header, b'', rng.choice(sets), encode_prefixes(table[offset:offset + count]))
+            offset += count
+            updates += 1
+            if updates % stats_interval == 0:
+                yield statistics_report(header, [(STAT_REJECTED, 0), (STAT_DUPLICATE_PREFIX, updates // 100),
+                                                 (STAT_DUPLICATE_WITHDRAW, 0), (STAT_AS_PATH_LOOP, 0),
+                                                 (STAT_ADJ_RIB_IN, offset)])
+        # End-of-RIB
+        yield route_monitoring(header)
+        yield statistics_report(header, [(STAT_ADJ_RIB_IN, len(table))])
+
+
+def main():
+    filename = None
+    options = {}
+    (opts, args) = getopt.getopt(sys.argv[1:], "a:m:n:o:p:r:s:")
+    for o, a in opts:
+        if o == '-o':
+            filename = a
+        else:
+            options[{'a': 'attributes', 'm': 'max_prefixes', 'n': 'routes', 'p': 'peers',
+                     'r': 'router', 's': 'seed'}[o[1]]] = int(a)
+
+    out = open(filename, 'wb') if filename else getattr(sys.stdout, 'buffer', sys.stdout)
+    msgs = 0
+    size = 0
+    for msg in router_stream(**options):
+        out.write(msg)
+        msgs += 1
+        size += len(msg)
+    if filename:
+        out.close()
+    sys.stderr.write("%d messages, %d bytes\n" % (msgs, size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,431 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+""" Benchmark harness
+
+  Runs the parser and end-to-end benchmarks over streams from bmpgen.py and
+  writes the results as JSON, so that runs of different versions can be
+  compared:
+
+    parse.get_BMP_messages      splitting a stream into BMP messages and decoding
+                                their headers, prefixes and path attributes
+    parse.BGP_message           decoding the BGP messages of the route monitoring
+                                messages alone, and again with an attribute cache
+    e2e.<mode>                  bmp-proxy.py configured for mode (passthrough, decode,
+                                ring, decoders, relay), fed by the routers over loopback
+                                and forwarding to sink.py: messages/sec, the latency
+                                from router to collector taken from the per-peer
+                                header timestamps, and the CPU time the proxy's
+                                processes took per Gbit forwarded (Linux only)
+
+  Larger messages, which favour the relay mode's zero-copy path, are made
+  with more prefixes per update (-m).
+
+  With -b the results are compared with an earlier run, and the exit status
+  is 1 if any rate is lower by more than the threshold (-t, percent).
+
+    bench/harness.py -o before.json
+    bench/harness.py -b before.json
+"""
+from __future__ import print_function
+import os
+import sys
+import getopt
+import json
+import platform
+import shutil
+import signal
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bgpparse import BGP_message, Attribute_cache
+from bmpparse import (get_BMP_messages, BMP_message, BMP_Route_Monitoring, BMP_Peer_Flag_Legacy_AS,
+                      BMP_Initiation_Message, BMP_Termination_Message)
+from bmpgen import router_stream, stamp
+from sink import Sink
+
+PROXY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bmp-proxy.py')
+
+# configuration of the proxy for each end-to-end mode, over that of e2e_config()
+MODES = {
+    'passthrough': {'listener': {'passthrough': True}},
+    'decode': {},
+    'ring': {'forward_queue': 'ring'},
+    'decoders': {'forward_queue': 'ring', 'listener': {'decoders': 2}},
+    'relay': {'listener': {'mode': 'relay'}},
+}
+
+BATCH_BYTES = 65536         # sent by a router with one call, when not paced
+START_TIMEOUT = 20          # seconds for the proxy to start listening and connect to the sink
+STOP_TIMEOUT = 20           # seconds for the proxy to exit once asked to
+
+
+def best_of(runs, func):
+    """ Call func runs times, returning the result taking least time
+
+        :return: (seconds, result)
+    """
+    best = None
+    for i in range(runs):
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best[0]:
+            best = (elapsed, result)
+    return best
+
+
+def decode_stream(stream):
+    """ Decode every message of stream down to its prefixes and attributes
+
+        :return: (messages, prefixes)
+    """
+    msgs = get_BMP_messages(stream)
+    prefixes = 0
+    for msg in msgs:
+        if msg.has_per_peer_header():
+            msg.bmp_ppc_Peer_AS
+        if msg.msg_type == BMP_Route_Monitoring:
+            bgp = msg.bmp_RM_bgp_message
+            bgp.attribute
+            prefixes += len(bgp.prefixes) + len(bgp.withdrawn_prefixes)
+    return (len(msgs), prefixes)
+
+
+def decode_updates(updates, cache=None):
+    """ Decode each (BGP message, AS width) down to its prefixes and attributes
+
+        :return: prefixes
+    """
+    prefixes = 0
+    for (update, as_width) in updates:
+        bgp = BGP_message(update, as_width, cache)
+        bgp.attribute
+        prefixes += len(bgp.prefixes) + len(bgp.withdrawn_prefixes)
+    return prefixes
+
+
+def parse_benchmarks(streams, runs):
+    """ Time the parsers over the concatenated streams
+
+        :return: dictionary of results by benchmark name
+    """
+    stream = b''.join(b''.join(msgs) for msgs in streams)
+    results = {}
+
+    (elapsed, (msgs, prefixes)) = best_of(runs, lambda: decode_stream(stream))
+    results['parse.get_BMP_messages'] = {'msgs': msgs, 'prefixes': prefixes, 'bytes': len(stream),
+                                         'seconds': elapsed,
+                                         'msgs_per_sec': msgs / elapsed,
+                                         'prefixes_per_sec': prefixes / elapsed,
+                                         'mbytes_per_sec': len(stream) / elapsed / 1e6}
+
+    updates = [(raw[48:], 2 if msg.bmp_ppc_Peer_Flags & BMP_Peer_Flag_Legacy_AS else 4)
+               for raw in (raw for msgs in streams for raw in msgs)
+               for msg in (BMP_message(raw),) if msg.msg_type == BMP_Route_Monitoring]
+    for (name, cache) in (('parse.BGP_message', None), ('parse.BGP_message.cached', Attribute_cache)):
+        (elapsed, prefixes) = best_of(runs, lambda: decode_updates(updates, cache() if cache else None))
+        results[name] = {'msgs': len(updates), 'prefixes': prefixes, 'seconds': elapsed,
+                         'msgs_per_sec': len(updates) / elapsed,
+                         'prefixes_per_sec': prefixes / elapsed}
+    return results
+
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def e2e_config(mode, port, sink_port, directory):
+    """ A proxy configuration listening on port and forwarding to the sink """
+    cfg = {
+        'max_queue_size': 1000,
+        'replay_state': False,
+        'listener': {'port': port, 'mode': 'event'},
+        'collector': {'host': '127.0.0.1', 'port': sink_port},
+        'logging': {
+            'version': 1,
+            'disable_existing_loggers': False,
+            'formatters': {'default': {'format': '%(asctime)s | %(levelname)-8s | %(name)s | %(message)s'}},
+            'handlers': {'file': {'class': 'logging.FileHandler', 'formatter': 'default',
+                                  'filename': os.path.join(directory, 'bmp-proxy.log')}},
+            'root': {'level': 'INFO', 'handlers': ['file']},
+        },
+    }
+    for (section, settings) in MODES[mode].items():
+        if isinstance(settings, dict):
+            cfg[section].update(settings)
+        else:
+            cfg[section] = settings
+    return cfg
+
+
+def batches(msgs, batch_msgs=None):
+    """ Group msgs into buffers sent with one call
+
+        :param batch_msgs:  Messages per buffer, or else up to BATCH_BYTES bytes
+
+        :return: list of (buffer, message count, offsets of the messages with a per-peer header)
+    """
+    result = []
+    buf = bytearray()
+    count = 0
+    offsets = []
+    for msg in msgs:
+        if ord(msg[5:6]) not in (BMP_Initiation_Message, BMP_Termination_Message):
+            offsets.append(len(buf))
+        buf += msg
+        count += 1
+        if count == batch_msgs or (batch_msgs is None and len(buf) >= BATCH_BYTES):
+            result.append((buf, count, offsets))
+            buf = bytearray()
+            count = 0
+            offsets = []
+    if count:
+        result.append((buf, count, offsets))
+    return result
+
+
+def send_stream(port, stream, rate=None):
+    """ Send the batches of a router's stream to the proxy, stamping each message as it goes
+
+        :param rate:        Messages per second, or as fast as possible
+
+        :return: the connection, left open so that the proxy does not drop the router's peers
+    """
+    sock = socket.create_connection(('127.0.0.1', port))
+    start = time.time()
+    sent = 0
+    for (buf, count, offsets) in stream:
+        if rate:
+            delay = start + sent / float(rate) - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        now = time.time()
+        seconds = int(now)
+        microseconds = int((now - seconds) * 1e6)
+        for offset in offsets:
+            stamp(buf, offset, seconds, microseconds)
+        sock.sendall(buf)
+        sent += count
+    return sock
+
+
+def run_proxy(mode, streams, rate, directory):
+    """ Start the proxy in mode, send it the streams of the routers and wait for the sink to get them
+
+        :return: dictionary of results
+    """
+    sink = Sink(0)
+    sink.start()
+    port = free_port()
+    cfg_filename = os.path.join(directory, 'bmp-proxy-%s.yml' % mode)
+    with open(cfg_filename, 'w') as f:
+        # JSON is YAML
+        json.dump(e2e_config(mode, port, sink.port, directory), f, indent=2)
+
+    proxy = subprocess.Popen([sys.executable, PROXY, '-c', cfg_filename], cwd=directory,
+                             stdout=open(os.path.join(directory, 'bmp-proxy.out'), 'a'),
+                             stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+    result = {'complete': False}
+    sockets = []
+    try:
+        deadline = time.time() + START_TIMEOUT
+        while sink.connections == 0 or not listening(port):
+            if time.time() > deadline or proxy.poll() is not None:
+                raise RuntimeError("proxy did not start, see %s" % directory)
+            time.sleep(0.1)
+
+        total = sum(count for stream in streams for (buf, count, offsets) in stream)
+
+        def router(stream):
+            sockets.append(send_stream(port, stream, rate))
+
+        threads = [threading.Thread(target=router, args=(stream,)) for stream in streams]
+        cpu_start = cpu_seconds(proxy.pid)
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        result['complete'] = sink.wait(total, max(60, 10 * total / 1000.0))
+        cpu = cpu_seconds(proxy.pid)
+
+        stats = sink.stats()
+        elapsed = (sink.last or time.time()) - start
+        result.update({'msgs': stats['msgs'], 'expected': total, 'bytes': stats['bytes'], 'seconds': elapsed,
+                       'msgs_per_sec': stats['msgs'] / elapsed,
+                       'mbytes_per_sec': stats['bytes'] / elapsed / 1e6,
+                       'latency_ms': stats['latency_ms']})
+        if cpu is not None and stats['bytes']:
+            result['cpu_seconds'] = cpu - cpu_start
+            result['cpu_seconds_per_gbit'] = (cpu - cpu_start) / (stats['bytes'] * 8 / 1e9)
+    finally:
+        for sock in sockets:
+            sock.close()
+        stop_proxy(proxy)
+        sink.stop()
+        sink.join()
+    return result
+
+
+def cpu_seconds(pgid):
+    """ CPU time, user and system, taken so far by the processes of a process group
+
+        :return: seconds, or None where /proc is not available
+    """
+    if not os.path.isdir('/proc'):
+        return None
+    ticks = 0
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % pid) as f:
+                # the fields after the command name, which may hold spaces
+                fields = f.read().rsplit(')', 1)[1].split()
+        except (IOError, OSError):
+            continue
+        if int(fields[2]) == pgid:
+            ticks += int(fields[11]) + int(fields[12])
+    return ticks / float(os.sysconf('SC_CLK_TCK'))
+
+
+def listening(port):
+    try:
+        socket.create_connection(('127.0.0.1', port)).close()
+        return True
+    except socket.error:
+        return False
+
+
+def stop_proxy(proxy):
+    """ Ask the proxy to exit, killing it and its processes if it does not """
+    if proxy.poll() is None:
+        proxy.send_signal(signal.SIGTERM)
+        deadline = time.time() + STOP_TIMEOUT
+        while proxy.poll() is None and time.time() < deadline:
+            time.sleep(0.1)
+    try:
+        os.killpg(proxy.pid, signal.SIGKILL)
+    except OSError:
+        pass
+    proxy.wait()
+
+
+def compare(results, baseline, threshold):
+    """ The rates in results lower than in baseline by more than threshold percent
+
+        :return: list of (benchmark, rate, baseline value, new value)
+    """
+    regressions = []
+    for (name, result) in sorted(results.items()):
+        previous = baseline.get(name, {})
+        for (key, value) in sorted(result.items()):
+            if key.endswith('_per_sec') and previous.get(key):
+                if value < previous[key] * (1 - threshold / 100.0):
+                    regressions.append((name, key, previous[key], value))
+    return regressions
+
+
+def usage(prog):
+    print("Usage: %s [OPTIONS]" % prog)
+    print("")
+    print("  -R routers".ljust(24) + "Routers sending to the proxy (default 1)")
+    print("  -p peers".ljust(24) + "Peers per router (default 2)")
+    print("  -n routes".ljust(24) + "Routes per peer (default 20000)")
+    print("  -a attributes".ljust(24) + "Distinct attribute sets per peer (default 1000)")
+    print("  -m prefixes".ljust(24) + "Most prefixes in an update (default 20)")
+    print("  -i runs".ljust(24) + "Runs of each parse benchmark, the best is kept (default 3)")
+    print("  -e modes".ljust(24) + "End-to-end modes, comma separated, or 'none' (default %s)" %
+          ','.join(sorted(MODES)))
+    print("  -r rate".ljust(24) + "Messages per second sent by each router (default unpaced)")
+    print("  -o file".ljust(24) + "Write the results to file rather than standard output")
+    print("  -b file".ljust(24) + "Compare with the results of an earlier run")
+    print("  -t percent".ljust(24) + "Drop in a rate reported as a regression (default 10)")
+
+
+def main():
+    params = {'routers': 1, 'peers': 2, 'routes': 20000, 'attributes': 1000, 'prefixes': 20, 'runs': 3,
+              'rate': None,
+              'modes': sorted(mode for mode in MODES if mode != 'relay' or hasattr(os, 'splice'))}
+    output = None
+    baseline = None
+    threshold = 10.0
+    try:
+        (opts, args) = getopt.getopt(sys.argv[1:], "R:p:n:a:m:i:e:r:o:b:t:h")
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage(sys.argv[0])
+        sys.exit(2)
+    for o, a in opts:
+        if o == '-h':
+            usage(sys.argv[0])
+            sys.exit(0)
+        elif o == '-e':
+            params['modes'] = [] if a == 'none' else a.split(',')
+            for mode in params['modes']:
+                if mode not in MODES:
+                    print("unknown mode '%s'" % mode)
+                    sys.exit(2)
+        elif o == '-o':
+            output = a
+        elif o == '-b':
+            baseline = a
+        elif o == '-t':
+            threshold = float(a)
+        else:
+            params[{'-R': 'routers', '-p': 'peers', '-n': 'routes', '-a': 'attributes', '-m': 'prefixes',
+                    '-i': 'runs', '-r': 'rate'}[o]] = int(a)
+
+    streams = [list(router_stream(router, params['peers'], params['routes'], params['attributes'],
+                                  params['prefixes']))
+               for router in range(params['routers'])]
+    results = parse_benchmarks(streams, params['runs'])
+
+    directory = tempfile.mkdtemp(prefix='bmp-proxy-bench-')
+    failed = False
+    for mode in params['modes']:
+        batched = [batches(msgs, max(1, params['rate'] // 100) if params['rate'] else None) for msgs in streams]
+        results['e2e.' + mode] = run_proxy(mode, batched, params['rate'], directory)
+        failed = failed or not results['e2e.' + mode]['complete']
+    if failed:
+        sys.stderr.write("some messages were not forwarded, the proxy's log is kept in %s\n" % directory)
+    else:
+        shutil.rmtree(directory)
+
+    report = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'parameters': params,
+              'results': results}
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if baseline:
+        with open(baseline) as f:
+            previous = json.load(f)
+        if previous.get('parameters') != params:
+            sys.stderr.write("the baseline was run with other parameters: %s\n" % previous.get('parameters'))
+        regressions = compare(results, previous['results'], threshold)
+        for (name, key, before, after) in regressions:
+            sys.stderr.write("%s %s: %.0f -> %.0f (%+.1f%%)\n" % (name, key, before, after,
+                                                                   100.0 * (after - before) / before))
+        if regressions or failed:
+            sys.exit(1)
+    elif failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
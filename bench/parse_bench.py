@@ -0,0 +1,97 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+""" Parser benchmark
+
+  Measures the rate at which a stream of BMP messages is framed and decoded:
+  the common and per-peer headers, the BGP header and the NLRI and withdrawn
+  prefixes of every route monitoring message.  The stream is read from a file
+  of raw BMP messages as received from a router (-f), or else a stream of
+  route monitoring updates is generated.  With -c the prefixes are only
+  counted, not decoded.
+"""
+from __future__ import print_function
+import os
+import sys
+import getopt
+import struct
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bgpparse
+from bmpparse import BMP_framer, BMP_message, BMP_Route_Monitoring
+
+
+def update_stream(count, prefixes):
+    """ Generate count route monitoring messages, each announcing prefixes /24s """
+    attrs = struct.pack('!BBBB', 0x40, 1, 1, 0)
+    attrs += struct.pack('!BBBBBII', 0x40, 2, 10, 2, 2, 65001, 65002)
+    attrs += struct.pack('!BBBI', 0x40, 3, 4, 0x0a000001)
+    stream = []
+    for i in range(count):
+        nlri = b''.join(struct.pack('!BI', 24, (0x0a000000 + ((i * prefixes + j) << 8)) & 0xffffffff)[:4]
+                        for j in range(prefixes))
+        body = struct.pack('!HH', 0, len(attrs)) + attrs + nlri
+        bgp = b'\xff' * 16 + struct.pack('!HB', 19 + len(body), 2) + body
+        peer = struct.pack('!BBQ12xIIIII', 0, 0, 0, 0x0a000001, 65001, 0x01010101, int(time.time()), 0)
+        stream.append(struct.pack('!BIB', 3, 6 + len(peer) + len(bgp), BMP_Route_Monitoring) + peer + bgp)
+    return b''.join(stream)
+
+
+def decode(stream, count_only=False):
+    """ Frame and decode every message in stream
+
+        :return: (messages, prefixes)
+    """
+    framer = BMP_framer()
+    msgs = 0
+    prefixes = 0
+    for offset in range(0, len(stream), 0x10000):
+        framer.feed(stream[offset:offset + 0x10000])
+        for frame in framer.frames():
+            msg = BMP_message(frame.tobytes())
+            msgs += 1
+            if msg.has_per_peer_header():
+                msg.bmp_ppc_Peer_AS
+            if msg.msg_type == BMP_Route_Monitoring:
+                bgp = msg.bmp_RM_bgp_message
+                if bgp.bgp_type != bgpparse.BGP_UPDATE:
+                    pass
+                elif count_only:
+                    prefixes += bgp.NLRI_count() + bgp.withdrawn_count()
+                else:
+                    prefixes += len(bgp.prefixes) + len(bgp.withdrawn_prefixes)
+    return (msgs, prefixes)
+
+
+def main():
+    count = 20000
+    prefixes = 20
+    filename = None
+    count_only = False
+    (opts, args) = getopt.getopt(sys.argv[1:], "cf:n:p:")
+    for o, a in opts:
+        if o == '-c':
+            count_only = True
+        elif o == '-f':
+            filename = a
+        elif o == '-n':
+            count = int(a)
+        elif o == '-p':
+            prefixes = int(a)
+
+    if filename:
+        with open(filename, 'rb') as f:
+            stream = f.read()
+    else:
+        stream = update_stream(count, prefixes)
+
+    start = time.time()
+    (msgs, prefixes) = decode(stream, count_only)
+    elapsed = time.time() - start
+
+    print("%d messages, %d prefixes, %d bytes in %.2f sec" % (msgs, prefixes, len(stream), elapsed))
+    print("%12.0f msgs/sec %12.0f prefixes/sec %10.1f MB/sec" % (msgs / elapsed, prefixes / elapsed, len(stream) / elapsed / 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+""" Forward queue benchmark
+
+  Measures the rate at which BMP sized messages pass from a producer process
+  to a consumer process through the Manager proxy queue and the shared memory
+  ring buffer.
+"""
+from __future__ import print_function
+import os
+import sys
+import getopt
+import time
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from ringbuffer import RingBuffer
+
+
+def produce(queue, count, size):
+    msg = b'\x03' + os.urandom(size - 1)
+    for i in range(count):
+        queue.put(msg)
+
+
+def consume(queue, count):
+    for i in range(count):
+        queue.get()
+
+
+def run(queue, count, size):
+    """ Time count messages of size bytes through queue
+
+        :return: messages per second
+    """
+    producer = multiprocessing.Process(target=produce, args=(queue, count, size))
+    start = time.time()
+    producer.start()
+    consume(queue, count)
+    elapsed = time.time() - start
+    producer.join()
+    return count / elapsed
+
+
+def main():
+    count = 200000
+    size = 100
+    (opts, args) = getopt.getopt(sys.argv[1:], "n:s:")
+    for o, a in opts:
+        if o == '-n':
+            count = int(a)
+        elif o == '-s':
+            size = int(a)
+
+    manager = multiprocessing.Manager()
+    results = [('manager', run(manager.Queue(1000), count, size)),
+               ('ring', run(RingBuffer(64 * 1024 * 1024), count, size))]
+    manager.shutdown()
+
+    for (name, rate) in results:
+        print("%-8s %8d bytes %12.0f msgs/sec %10.1f MB/sec" % (name, size, rate, rate * size / 1e6))
+
+
+if __name__ == '__main__':
+    main()
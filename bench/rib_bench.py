@@ -0,0 +1,132 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+""" Adj-RIB-In benchmark
+
+  Loads generated full tables into the RIB store, one per peer, through the
+  same path as the listener (BMP route monitoring messages decoded with a
+  shared attribute cache), then withdraws them.  Reports updates and routes
+  per second and the memory used per route: the trie arrays alone, and on
+  python 3 everything allocated while loading (tries, decoded attributes and
+  cache).
+"""
+from __future__ import print_function
+import os
+import sys
+import getopt
+import random
+import struct
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bgpparse import Attribute_cache
+from bmpparse import BMP_message, BMP_Route_Monitoring
+from rib import RIB_store
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def bmp_update(peer, withdrawn, attrs, nlri):
+    body = struct.pack('!H', len(withdrawn)) + withdrawn + struct.pack('!H', len(attrs)) + attrs + nlri
+    bgp = b'\xff' * 16 + struct.pack('!HB', 19 + len(body), 2) + body
+    header = struct.pack('!BBQ12xIIIII', 0, 0, 0, peer, 65000 + peer, peer, 0, 0)
+    return struct.pack('!BIB', 3, 6 + len(header) + len(bgp), BMP_Route_Monitoring) + header + bgp
+
+
+def encode_prefixes(prefixes):
+    return b''.join(struct.pack('!BI', length, prefix)[:1 + (length + 7) // 8] for (prefix, length) in prefixes)
+
+
+def full_table(routes):
+    """ routes distinct prefixes, roughly the length mix of the IPv4 table """
+    lengths = [24] * 60 + [23] * 8 + [22] * 12 + [21] * 5 + [20] * 5 + [19] * 4 + [16] * 4 + [18, 17]
+    table = set()
+    while len(table) < routes:
+        length = random.choice(lengths)
+        table.add((random.getrandbits(32) & ((0xffffffff << (32 - length)) & 0xffffffff), length))
+    return list(table)
+
+
+def attribute_sets(count):
+    sets = []
+    for i in range(count):
+        path = [random.randint(1, 65000) for j in range(random.randint(2, 8))]
+        seg = struct.pack('!BB', 2, len(path)) + b''.join(struct.pack('!I', asn) for asn in path)
+        attrs = struct.pack('!BBBB', 0x40, 1, 1, 0)
+        attrs += struct.pack('!BBB', 0x40, 2, len(seg)) + seg
+        attrs += struct.pack('!BBBI', 0x40, 3, 4, 0x0a000001)
+        attrs += struct.pack('!BBBI', 0xc0, 8, 4, 0xfde80000 + i)
+        sets.append(attrs)
+    return sets
+
+
+def messages(peers, table, attributes, per_update, withdraw=False):
+    msgs = []
+    for peer in range(1, peers + 1):
+        for i in range(0, len(table), per_update):
+            prefixes = encode_prefixes(table[i:i + per_update])
+            if withdraw:
+                msgs.append(bmp_update(peer, prefixes, b'', b''))
+            else:
+                msgs.append(bmp_update(peer, b'', random.choice(attributes), prefixes))
+    return msgs
+
+
+def apply(rib, cache, msgs):
+    start = time.time()
+    for msg in msgs:
+        rib.update('router', BMP_message(msg, cache))
+    return time.time() - start
+
+
+def main():
+    routes = 200000
+    peers = 2
+    distinct = 20000
+    per_update = 10
+    (opts, args) = getopt.getopt(sys.argv[1:], "n:p:a:u:")
+    for o, a in opts:
+        if o == '-n':
+            routes = int(a)
+        elif o == '-p':
+            peers = int(a)
+        elif o == '-a':
+            distinct = int(a)
+        elif o == '-u':
+            per_update = int(a)
+
+    random.seed(1)
+    table = full_table(routes)
+    attributes = attribute_sets(distinct)
+    announce = messages(peers, table, attributes, per_update)
+    withdraw = messages(peers, table, attributes, per_update, True)
+
+    # tracing allocations slows the load down, so it is done in a second pass
+    allocated = None
+    if tracemalloc:
+        tracemalloc.start()
+        traced = (RIB_store(peers * routes), Attribute_cache(distinct))
+        apply(traced[0], traced[1], announce)
+        allocated = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del traced
+
+    rib = RIB_store(peers * routes)
+    cache = Attribute_cache(distinct)
+    elapsed = apply(rib, cache, announce)
+
+    total = rib.routes
+    print("%d peers x %d routes, %d distinct attribute sets, %d prefixes per update" % (peers, routes, distinct, per_update))
+    print("load:     %8.0f updates/sec %10.0f routes/sec" % (len(announce) / elapsed, total / elapsed))
+    print("memory:   %8.1f bytes/route in the tries" % (float(rib.memory()) / total))
+    if allocated is not None:
+        print("          %8.1f bytes/route allocated in all" % (float(allocated) / total))
+
+    elapsed = apply(rib, cache, withdraw)
+    print("withdraw: %8.0f updates/sec %10.0f routes/sec (%d left)" % (len(withdraw) / elapsed, total / elapsed, rib.routes))
+
+
+if __name__ == '__main__':
+    main()
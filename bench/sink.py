@@ -0,0 +1,184 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+""" Stand-in collector
+
+  Accepts BMP connections, as from the proxy's senders, and counts the
+  messages and bytes received by message type.  Messages with a per-peer
+  header whose timestamp was set when they were sent (as the benchmark
+  harness does) also give their latency, the time from being sent to the
+  proxy to being received here; both ends must share a clock.
+
+  Run on its own it serves until interrupted, then prints its counters:
+
+    bench/sink.py -p 5000
+"""
+from __future__ import print_function
+import os
+import sys
+import getopt
+import errno
+import json
+import select
+import socket
+import struct
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bmpparse import BMP_framer, BMP_Initiation_Message, BMP_Termination_Message
+from bmpgen import TIMESTAMP_OFFSET
+
+_common_header = struct.Struct('!BIB')
+_timestamp = struct.Struct('!II')
+
+POLL_TIMEOUT = 100 # milliseconds
+
+
+def percentiles(samples, points=(50, 90, 99)):
+    """ The given percentiles and the maximum of samples, as a dictionary """
+    if not samples:
+        return {}
+    samples = sorted(samples)
+    result = dict(('p%d' % p, samples[min(len(samples) - 1, len(samples) * p // 100)]) for p in points)
+    result['max'] = samples[-1]
+    return result
+
+
+class Sink(threading.Thread):
+    """ Collector receiving and counting BMP messages from any number of connections """
+
+    def __init__(self, port, address='127.0.0.1'):
+        """ Constructor
+
+            :param port:        Port to listen on, 0 for any free port
+            :param address:     Address to listen on
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._stop_event = threading.Event()
+        self._cond = threading.Condition()
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((address, port))
+        self._sock.listen(8)
+        self.port = self._sock.getsockname()[1]
+        self.reset()
+
+    def reset(self):
+        """ Clear the counters """
+        with self._cond:
+            self.msgs = 0
+            self.bytes = 0
+            self.msgs_by_type = [0] * 7
+            self.latencies = []
+            self.first = None       # time the first and last messages were received
+            self.last = None
+            self.connections = 0
+
+    def run(self):
+        """ Override """
+        poller = select.poll()
+        poller.register(self._sock.fileno(), select.POLLIN)
+        sessions = {}
+        while not self._stop_event.is_set():
+            for (fd, event) in poller.poll(POLL_TIMEOUT):
+                if fd == self._sock.fileno():
+                    (conn, address) = self._sock.accept()
+                    sessions[conn.fileno()] = (conn, BMP_framer())
+                    poller.register(conn.fileno(), select.POLLIN)
+                    self.connections += 1
+                    continue
+
+                (conn, framer) = sessions[fd]
+                try:
+                    received = framer.recv(conn)
+                except socket.error as e:
+                    if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                        continue
+                    received = 0
+                if received == 0:
+                    poller.unregister(fd)
+                    del sessions[fd]
+                    conn.close()
+                    continue
+                self.count(framer)
+
+        for (conn, framer) in sessions.values():
+            conn.close()
+        self._sock.close()
+
+    def count(self, framer):
+        """ Count the complete messages held by framer """
+        now = time.time()
+        with self._cond:
+            if self.first is None:
+                self.first = now
+            for frame in framer.frames():
+                (version, length, msg_type) = _common_header.unpack_from(frame)
+                self.msgs += 1
+                self.bytes += length
+                self.msgs_by_type[msg_type] += 1
+                if msg_type != BMP_Initiation_Message and msg_type != BMP_Termination_Message:
+                    (seconds, microseconds) = _timestamp.unpack_from(frame, TIMESTAMP_OFFSET)
+                    if seconds:
+                        self.latencies.append(now - seconds - microseconds / 1e6)
+            self.last = now
+            self._cond.notify_all()
+
+    def wait(self, msgs, timeout):
+        """ Wait until msgs messages have been received in all
+
+            :return: True if they were, False on timeout
+        """
+        deadline = time.time() + timeout
+        with self._cond:
+            while self.msgs < msgs:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(min(remaining, 1.0))
+        return True
+
+    def stats(self):
+        """ The counters as a dictionary, latencies in milliseconds """
+        with self._cond:
+            elapsed = (self.last - self.first) if self.first is not None else 0
+            latency = percentiles(self.latencies)
+            return {'msgs': self.msgs,
+                    'bytes': self.bytes,
+                    'msgs_by_type': list(self.msgs_by_type),
+                    'connections': self.connections,
+                    'elapsed': elapsed,
+                    'latency_ms': dict((k, round(v * 1000, 3)) for (k, v) in latency.items())}
+
+    def stop(self):
+        self._stop_event.set()
+
+    def stopped(self):
+        return self._stop_event.is_set()
+
+
+def main():
+    address = '127.0.0.1'
+    port = 5000
+    (opts, args) = getopt.getopt(sys.argv[1:], "a:p:")
+    for o, a in opts:
+        if o == '-a':
+            address = a
+        elif o == '-p':
+            port = int(a)
+
+    sink = Sink(port, address)
+    sink.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    sink.stop()
+    sink.join()
+    print(json.dumps(sink.stats(), indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
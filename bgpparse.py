@@ -3,12 +3,18 @@
 # take a message which is allegedly BGP and parse it into an object wih plausible attributes
 #
 
+import logging
 import struct
-import sys
+from array import array
 from binascii import hexlify
-from ipaddress import ip_address
-def eprint(s):
-    sys.stderr.write(s+'\n')
+from collections import OrderedDict
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# per-message reports are at debug level, which is checked before anything is formatted
+_log = logging.getLogger(__name__)
 
 BGP_marker = struct.pack('!QQ',0xffffffffffffffff,0xffffffffffffffff)
 BGP_OPEN = 1
@@ -24,194 +30,412 @@ BGP_TYPE_CODE_LOCAL_PREF = 5
 BGP_TYPE_CODE_ATOMIC_AGGREGATE = 6
 BGP_TYPE_CODE_AGGREGATOR = 7
 BGP_TYPE_CODE_COMMUNITIES = 8
+BGP_TYPE_CODE_MP_REACH_NLRI = 14
+BGP_TYPE_CODE_MP_UNREACH_NLRI = 15
 BGP_TYPE_CODE_AS4_PATH = 17
 BGP_Attribute_Flags_Optional = 0x80 # 1 << 7
 BGP_Attribute_Flags_Transitive = 0x40 # 1 << 6
 BGP_Attribute_Flags_Partial = 0x20 # 1 << 5
 BGP_Attribute_Flags_Extended_Length = 0x10 # 1 << 4
 
+# precompiled layouts, so that each field group is decoded with one call
+_header = struct.Struct('!16sHB')           # marker, length, type
+_open = struct.Struct('!BHHIB')             # version, AS, hold time, BGP id, parameter length
+_uint8 = struct.Struct('!B')
+_uint16 = struct.Struct('!H')
+_uint32 = struct.Struct('!I')
+_aggregator = struct.Struct('!HI')         # AS, address
+_aggregator4 = struct.Struct('!II')         # four octet AS, address
 
-class BGP_message:
-
-    def __init__(self,msg):
-        self.attribute = {}
-        msg_len  = len(msg)
-        assert msg_len > 18
-        bgp_marker = msg[0:16]
-        assert bgp_marker == BGP_marker
-        self.bgp_length = struct.unpack_from('!H', msg, offset=16)[0]
-        assert self.bgp_length > 18 and self.bgp_length <= msg_len
-        self.bgp_type = struct.unpack_from('!B', msg, offset=18)[0]
-        assert self.bgp_type > 0 and self.bgp_type < 5
-        eprint( "++ BGP message rcvd length %d type %d" % (self.bgp_length,self.bgp_type))
+_ipv6_halves = struct.Struct('!QQ')
 
-        if self.bgp_type == BGP_UPDATE:
-            self.parse_bgp_update(msg[19:self.bgp_length])
-        elif self.bgp_type == BGP_OPEN:
-            self.parse_bgp_open(msg[19:self.bgp_length])
-        elif self.bgp_type == BGP_NOTIFICATION:
-            self.parse_bgp_notification(msg[19:self.bgp_length])
+IPv4_width = 4
+IPv6_width = 16
 
-    def parse_bgp_open(self,msg):
-        self.bgp_open_version = struct.unpack_from('!B', msg, offset=0)[0]
-        self.bgp_open_AS = struct.unpack_from('!H', msg, offset=1)[0]
-        self.bgp_open_hold_time = struct.unpack_from('!H', msg, offset=3)[0]
-        self.bgp_open_bgp_id = struct.unpack_from('!I', msg, offset=5)[0]
-        parameter_length = struct.unpack_from('!B', msg, offset=9)[0]
-        self.bgp_open_optional_parameters = self.tlv_parse(msg[10:(9+parameter_length)])
-        pass
 
-    def tlv_parsemsg(self):
-        pass
+def count_prefixes(prefix_list):
+    # the number of prefixes in an NLRI or withdrawn routes block, without decoding them
+    # (the count does not depend on the address family)
+    prefix_list_length = len(prefix_list)
+    lengths = bytearray(prefix_list)
+    offset = 0
+    count = 0
+    while offset < prefix_list_length:
+        offset += 1 + ((lengths[offset] + 7) >> 3)
+        count += 1
+    assert offset == prefix_list_length
+    return count
 
-    def parse_bgp_update(self,msg):
-        lm = len(msg)
-        withdrawn_routes_length = struct.unpack_from('!H', msg, offset=0)[0]
-        assert lm > withdrawn_routes_length + 3
-        self.process_withdrawn_routes(msg[2:2+withdrawn_routes_length])
-        path_attribute_length = struct.unpack_from('!H', msg, offset=withdrawn_routes_length+2)[0]
-        assert lm > withdrawn_routes_length + 3 + path_attribute_length
-        self.process_NLRI(msg[ withdrawn_routes_length + 4 + path_attribute_length:])
-        self.process_path_attributes(msg[withdrawn_routes_length + 4 : withdrawn_routes_length + 4 + path_attribute_length])
 
-    def process_withdrawn_routes(self,prefix_list):
-        self.withdrawn_prefixes = self.get_prefixes(prefix_list)
+class NLRI_block(object):
+    # the prefixes of an NLRI or withdrawn routes block, decoded in one pass into two
+    # compact arrays rather than one Python object per prefix:
+    #   lengths    - array('B') of prefix lengths
+    #   addresses  - bytearray of fixed width (4 or 16 byte) addresses in network order,
+    #                zero filled beyond the prefix length
+    # the i'th prefix is lengths[i] and addresses[i*width:(i+1)*width].
+    # Iterating yields (length, address) tuples, with the address as an integer,
+    # as get_prefixes() always has; to_numpy() offers the arrays to numpy users.
 
-    def process_NLRI(self,prefix_list):
-        self.prefixes = self.get_prefixes(prefix_list)
+    __slots__ = ('width', 'lengths', 'addresses')
 
-    def get_prefixes(self,prefix_list):
-    # BGP compresses routes by using the minimum number of bytes needed
-    # for the prefix length, i.e. a /24 needs 3 bytes but a /8 needs only 1
-    # whether the parser or the application should unpack it is a matter of taste
-    # however this library should provide the mechanism in either case.
-    # For now, it is done early, whilst parsing....
+    def __init__(self, prefix_list, width=IPv4_width):
+        assert width in (IPv4_width, IPv6_width)
+        self.width = width
+        self.lengths = array('B')
+        self.addresses = bytearray()
 
-    # implementation note:
-    # avoiding the obvious recursive solution given that these lists can be quite long
-    # and testing python implementation of optimising tail recursion is not in scope....
-        ## eprint("get_prefixes")
-        ## eprint( hexlify(prefix_list))
-        ## eprint("")
-        prefix_list_length = len(prefix_list)
+        data = bytearray(prefix_list)
+        data_length = len(data)
+        max_length = width * 8
+        padding = bytearray(width)
+        append_length = self.lengths.append
+        addresses = self.addresses
         offset = 0
-        prefixes = []
-        while offset < prefix_list_length:
-            prefix_length = struct.unpack_from('!B', prefix_list, offset=offset)[0]
-            if prefix_length > 24:
-                prefix_byte_length = 4
-            elif prefix_length > 16:
-                prefix_byte_length = 3
-            elif prefix_length > 8:
-                prefix_byte_length = 2
-            elif prefix_length > 0:
-                prefix_byte_length = 1
-            else:
-                prefix_byte_length = 0
-            ## eprint( "++ %d:%d:%d" % (offset,prefix_list_length,prefix_byte_length))
-            assert prefix_byte_length + offset < prefix_list_length
+        while offset < data_length:
+            prefix_length = data[offset]
+            assert prefix_length <= max_length
+            prefix_byte_length = (prefix_length + 7) >> 3
+            end = offset + 1 + prefix_byte_length
+            assert end <= data_length
+            append_length(prefix_length)
+            addresses += data[offset+1:end]
+            addresses += padding[prefix_byte_length:]
+            offset = end
 
-            prefix = 0
-            if prefix_byte_length > 0:
-                prefix = struct.unpack_from('!B', prefix_list, offset=offset+1)[0] << 24
-            if prefix_byte_length > 1:
-                prefix |= struct.unpack_from('!B', prefix_list, offset=offset+2)[0] << 16
-            if prefix_byte_length > 2:
-                prefix |= struct.unpack_from('!B', prefix_list, offset=offset+3)[0] << 8
-            if prefix_byte_length > 3:
-                prefix |= struct.unpack_from('!B', prefix_list, offset=offset+4)[0]
+    def __len__(self):
+        return len(self.lengths)
 
-            prefixes += [(prefix_length,prefix)]
-            ## eprint( "++ " + hexlify(prefix_list[offset:offset+ 1 + prefix_byte_length]))
-            eprint( "++ %s/%d" % (ip_address(prefix),prefix_length))
-            offset += 1 + prefix_byte_length
+    def count(self):
+        return len(self.lengths)
 
-        return prefixes
+    def address(self, i):
+        # the i'th address as an integer
+        if self.width == IPv4_width:
+            return _uint32.unpack_from(self.addresses, i * 4)[0]
+        (high, low) = _ipv6_halves.unpack_from(self.addresses, i * 16)
+        return (high << 64) | low
 
+    def packed(self, i):
+        # the i'th address as bytes, suitable for ipaddress or socket.inet_ntop
+        return bytes(self.addresses[i * self.width:(i + 1) * self.width])
+
+    def __iter__(self):
+        if self.width == IPv4_width:
+            # one unpack for the whole block
+            values = struct.unpack('!%dI' % len(self.lengths), bytes(self.addresses))
+            return iter(zip(self.lengths, values))
+        return ((self.lengths[i], self.address(i)) for i in range(len(self.lengths)))
+
+    def to_numpy(self):
+        # (lengths, addresses) as numpy arrays: uint8 lengths, and either big endian
+        # uint32 IPv4 addresses or an n x 16 uint8 array of IPv6 addresses
+        if numpy is None:
+            raise ImportError("numpy is not installed")
+        lengths = numpy.frombuffer(self.lengths, dtype=numpy.uint8)
+        if self.width == IPv4_width:
+            addresses = numpy.frombuffer(self.addresses, dtype='>u4')
+        else:
+            addresses = numpy.frombuffer(self.addresses, dtype=numpy.uint8).reshape(-1, 16)
+        return (lengths, addresses)
+
+
+class Path_attributes(object):
+    # the decoded path attributes of an update, a read only mapping from type code to value
+    #
+    # instances are shared between the updates that carry the same attributes (see
+    # Attribute_cache) so nothing may change them once built.  Values are immutable too:
+    # AS paths are tuples of (segment type, tuple of ASes); attributes which are not
+    # decoded here (communities, and any unknown type) are held as their raw bytes.
+    # The raw attribute block is kept as 'raw'.
+
+    __slots__ = ('raw', '_attributes')
+
+    def __init__(self, attributes, as_width=2):
+        # as_width is 2, or 4 where the AS_PATH and AGGREGATOR carry four octet ASes
+        # (the BMP peer flags say which)
+        self.raw = attributes
+        self._attributes = {}
 
-    def process_path_attributes(self,attributes):
-        
         offset = 0
         attributes_len = len(attributes)
         attr_count = 0
-        while offset > attributes_len:
-            attr_flags = struct.unpack_from('!B', attributes, offset=0)[0]
-            attr_type_code = struct.unpack_from('!B', attributes, offset=1)[0]
+        while offset < attributes_len:
+            (attr_flags, attr_type_code) = struct.unpack_from('!BB', attributes, offset)
 
             extended_length = bool(attr_flags & BGP_Attribute_Flags_Extended_Length)
             if extended_length:
-                length = struct.unpack_from('!H', attributes, offset=1)[0]
-                quantum = 3
+                length = _uint16.unpack_from(attributes, offset+2)[0]
+                quantum = 4
             else:
-                length = struct.unpack_from('!B', attributes, offset=1)[0]
-                quantum = 2
+                length = _uint8.unpack_from(attributes, offset+2)[0]
+                quantum = 3
 
             attribute = attributes[offset+quantum:offset+length+quantum]
             offset += length+quantum
 
             attr_count += 1
             try:
-                self.parse_attribute(attr_flags,attr_type_code,attribute)
-            except e:
-                eprint("++failed to parse attribute %d at offset %d (%x,%x) %s (%s)" % (attr_count,offset,attr_flags,attr_type_code,e,hexlify(attribute)))
+                self.parse_attribute(attr_flags,attr_type_code,attribute,as_width)
+            except (AssertionError, struct.error) as e:
+                _log.warning("++failed to parse attribute %d at offset %d (%x,%x) %s (%s)", attr_count,offset,attr_flags,attr_type_code,e,hexlify(attribute))
             # TODO - check that all of the mandatory attributes are present
 
+    def parse_attribute(self,flags,code,attr,as_width):
 
-    def parse_attribute(self,flags,code,attr):
-
-        def get_path_ases(as_list):
-            offset = 0
-            mylist = []
-            while offset < len(as_list):
-                mylist.append(struct.unpack_from('!H', as_list, offset=offset)[0])
-                offset += 2
-            return mylist
-
-        def get_path_as4s(as_list):
+        def get_path_segments(as_list, width):
+            segments = []
             offset = 0
-            mylist = []
             while offset < len(as_list):
-                mylist.append(struct.unpack_from('!I', as_list, offset=offset)[0])
-                offset += 4
-            return mylist
+                (path_segment_type, path_segment_length) = struct.unpack_from('!BB', as_list, offset)
+                end = offset + 2 + width*path_segment_length
+                assert end <= len(as_list)
+                fmt = '!%dH' if width == 2 else '!%dI'
+                segments.append((path_segment_type, struct.unpack(fmt % path_segment_length, as_list[offset+2:end])))
+                offset = end
+            return tuple(segments)
 
         attr_len = len(attr)
         if (code==BGP_TYPE_CODE_ORIGIN):
             assert attr_len == 1
-            self.attribute[BGP_TYPE_CODE_ORIGIN] = struct.unpack_from('!B', attr, offset=0)[0]
+            self._attributes[BGP_TYPE_CODE_ORIGIN] = _uint8.unpack_from(attr)[0]
         elif (code==BGP_TYPE_CODE_AS_PATH):
-            path_segment_type = struct.unpack_from('!B', attr, offset=0)[0]
-            path_segment_length = struct.unpack_from('!B', attr, offset=1)[0]
-            assert attr_len == 2 + 2*path_segment_length
-            ases = get_path_ases(attr[2:attr_len])
-            self.attribute[BGP_TYPE_CODE_AS_PATH].append((path_segment_type,ases))
+            self._attributes[BGP_TYPE_CODE_AS_PATH] = get_path_segments(attr, as_width)
         elif (code==BGP_TYPE_CODE_NEXT_HOP):
             assert attr_len == 4
-            self.attribute[BGP_TYPE_CODE_NEXT_HOP] = struct.unpack_from('!I', attr, offset=0)[0]
+            self._attributes[BGP_TYPE_CODE_NEXT_HOP] = _uint32.unpack_from(attr)[0]
         elif (code==BGP_TYPE_CODE_MULTI_EXIT_DISC):
             assert attr_len == 4
-            self.attribute[BGP_TYPE_CODE_MULTI_EXIT_DISC] = struct.unpack_from('!I', attr, offset=0)[0]
+            self._attributes[BGP_TYPE_CODE_MULTI_EXIT_DISC] = _uint32.unpack_from(attr)[0]
         elif (code==BGP_TYPE_CODE_LOCAL_PREF):
             assert attr_len == 4
-            self.attribute[BGP_TYPE_CODE_LOCAL_PREF] = struct.unpack_from('!I', attr, offset=0)[0]
+            self._attributes[BGP_TYPE_CODE_LOCAL_PREF] = _uint32.unpack_from(attr)[0]
         elif (code==BGP_TYPE_CODE_ATOMIC_AGGREGATE):
-            assert attr_len == 4
-            self.attribute[BGP_TYPE_CODE_ATOMIC_AGGREGATE] = True
+            assert attr_len == 0
+            self._attributes[BGP_TYPE_CODE_ATOMIC_AGGREGATE] = True
         elif (code==BGP_TYPE_CODE_AGGREGATOR):
-            assert attr_len == 6
-            self.attribute[BGP_TYPE_CODE_AGGREGATOR] = (struct.unpack_from('!H', attr, offset=0)[0],struct.unpack_from('!I', attr, offset=4)[0])
+            assert attr_len in (6, 8)
+            if attr_len == 6:
+                self._attributes[BGP_TYPE_CODE_AGGREGATOR] = _aggregator.unpack(attr)
+            else:
+                self._attributes[BGP_TYPE_CODE_AGGREGATOR] = _aggregator4.unpack(attr)
         elif (code==BGP_TYPE_CODE_COMMUNITIES):
-            assert attr_len > 0
+            assert attr_len > 0 and attr_len % 4 == 0
             # TODO - don't tyr to unpack the community string yet.....
-            self.attribute[BGP_TYPE_CODE_COMMUNITIES] = attr[2:attr_len]
+            self._attributes[BGP_TYPE_CODE_COMMUNITIES] = attr
         elif (code==BGP_TYPE_CODE_AS4_PATH):
-            path_segment_type = struct.unpack_from('!B', attr, offset=0)[0]
-            path_segment_length = struct.unpack_from('!B', attr, offset=1)[0]
-            assert attr_len == 2 + 4*path_segment_length
-            ases = get_path_as4s(attr[2:attr_len])
-            self.attribute[BGP_TYPE_CODE_AS4_PATH].append((path_segment_type,ases))
+            self._attributes[BGP_TYPE_CODE_AS4_PATH] = get_path_segments(attr, 4)
+        else:
+            self._attributes[code] = attr
+
+    def __getitem__(self, code):
+        return self._attributes[code]
+
+    def __contains__(self, code):
+        return code in self._attributes
+
+    def __iter__(self):
+        return iter(self._attributes)
+
+    def __len__(self):
+        return len(self._attributes)
+
+    def __eq__(self, other):
+        return isinstance(other, Path_attributes) and self.raw == other.raw
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.raw)
+
+    def get(self, code, default=None):
+        return self._attributes.get(code, default)
+
+    def keys(self):
+        return list(self._attributes.keys())
+
+    def items(self):
+        return list(self._attributes.items())
+
+
+class Attribute_cache(object):
+    # a bounded LRU cache of Path_attributes, so that the attribute block shared by many
+    # updates (a table dump sends thousands of prefixes with the same attributes) is
+    # decoded, and held in memory, only once.
+    #
+    # entries are keyed by the raw attribute bytes and the context they were received in:
+    # the AS width, which changes how they decode, and whatever the caller passes to keep
+    # peers apart (e.g. the BMP per-peer header hash).  The least recently used entry is
+    # evicted when max_entries is reached.
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, attributes, as_width=2, context=None):
+        key = (context, as_width, attributes)
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            entry = Path_attributes(attributes, as_width)
+            if len(self._entries) >= self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        # (re)inserting moves the entry to the most recently used end
+        self._entries[key] = entry
+        return entry
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        return "%d entries, %d hits, %d misses, %d evictions" % (len(self._entries), self.hits, self.misses, self.evictions)
+
+
+BGP_header_length = 19
+BGP_max_message_length = 4096
+
+
+def encode_prefixes(prefixes):
+    # an NLRI or withdrawn routes block of IPv4 (length, address) prefixes
+    return b''.join(_uint8.pack(length) + _uint32.pack(prefix)[:(length + 7) >> 3]
+                    for (length, prefix) in prefixes)
+
+
+def split_prefixes(block, space):
+    # split an encoded prefix block into slices of whole prefixes, each at most space bytes
+    # (space must hold the longest prefix, 5 bytes for IPv4)
+    start = 0
+    while start < len(block):
+        end = start
+        while end < len(block) and end - start + 1 + ((ord(block[end:end + 1]) + 7) >> 3) <= space:
+            end += 1 + ((ord(block[end:end + 1]) + 7) >> 3)
+        yield block[start:end]
+        start = end
+
+
+def encode_update(withdrawn=b'', attributes=b'', nlri=b''):
+    # a complete BGP UPDATE message from encoded blocks
+    body = _uint16.pack(len(withdrawn)) + withdrawn + _uint16.pack(len(attributes)) + attributes + nlri
+    return _header.pack(BGP_marker, BGP_header_length + len(body), BGP_UPDATE) + body
+
+
+class BGP_message(object):
+    # the header is decoded up front; the withdrawn routes, path attributes and NLRI
+    # of an update are only located, and are decoded when first used
+
+    __slots__ = ('bgp_length', 'bgp_type', 'attribute', 'withdrawn_prefixes', 'prefixes',
+                 'withdrawn_block', 'NLRI_block',
+                 '_withdrawn_routes', '_path_attributes', '_NLRI',
+                 '_as_width', '_attribute_cache', '_context',
+                 'bgp_open_version', 'bgp_open_AS', 'bgp_open_hold_time', 'bgp_open_bgp_id',
+                 'bgp_open_optional_parameters')
+
+    def __init__(self,msg,as_width=2,attribute_cache=None,context=None):
+        # as_width: 2 or 4, the size of the ASes in the AS_PATH
+        # attribute_cache: an Attribute_cache to share decoded path attributes through
+        # context: passed to the cache, to keep the attributes of different peers apart
+        self._as_width = as_width
+        self._attribute_cache = attribute_cache
+        self._context = context
+        msg_len  = len(msg)
+        assert msg_len > 18
+        (bgp_marker, self.bgp_length, self.bgp_type) = _header.unpack_from(msg)
+        assert bgp_marker == BGP_marker
+        assert self.bgp_length > 18 and self.bgp_length <= msg_len
+        assert self.bgp_type > 0 and self.bgp_type < 5
+        _log.debug( "++ BGP message rcvd length %d type %d", self.bgp_length,self.bgp_type)
+
+        if self.bgp_type == BGP_UPDATE:
+            self.parse_bgp_update(msg[19:self.bgp_length])
+        elif self.bgp_type == BGP_OPEN:
+            self.parse_bgp_open(msg[19:self.bgp_length])
+        elif self.bgp_type == BGP_NOTIFICATION:
+            self.parse_bgp_notification(msg[19:self.bgp_length])
+
+    def __getattr__(self, name):
+        # called only for attributes not yet set
+        if name == 'attribute':
+            if self.bgp_type == BGP_UPDATE:
+                self.process_path_attributes(self._path_attributes)
+            else:
+                self.attribute = Path_attributes(b'')
+            return self.attribute
+        elif name == 'withdrawn_prefixes' and self.bgp_type == BGP_UPDATE:
+            self.process_withdrawn_routes(self._withdrawn_routes)
+            return self.withdrawn_prefixes
+        elif name == 'prefixes' and self.bgp_type == BGP_UPDATE:
+            self.process_NLRI(self._NLRI)
+            return self.prefixes
+        elif name == 'withdrawn_block' and self.bgp_type == BGP_UPDATE:
+            self.withdrawn_block = NLRI_block(self._withdrawn_routes)
+            return self.withdrawn_block
+        elif name == 'NLRI_block' and self.bgp_type == BGP_UPDATE:
+            self.NLRI_block = NLRI_block(self._NLRI)
+            return self.NLRI_block
+        raise AttributeError(name)
+
+    def parse_bgp_open(self,msg):
+        (self.bgp_open_version, self.bgp_open_AS, self.bgp_open_hold_time, self.bgp_open_bgp_id,
+         parameter_length) = _open.unpack_from(msg)
+        self.bgp_open_optional_parameters = self.tlv_parse(msg[10:(9+parameter_length)])
+        pass
+
+    def tlv_parsemsg(self):
+        pass
+
+    def parse_bgp_update(self,msg):
+        lm = len(msg)
+        withdrawn_routes_length = _uint16.unpack_from(msg)[0]
+        assert lm > withdrawn_routes_length + 3
+        self._withdrawn_routes = msg[2:2+withdrawn_routes_length]
+        path_attribute_length = _uint16.unpack_from(msg, withdrawn_routes_length+2)[0]
+        assert lm > withdrawn_routes_length + 3 + path_attribute_length
+        self._NLRI = msg[ withdrawn_routes_length + 4 + path_attribute_length:]
+        self._path_attributes = msg[withdrawn_routes_length + 4 : withdrawn_routes_length + 4 + path_attribute_length]
+
+    def process_withdrawn_routes(self,prefix_list):
+        self.withdrawn_prefixes = list(self.withdrawn_block)
+        _log.debug( "++ %d withdrawn prefixes", len(self.withdrawn_prefixes))
+
+    def process_NLRI(self,prefix_list):
+        self.prefixes = list(self.NLRI_block)
+        _log.debug( "++ %d prefixes", len(self.prefixes))
+
+    def withdrawn_count(self):
+        return count_prefixes(self._withdrawn_routes)
+
+    def NLRI_count(self):
+        return count_prefixes(self._NLRI)
+
+    def get_prefixes(self,prefix_list):
+    # BGP compresses routes by using the minimum number of bytes needed
+    # for the prefix length, i.e. a /24 needs 3 bytes but a /8 needs only 1
+    # whether the parser or the application should unpack it is a matter of taste
+    # however this library should provide the mechanism in either case.
+    # For now, it is done early, whilst parsing....
+
+    # implementation note:
+    # avoiding the obvious recursive solution given that these lists can be quite long
+    # and testing python implementation of optimising tail recursion is not in scope....
+    # the prefixes are decoded in bulk by NLRI_block, see there for the layout
+        return list(NLRI_block(prefix_list))
+
+
+    def process_path_attributes(self,attributes):
+        if self._attribute_cache is not None:
+            self.attribute = self._attribute_cache.get(attributes, self._as_width, self._context)
         else:
-            assert False
+            self.attribute = Path_attributes(attributes, self._as_width)
 
     def parse_bgp_notification(self,msg):
         pass
@@ -8,11 +8,23 @@ import logging
 import yaml # requires sudo pip install pyyaml
 import time
 import signal
+import os
+import socket
 
 from multiprocessing import Queue, Manager
 from logger import LoggerThread
 from listener import Listener
 from forwarder import Sender
+from ringbuffer import RingBuffer
+from replay import State_table, Replay_server
+from decoder import Decoder
+from metrics import Metrics, Metrics_server
+from transport import TRANSPORT_BMP, TRANSPORT_ZLIB
+from budget import Queue_budget, POLICIES, POLICY_SPILL
+from supervisor import Supervisor, Worker_lock
+from scheduler import Scheduler, DEFAULT_QUANTUM, DEFAULT_DEPTH, DEFAULT_ROUTER_QUEUE_BYTES
+from relay import Relay
+from filters import Rule_set, compile_rules
 
 # Root logger
 LOG = None
@@ -20,6 +32,16 @@ LOG = None
 # Running flag for main process
 RUNNING = True
 
+DEFAULT_RING_BUFFER_SIZE = 64 * 1024 * 1024
+
+# RIB dump messages held for each sender
+REPLAY_QUEUE_SIZE = 1000
+
+DEFAULT_DECODER_QUEUE_SIZE = 16 * 1024 * 1024
+
+# Seconds between checks on the worker processes
+SUPERVISE_INTERVAL = 1
+
 
 def signal_handler(signum, frame):
     """ Signal handler to shutdown the program
@@ -37,11 +59,24 @@ def signal_handler(signum, frame):
     RUNNING = False
 
 
+def resume(*queues):
+    """ Bring the main process's copies of the shared rings' positions up to date,
+        before a worker process is forked to replace one that died
+
+        :param queues:  Ring buffers the worker puts to and ring readers it gets from;
+                        other queues keep no private positions and are skipped
+    """
+    for queue in queues:
+        if hasattr(queue, 'resume'):
+            queue.resume()
+
+
 def load_config(cfg_filename, LOG):
     cfg = {}
 
     try:
-        cfg = yaml.load(file(cfg_filename, 'r'))
+        with open(cfg_filename, 'r') as f:
+            cfg = yaml.safe_load(f)
 
         if 'listener' in cfg:
             if 'port' not in cfg['listener']:
@@ -58,27 +93,169 @@ def load_config(cfg_filename, LOG):
                 print("Configuration is missing 'listener' section.")
             sys.exit(2)
 
-        if 'collector' in cfg:
-            if 'host' not in cfg['collector']:
+        # A single 'collector' section is a list of one
+        if 'collectors' in cfg:
+            collectors = cfg['collectors']
+        elif 'collector' in cfg:
+            collectors = [cfg['collector']]
+        else:
+            if LOG:
+                LOG.error("Configuration is missing 'collector' section.")
+            else:
+                print("Configuration is missing 'collector' section.")
+            sys.exit(2)
+
+        for collector in collectors:
+            # a collector with several endpoints is labelled by its first
+            for endpoint in collector.get('endpoints', []):
+                if 'host' not in endpoint:
+                    if LOG:
+                        LOG.error("Configuration is missing 'host' in collector endpoint")
+                    else:
+                        print("Configuration is missing 'host' in collector endpoint")
+                    sys.exit(2)
+                endpoint.setdefault('port', 5000)
+            if collector.get('endpoints') and 'host' not in collector:
+                collector['host'] = collector['endpoints'][0]['host']
+                collector['port'] = collector['endpoints'][0]['port']
+
+            if 'host' not in collector:
                 if LOG:
                     LOG.error("Configuration is missing 'host' in collector section")
                 else:
                     print("Configuration is missing 'host' in collector section")
                 sys.exit(2)
 
-            if 'port' not in cfg['collector']:
+            if 'port' not in collector:
                 if LOG:
                     LOG.error("Configuration is missing 'port' in collector section, using default of 5000")
                 else:
                     print("Configuration is missing 'port' in collector section, using default of 5000")
 
-                cfg['collector']['port'] = 5000
+                collector['port'] = 5000
 
-        else:
+            if collector.get('transport', TRANSPORT_BMP) not in (TRANSPORT_BMP, TRANSPORT_ZLIB):
+                if LOG:
+                    LOG.error("Configuration collector 'transport' must be either '%s' or '%s'" %
+                              (TRANSPORT_BMP, TRANSPORT_ZLIB))
+                else:
+                    print("Configuration collector 'transport' must be either '%s' or '%s'" %
+                          (TRANSPORT_BMP, TRANSPORT_ZLIB))
+                sys.exit(2)
+
+            if collector.get('compression_level', 6) not in range(-1, 10):
+                if LOG:
+                    LOG.error("Configuration collector 'compression_level' must be from 0 to 9, or -1")
+                else:
+                    print("Configuration collector 'compression_level' must be from 0 to 9, or -1")
+                sys.exit(2)
+
+            if 'spool' in collector and 'directory' not in collector['spool']:
+                if LOG:
+                    LOG.error("Configuration is missing 'directory' in collector spool section")
+                else:
+                    print("Configuration is missing 'directory' in collector spool section")
+                sys.exit(2)
+
+        cfg['collectors'] = collectors
+
+        if cfg.get('forward_queue', 'manager') not in ('manager', 'ring'):
             if LOG:
-                LOG.error("Configuration is missing 'collector' section.")
+                LOG.error("Configuration 'forward_queue' must be either 'manager' or 'ring'")
             else:
-                print("Configuration is missing 'collector' section.")
+                print("Configuration 'forward_queue' must be either 'manager' or 'ring'")
+            sys.exit(2)
+
+        if cfg.get('overload_policy', 'block') not in POLICIES:
+            if LOG:
+                LOG.error("Configuration 'overload_policy' must be one of %s" % ", ".join(POLICIES))
+            else:
+                print("Configuration 'overload_policy' must be one of %s" % ", ".join(POLICIES))
+            sys.exit(2)
+
+        if cfg.get('overload_policy', 'block') == POLICY_SPILL and 'directory' not in cfg.get('overload_spill', {}):
+            if LOG:
+                LOG.error("Configuration is missing 'directory' in overload_spill section")
+            else:
+                print("Configuration is missing 'directory' in overload_spill section")
+            sys.exit(2)
+
+        if cfg['listener'].get('processes', 1) > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+            if LOG:
+                LOG.error("Configuration listener 'processes' needs SO_REUSEPORT, which this platform lacks")
+            else:
+                print("Configuration listener 'processes' needs SO_REUSEPORT, which this platform lacks")
+            sys.exit(2)
+
+        if cfg['listener'].get('mode') == 'relay':
+            # nothing but the common header is read, no feature that looks further can be used
+            listener = cfg['listener']
+            conflicts = [name for (name, used) in (
+                ("several collectors", len(collectors) > 1),
+                ("collector transport", collectors[0].get('transport', TRANSPORT_BMP) != TRANSPORT_BMP),
+                ("collector spool", 'spool' in collectors[0]),
+                ("listener decoders", listener.get('decoders', 0) > 0),
+                ("listener rib", listener.get('rib', False)),
+                ("listener coalesce_window", listener.get('coalesce_window', 0) > 0),
+                ("listener capture", bool(listener.get('capture'))),
+                ("listener processes", listener.get('processes', 1) > 1),
+                ("listener accept_compressed", listener.get('accept_compressed', False)),
+                ("max_queue_bytes", cfg.get('max_queue_bytes', 0) > 0),
+                ("schedule", 'schedule' in cfg),
+                ("filters", bool(cfg.get('filters')))) if used]
+            if not hasattr(os, 'splice'):
+                if LOG:
+                    LOG.error("Configuration listener mode 'relay' needs os.splice(), Python 3.10 or later on Linux")
+                else:
+                    print("Configuration listener mode 'relay' needs os.splice(), Python 3.10 or later on Linux")
+                sys.exit(2)
+            if conflicts:
+                if LOG:
+                    LOG.error("Configuration listener mode 'relay' cannot be used with %s" % ", ".join(conflicts))
+                else:
+                    print("Configuration listener mode 'relay' cannot be used with %s" % ", ".join(conflicts))
+                sys.exit(2)
+
+        if 'schedule' in cfg:
+            if cfg.get('forward_queue', 'manager') != 'ring' and len(collectors) == 1 and \
+                    not cfg.get('max_queue_bytes', 0):
+                # the scheduler fills the forward queue to a depth in bytes
+                if LOG:
+                    LOG.error("Configuration 'schedule' needs forward_queue 'ring' or max_queue_bytes")
+                else:
+                    print("Configuration 'schedule' needs forward_queue 'ring' or max_queue_bytes")
+                sys.exit(2)
+            if any(weight < 1 for weight in ((cfg['schedule'] or {}).get('weights') or {}).values()):
+                if LOG:
+                    LOG.error("Configuration schedule 'weights' must be 1 or more")
+                else:
+                    print("Configuration schedule 'weights' must be 1 or more")
+                sys.exit(2)
+
+        if cfg.get('filters'):
+            try:
+                compile_rules(cfg['filters'])
+            except ValueError as e:
+                if LOG:
+                    LOG.error("Configuration 'filters': %s" % e)
+                else:
+                    print("Configuration 'filters': %s" % e)
+                sys.exit(2)
+
+        if cfg['listener'].get('shard_by', 'router') != 'router':
+            # the decoders forward independently, a router's Initiation and Termination
+            # could not be kept in order with the messages of its peers
+            if LOG:
+                LOG.error("Configuration listener 'shard_by' must be 'router'")
+            else:
+                print("Configuration listener 'shard_by' must be 'router'")
+            sys.exit(2)
+
+        if 'metrics' in cfg and 'port' not in cfg['metrics']:
+            if LOG:
+                LOG.error("Configuration is missing 'port' in metrics section")
+            else:
+                print("Configuration is missing 'port' in metrics section")
             sys.exit(2)
 
         if 'logging' not in cfg:
@@ -165,8 +342,9 @@ def main():
     cfg_dict = manager.dict()
     cfg_dict['max_queue_size'] = cfg['max_queue_size']
     cfg_dict['logging'] = cfg['logging']
-    cfg_dict['collector'] = cfg['collector']
+    cfg_dict['collectors'] = cfg['collectors']
     cfg_dict['listener'] = cfg['listener']
+    cfg_dict['log_pipeline'] = cfg.get('log_pipeline', {})
 
     # Setup signal handers
     signal.signal(signal.SIGTERM, signal_handler)
@@ -180,16 +358,142 @@ def main():
 
     LOG = logging.getLogger()
 
-    # Use manager queue to ensure no duplicates
-    forward_queue = manager.Queue(cfg_dict['max_queue_size'])
-
-    # Start the BMP consumer process
-    proc_consumer = Listener(cfg_dict, forward_queue, log_queue)
-    proc_consumer.start()
-
-    # Start the BMP writer process
-    proc_writer = Sender(cfg_dict, forward_queue, log_queue)
-    proc_writer.start()
+    collector_count = len(cfg['collectors'])
+    # Routers relayed to the collector by a single process, kernel side
+    relay = cfg['listener'].get('mode') == 'relay'
+    decoder_count = 0
+    if not cfg['listener'].get('passthrough', False):
+        decoder_count = cfg['listener'].get('decoders', 0)
+    # Listener processes sharing the port (SO_REUSEPORT)
+    listener_count = cfg['listener'].get('processes', 1)
+    listener_indexes = list(range(listener_count)) if listener_count > 1 else [None]
+
+    # The listeners put to the forward queue, or the decoders when there are decoders
+    producer_names = (["decoder.%d" % i for i in range(decoder_count)] or
+                      ["listener" if i is None else "listener.%d" % i for i in listener_indexes])
+
+    if cfg.get('forward_queue', 'manager') == 'ring' or collector_count > 1:
+        # Shared memory ring buffer, inherited by the listener and sender processes.
+        # Each message is written once and read by every sender.  The producers,
+        # if there are several, take turns to write to it.
+        forward_queue = RingBuffer(cfg.get('ring_buffer_size', DEFAULT_RING_BUFFER_SIZE), collector_count,
+                                   Worker_lock() if len(producer_names) > 1 else None)
+        sender_queues = [forward_queue.reader(i) for i in range(collector_count)]
+    else:
+        # Use manager queue to ensure no duplicates, bounded by bytes rather than
+        # messages when there is a byte budget
+        forward_queue = manager.Queue(0 if cfg.get('max_queue_bytes', 0) else cfg_dict['max_queue_size'])
+        sender_queues = [forward_queue]
+
+    # With a byte budget each producer gets its own end, applying the overload policy
+    producer_queues = [forward_queue] * len(producer_names)
+    budget = None
+    if cfg.get('max_queue_bytes', 0):
+        budget = Queue_budget(cfg['max_queue_bytes'], len(producer_names), producer_names,
+                              forward_queue if isinstance(forward_queue, RingBuffer) else None)
+        spill = cfg.get('overload_spill')
+        producer_queues = [budget.producer(forward_queue, i, cfg.get('overload_policy', 'block'),
+                                           cfg.get('overload_drop_level', 0.5),
+                                           dict(spill, directory=os.path.join(spill['directory'], name))
+                                           if spill and 'directory' in spill else None)
+                           for (i, name) in enumerate(producer_names)]
+        if not isinstance(forward_queue, RingBuffer):
+            sender_queues = [budget.consumer(forward_queue)]
+
+    # Initiation and Peer Up messages, and RIB dumps when the listener keeps the RIB,
+    # replayed to collectors as they connect
+    state_table = None
+    replay_requests = None
+    replay_queues = [None] * collector_count
+    # Counters shared by the processes, served over HTTP by the main process
+    metrics = None
+    if 'metrics' in cfg:
+        metrics = Metrics(cfg['collectors'], cfg['metrics'].get('max_routers', 256), Worker_lock(), listener_count)
+
+    # Each producer keeps the messages of every router apart and sends them on in
+    # fair turns, state messages first
+    if 'schedule' in cfg:
+        schedule = cfg['schedule'] or {}
+        producer_queues = [Scheduler(queue, budget.held if budget is not None else forward_queue.used,
+                                     schedule.get('depth', DEFAULT_DEPTH), schedule.get('quantum', DEFAULT_QUANTUM),
+                                     schedule.get('router_queue_bytes', DEFAULT_ROUTER_QUEUE_BYTES),
+                                     schedule.get('weights'), metrics)
+                           for queue in producer_queues]
+
+    replay_servers = [None] * len(producer_names)
+    if cfg.get('replay_state', True):
+        state_table = State_table(manager.dict())
+        if cfg['listener'].get('rib', False):
+            replay_queues = [Queue(REPLAY_QUEUE_SIZE) for i in range(collector_count)]
+            # each decoder, or listener, dumps the peers it holds
+            replay_requests = [Queue() for name in producer_names]
+            replay_servers = [Replay_server(requests, replay_queues) for requests in replay_requests]
+
+    # Filter rules, compiled once and applied by every listener to the messages received
+    rule_set = None
+    if cfg.get('filters'):
+        rule_set = Rule_set(compile_rules(cfg['filters']), listener_count)
+
+    # The worker processes are started, and restarted should they die, by the supervisor.
+    # A replacement takes up the shared rings where the process it replaces left them.
+    supervisor = Supervisor(LOG)
+
+    if relay:
+        supervisor.start("relay", 'relay',
+                         lambda: Relay(cfg_dict, log_queue,
+                                       State_table({}) if cfg.get('replay_state', True) else None, metrics))
+
+    # Start the decoder processes, fed by the listeners through a ring buffer each
+    decoder_queues = None
+    if decoder_count:
+        decoder_queues = [RingBuffer(cfg['listener'].get('decoder_queue_size', DEFAULT_DECODER_QUEUE_SIZE), 1,
+                                     Worker_lock() if listener_count > 1 else None)
+                          for i in range(decoder_count)]
+        for i in range(decoder_count):
+            supervisor.start("decoder.%d" % i, 'decoder',
+                             lambda i=i: Decoder(cfg_dict, i, decoder_queues[i], producer_queues[i], log_queue,
+                                                 replay_servers[i], metrics),
+                             lambda i=i: resume(decoder_queues[i].reader(0), forward_queue))
+
+    # Start the BMP consumer processes
+    for (n, index) in enumerate([] if relay else listener_indexes):
+        supervisor.start("listener" if index is None else "listener.%d" % index, 'listener',
+                         lambda n=n, index=index: Listener(cfg_dict,
+                                                           forward_queue if decoder_count else producer_queues[n],
+                                                           log_queue, state_table,
+                                                           None if decoder_count else replay_servers[n],
+                                                           decoder_queues, metrics, index,
+                                                           rule_set.filter(n) if rule_set is not None else None),
+                         lambda: resume(*(decoder_queues or [forward_queue])))
+
+    # Start a BMP writer process per collector
+    for i in range(0 if relay else collector_count):
+        supervisor.start("sender.%d" % i, 'sender',
+                         lambda i=i: Sender(cfg_dict, sender_queues[i], log_queue, i,
+                                            state_table, replay_requests, replay_queues[i], metrics),
+                         lambda i=i: resume(sender_queues[i]))
+
+    metrics_server = None
+    if metrics is not None:
+        gauges = []
+        for (i, collector) in enumerate([] if relay else cfg['collectors']):
+            gauges.append(("bmp_proxy_forward_queue_depth", "Messages waiting to be sent to a collector",
+                           {'collector': "%s:%d" % (collector['host'], collector['port'])},
+                           sender_queues[min(i, len(sender_queues) - 1)].qsize))
+        for (i, decoder_queue) in enumerate(decoder_queues or []):
+            gauges.append(("bmp_proxy_decoder_queue_depth", "Messages waiting to be decoded",
+                           {'decoder': str(i)}, decoder_queue.qsize))
+
+        counters = supervisor.counters()
+        if budget is not None:
+            gauges += budget.gauges()
+            counters += budget.counters()
+        if rule_set is not None:
+            counters += rule_set.counters()
+
+        metrics_server = Metrics_server(metrics, cfg['metrics'].get('address', '127.0.0.1'),
+                                        cfg['metrics']['port'], gauges, counters)
+        metrics_server.start()
 
     LOG.info("Threads started")
 
@@ -197,19 +501,29 @@ def main():
     while RUNNING:
 
         try:
-            time.sleep(3)
+            time.sleep(SUPERVISE_INTERVAL)
+            if RUNNING:
+                supervisor.check()
 
         except KeyboardInterrupt:
             print("\nStop requested by user")
             RUNNING = False
             break
 
-    proc_consumer.stop()
+    supervisor.stop('relay')
+    supervisor.stop('listener')
     time.sleep(1)
 
-    proc_writer.stop()
+    if decoder_count:
+        supervisor.stop('decoder')
+        time.sleep(1)
+
+    supervisor.stop('sender')
     time.sleep(1)
 
+    if metrics_server is not None:
+        metrics_server.stop()
+
     manager.shutdown()
 
     thread_logger.stop()
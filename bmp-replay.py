@@ -0,0 +1,261 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+""" Replay a capture
+
+  Sends the messages of a capture made by the listener (listener 'capture'
+  setting) to a BMP proxy, with a connection per captured router, or straight
+  to a collector, with every router's messages on one connection as the
+  proxy sends them.  The messages are sent with the spacing they were
+  received with, or N times faster, or as fast as they can be.
+"""
+from __future__ import print_function
+import sys
+import getopt
+import socket
+import time
+
+from capture import Capture_reader
+
+# Bytes gathered for a connection before sending them with one call
+SEND_BATCH = 64 * 1024
+
+# Least wait worth sleeping for, below it the messages due are sent early
+MIN_SLEEP = 0.001
+
+
+def usage(prog):
+
+    """ Usage - Prints the usage for this program.
+
+        :param prog:  Program name
+    """
+    print("")
+    print("Usage: %s [OPTIONS] <capture file>" % prog)
+    print("")
+
+    print("OPTIONS:")
+    print("  -h, --help".ljust(30) + "Print this help menu")
+    print("  -H, --host".ljust(30) + "Host to send to (default 127.0.0.1)")
+    print("  -p, --port".ljust(30) + "Port to send to (default 5001, the proxy's listener)")
+    print("  -c, --collector".ljust(30) + "Send all routers' messages on one connection, as to a collector")
+    print("  -s, --speed".ljust(30) + "Replay N times as fast as captured, 0 for as fast as possible (default 1)")
+    print("  -o, --offset".ljust(30) + "Start this many seconds into the capture")
+    print("  -r, --router".ljust(30) + "Replay only this router, may be repeated")
+    print("  -i, --info".ljust(30) + "Print what the capture holds and exit")
+    print("")
+
+
+def parse_cmd_args(argv):
+    """ Parse commandline arguments
+
+        Usage is printed and program is terminated if there is an error.
+
+        :param argv:   ARGV as provided by sys.argv.  Arg 0 is the program name
+
+        :returns: Command line arg configuration dictionary
+    """
+    cfg = {
+            'host': '127.0.0.1',
+            'port': 5001,
+            'collector': False,
+            'speed': 1.0,
+            'offset': 0.0,
+            'routers': [],
+            'info': False
+           }
+
+    try:
+        (opts, args) = getopt.getopt(argv[1:], "hH:p:cs:o:r:i",
+                                       ["help", "host=", "port=", "collector", "speed=", "offset=",
+                                        "router=", "info"])
+
+        for o, a in opts:
+            if o in ("-h", "--help"):
+                usage(argv[0])
+                sys.exit(0)
+
+            elif o in ("-H", "--host"):
+                cfg['host'] = a
+
+            elif o in ("-p", "--port"):
+                cfg['port'] = int(a)
+
+            elif o in ("-c", "--collector"):
+                cfg['collector'] = True
+
+            elif o in ("-s", "--speed"):
+                cfg['speed'] = float(a)
+
+            elif o in ("-o", "--offset"):
+                cfg['offset'] = float(a)
+
+            elif o in ("-r", "--router"):
+                cfg['routers'].append(a)
+
+            elif o in ("-i", "--info"):
+                cfg['info'] = True
+
+            else:
+                usage(argv[0])
+                sys.exit(1)
+
+    except (getopt.GetoptError, ValueError) as err:
+        print(str(err))
+        usage(argv[0])
+        sys.exit(2)
+
+    if len(args) != 1:
+        usage(argv[0])
+        sys.exit(2)
+    cfg['filename'] = args[0]
+
+    return cfg
+
+
+def print_info(capture):
+    """ Print the routers, message count and span of a capture """
+    if not capture.indexed:
+        # no totals without the index, count them
+        (msgs, size, first, last) = (0, 0, None, None)
+        for (timestamp, router, msg) in capture.records():
+            msgs += 1
+            size += len(msg)
+            first = timestamp if first is None else first
+            last = timestamp
+        print("%s was not closed, it has no index" % capture.filename)
+    else:
+        (msgs, size, first, last) = (capture.msgs, capture.bytes, capture.first, capture.last)
+
+    print("%d messages, %d bytes from %d routers" % (msgs, size, len(capture.routers)))
+    if first is not None:
+        print("from %s to %s (%.1f seconds)" % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(first)),
+                                                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last)),
+                                                last - first))
+    for name in sorted(capture.routers.values()):
+        print("  %s" % name)
+
+
+class Replayer(object):
+    """ Sends the messages of a capture, a connection per router or one for all """
+
+    def __init__(self, host, port, collector=False):
+        """ Constructor
+
+            :param host:        Host to connect to
+            :param port:        Port to connect to
+            :param collector:   True to send every router's messages on one connection
+        """
+        self._address = (host, port)
+        self._collector = collector
+        self._connections = {}      # router (or None) -> socket
+        self._pending = {}          # router (or None) -> [messages]
+        self._pending_bytes = 0
+        self.msgs = 0
+        self.bytes = 0
+
+    def add(self, router, msg):
+        """ Queue a message to send, sending the queued messages once there are enough """
+        key = None if self._collector else router
+        self._pending.setdefault(key, []).append(msg)
+        self._pending_bytes += len(msg)
+        if self._pending_bytes >= SEND_BATCH:
+            self.flush()
+
+    def flush(self):
+        """ Send the queued messages, in order for each connection """
+        for (key, msgs) in self._pending.items():
+            sock = self._connections.get(key)
+            if sock is None:
+                sock = socket.create_connection(self._address)
+                self._connections[key] = sock
+            data = b''.join(msgs)
+            sock.sendall(data)
+            self.msgs += len(msgs)
+            self.bytes += len(data)
+        self._pending = {}
+        self._pending_bytes = 0
+
+    def close(self):
+        """ Close the connections, dropping any messages not sent """
+        self._pending = {}
+        self._pending_bytes = 0
+        for sock in self._connections.values():
+            sock.close()
+        self._connections = {}
+
+
+def replay(capture, replayer, speed=1.0, offset=0.0, routers=None):
+    """ Send the messages of a capture, spaced as they were received divided by speed
+
+        :param capture:     capture.Capture_reader
+        :param replayer:    Replayer to send them with
+        :param speed:       How many times as fast as received, 0 for no waiting
+        :param offset:      Seconds into the capture to start from
+        :param routers:     Names of the routers to replay, or all
+    """
+    start = None
+    if offset and capture.first is not None:
+        start = capture.first + offset
+
+    origin = None           # (capture time, wall clock time) of the first message sent
+    for (timestamp, router, msg) in capture.records(start):
+        if offset and start is None:
+            # without the index the capture's start is only known now
+            start = timestamp + offset
+        if start is not None and timestamp < start:
+            continue
+        if routers and router not in routers:
+            continue
+        if origin is None:
+            origin = (timestamp, time.time())
+
+        if speed:
+            wait = origin[1] + (timestamp - origin[0]) / speed - time.time()
+            if wait >= MIN_SLEEP:
+                replayer.flush()
+                time.sleep(wait)
+
+        replayer.add(router, msg)
+
+    replayer.flush()
+
+
+def main():
+    """ Main entry point """
+    cfg = parse_cmd_args(sys.argv)
+
+    try:
+        capture = Capture_reader(cfg['filename'])
+    except (IOError, ValueError) as e:
+        print("Failed to open capture '%s': %s" % (cfg['filename'], e))
+        sys.exit(2)
+
+    if cfg['info']:
+        print_info(capture)
+        capture.close()
+        sys.exit(0)
+
+    replayer = Replayer(cfg['host'], cfg['port'], cfg['collector'])
+    started = time.time()
+    try:
+        replay(capture, replayer, cfg['speed'], cfg['offset'], cfg['routers'])
+
+    except KeyboardInterrupt:
+        print("\nStop requested by user")
+
+    except socket.error as e:
+        print("Failed to send to %s:%d: %s" % (cfg['host'], cfg['port'], e))
+        sys.exit(1)
+
+    finally:
+        replayer.close()
+        capture.close()
+
+    elapsed = time.time() - started
+    print("sent %d messages, %d bytes in %.1f seconds (%.0f msgs/sec)" %
+          (replayer.msgs, replayer.bytes, elapsed, replayer.msgs / elapsed if elapsed else 0))
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,11 +3,11 @@
 # take a message which is allegedly BMP and parse it into an object wih plausible attributes
 #
 
+import logging
 import struct
-import sys
 from bgpparse import *
-def eprint(s):
-    sys.stderr.write(s+'\n')
+
+_log = logging.getLogger(__name__)
 
 
 BMP_Route_Monitoring = 0
@@ -18,20 +18,130 @@ BMP_Initiation_Message = 4
 BMP_Termination_Message = 5
 BMP_Route_Mirroring_Message = 6
 
-class BMP_message:
+BMP_common_header_length = 6
+BMP_max_message_length = 0x1000000
+
+# per-peer header Peer Flags
+BMP_Peer_Flag_IPv6 = 0x80       # V
+BMP_Peer_Flag_Post_Policy = 0x40 # L
+BMP_Peer_Flag_Legacy_AS = 0x20  # A, the AS_PATH has 2 byte rather than 4 byte ASes
+
+# precompiled layouts, so that each header is decoded with one call
+_common_header = struct.Struct('!BIB')              # version, length, type
+# Peer Type, Peer Flags, Peer Distinguisher, Peer Address (16 bytes, as two halves),
+# Peer AS, Peer BGP ID, Timestamp seconds, Timestamp microseconds
+_per_peer_header = struct.Struct('!BBQQQIIII')
+_uint32 = struct.Struct('!I')
+
+_per_peer_fields = ('bmp_ppc_Peer_Type', 'bmp_ppc_Peer_Flags', 'bmp_ppc_Peer_Distinguisher',
+                    'bmp_ppc_Peer_Address', 'bmp_ppc_Peer_AS', 'bmp_ppc_Peer_BGPID',
+                    'bmp_ppc_Timestamp_Seconds', 'bmp_ppc_Timestamp_Microseconds',
+                    'bmp_ppc_fixed_hash')
+
+class BMP_framer(object):
+    # reassemble complete BMP messages from a stream socket
+    #
+    # one buffer is kept per connection; the socket reads straight into its free tail
+    # (recv_into) and complete messages are handed out as memoryview slices of it, so
+    # no copy is made until the caller wants one.  Only a partial message left at the
+    # end of a read is moved back to the front of the buffer, ready for the next read.
+    # The slices returned by frames() are only valid until the next call to recv().
+
+    def __init__(self, size=0x100000):
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+
+    def pending(self):
+        return self._end - self._start
+
+    def _make_room(self):
+        # called before every read: discard consumed messages and make sure that
+        # the message at the head of the buffer (if its length is known) can fit
+        tail = self._end - self._start
+        needed = len(self._buf)
+        if tail >= BMP_common_header_length:
+            length = _uint32.unpack_from(self._buf, self._start+1)[0]
+            needed = max(needed, min(length, BMP_max_message_length))
+        if tail == len(self._buf):
+            needed = 2 * tail
+        if needed > len(self._buf):
+            buf = bytearray(needed)
+            buf[0:tail] = self._buf[self._start:self._end]
+            self._buf = buf
+            self._view = memoryview(buf)
+        elif self._start > 0:
+            if tail > 0:
+                self._buf[0:tail] = self._buf[self._start:self._end]
+        self._start = 0
+        self._end = tail
+
+    def recv(self, sock):
+        # read whatever the socket has into the buffer, returns the byte count (0 at EOF)
+        if self._start > 0 or self._end == len(self._buf):
+            self._make_room()
+        n = sock.recv_into(self._view[self._end:])
+        self._end += n
+        return n
+
+    def feed(self, data):
+        # append bytes obtained elsewhere (e.g. from a decoder) to the buffer
+        offset = 0
+        while offset < len(data):
+            if self._start > 0 or self._end == len(self._buf):
+                self._make_room()
+            n = min(len(data) - offset, len(self._buf) - self._end)
+            self._buf[self._end:self._end+n] = data[offset:offset+n]
+            self._end += n
+            offset += n
 
-    def __init__(self,msg):
+    def peek(self, n):
+        # the first n bytes buffered and not yet framed, fewer if not yet received
+        return bytes(self._buf[self._start:min(self._end, self._start + n)])
+
+    def take(self):
+        # remove and return every byte buffered and not yet framed
+        data = bytes(self._buf[self._start:self._end])
+        self._start = 0
+        self._end = 0
+        return data
+
+    def frames(self):
+        # yield every complete message currently buffered
+        while self._end - self._start >= BMP_common_header_length:
+            version, length, msg_type = _common_header.unpack_from(self._buf, self._start)
+            if 3 != version or 6 < msg_type or length < BMP_common_header_length or length > BMP_max_message_length:
+                raise ValueError("BMP framing error (version %d, length %d, type %d)" % (version, length, msg_type))
+            if self._end - self._start < length:
+                if length > len(self._buf):
+                    # grow now, so that the rest of the message can be read in
+                    self._make_room()
+                break
+            start = self._start
+            self._start += length
+            yield self._view[start:start+length]
+
+class BMP_message(object):
+    # only the common header is decoded up front, the per-peer header and the
+    # BGP message of a route monitoring message are decoded when first used
+
+    __slots__ = ('_msg', '_attribute_cache', 'version', 'length', 'msg_type', 'bmp_RM_bgp_message') + _per_peer_fields
+
+    def __init__(self,msg,attribute_cache=None):
+        # attribute_cache: optional bgpparse.Attribute_cache used to decode route monitoring
+        # messages, shared by the messages of every peer
         # parse the common header (CH)
-        self.version  = struct.unpack_from('!B', msg, offset=0)[0]
+        self._msg = msg
+        self._attribute_cache = attribute_cache
+        (self.version, self.length, self.msg_type) = _common_header.unpack_from(msg)
         assert 3 == self.version
-        self.length   = struct.unpack_from('!I', msg, offset=1)[0]
-        self.msg_type = struct.unpack_from('!B', msg, offset=5)[0]
         msg_len  = len(msg)
         assert msg_len >= self.length
 
 
         if 6 < self.msg_type:
-            eprint("msg_type out of range %d" % self.msg_type)
+            _log.warning("msg_type out of range %d", self.msg_type)
             ## sys.exit()
             return None
 
@@ -39,20 +149,47 @@ class BMP_message:
             pass # there is no PPC header in these messages
         else:
             assert msg_len > 47
-            self.bmp_ppc_fixed_hash = hash(msg[6:40])
-            self.bmp_ppc_Peer_Type = struct.unpack_from('!B', msg, offset=6)[0]               # 1 byte index 6
-            self.bmp_ppc_Peer_Flags = struct.unpack_from('!B', msg, offset=7)[0]              # 1 byte index 7
-            self.bmp_ppc_Peer_Distinguisher  = struct.unpack_from('!Q', msg, offset=8)[0]     # 8 bytes index 8
-            # 16 byte field to accomodate IPv6, however I assume IPv4 here!
-            self.bmp_ppc_Peer_Address = struct.unpack_from('!I', msg, offset=16)[0]           # 16 bytes index 16
-            self.bmp_ppc_Peer_AS = struct.unpack_from('!I', msg, offset=32)[0]                # 4 bytes index 32
-            self.bmp_ppc_Peer_BGPID = struct.unpack_from('!I', msg, offset=36)[0]             # 4 bytes index 36
-            self.bmp_ppc_Timestamp_Seconds = struct.unpack_from('!I', msg, offset=40)[0]      # 4 bytes index 40
-            self.bmp_ppc_Timestamp_Microseconds = struct.unpack_from('!I', msg, offset=44)[0] # 4 bytes index 44
 
+    def __getattr__(self, name):
+        # called only for attributes not yet set
+        if name in _per_peer_fields and self.has_per_peer_header():
+            self.parse_per_peer_header()
+            return getattr(self, name)
+        elif name == 'bmp_RM_bgp_message' and self.msg_type == BMP_Route_Monitoring:
+            as_width = 2 if self.bmp_ppc_Peer_Flags & BMP_Peer_Flag_Legacy_AS else 4
+            self.bmp_RM_bgp_message = BGP_message(self._msg[48:], as_width, self._attribute_cache, self.bmp_ppc_fixed_hash)
+            return self.bmp_RM_bgp_message
+        raise AttributeError(name)
+
+    def per_peer_header(self):
+        # the raw per-peer header, or None
+        if self.has_per_peer_header():
+            return self._msg[6:48]
+        return None
+
+    def has_per_peer_header(self):
+        return self.msg_type <= 6 and self.msg_type != BMP_Initiation_Message and self.msg_type != BMP_Termination_Message
+
+    def parse_per_peer_header(self):
+            msg = self._msg
+            self.bmp_ppc_fixed_hash = hash(msg[6:40])
+            # 16 byte address field to accomodate IPv6, an IPv4 address is in its
+            # last 4 bytes (RFC 7854 4.2), so as an integer it is the address either way
+            (self.bmp_ppc_Peer_Type,                # 1 byte index 6
+             self.bmp_ppc_Peer_Flags,               # 1 byte index 7
+             self.bmp_ppc_Peer_Distinguisher,       # 8 bytes index 8
+             address_high,                          # 16 bytes index 16
+             address_low,
+             self.bmp_ppc_Peer_AS,                  # 4 bytes index 32
+             self.bmp_ppc_Peer_BGPID,               # 4 bytes index 36
+             self.bmp_ppc_Timestamp_Seconds,        # 4 bytes index 40
+             self.bmp_ppc_Timestamp_Microseconds    # 4 bytes index 44
+             ) = _per_peer_header.unpack_from(msg, 6)
+            self.bmp_ppc_Peer_Address = (address_high << 64) | address_low
 
-        if (self.msg_type == BMP_Route_Monitoring):
-            self.bmp_RM_bgp_message = BGP_message(msg[48:])
+def encode_BMP_message(msg_type, body):
+    # a complete BMP message of msg_type, body includes any per-peer header
+    return _common_header.pack(3, BMP_common_header_length + len(body), msg_type) + body
 
 def get_BMP_messages(msg):
         msg_len  = len(msg)
@@ -60,9 +197,7 @@ def get_BMP_messages(msg):
         msgs = []
         while offset < msg_len:
             if msg_len - offset > 5:
-                version  = struct.unpack_from('!B', msg, offset=offset)[0]
-                length   = struct.unpack_from('!I', msg, offset=offset+1)[0]
-                msg_type = struct.unpack_from('!B', msg, offset=offset+5)[0]
+                (version, length, msg_type) = _common_header.unpack_from(msg, offset)
             else:
                 version  = 0xff
                 length   = 0
@@ -72,15 +207,15 @@ def get_BMP_messages(msg):
                 msgs.append((offset,length))
                 offset += length
             else:
-                eprint("-- error parsing BMP messages (%d:%d:%d:%d)" % (len(msgs),msg_len,offset,length))
+                _log.warning("-- error parsing BMP messages (%d:%d:%d:%d)", len(msgs),msg_len,offset,length)
                 return []
 
         # now process each seprate chunk as a BMP message
         bmp_msgs = []
         if len(msgs) > 1:
-            eprint("--multipart BMP message with %d chunks" % len(msgs))
+            _log.debug("--multipart BMP message with %d chunks", len(msgs))
         for (offset,length) in msgs:
             if len(msgs) > 1:
-                eprint("--multipart BMP chunk at (%d :%d)" % (offset,length))
+                _log.debug("--multipart BMP chunk at (%d :%d)", offset,length)
             bmp_msgs.append(BMP_message(msg[offset:offset+length]))
         return bmp_msgs
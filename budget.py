@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+""" Byte budget of the forward queue
+
+  max_queue_size bounds the forward queue by messages, so a full table of
+  large updates takes as many slots as the same number of small statistics
+  reports.  With max_queue_bytes set the queue is bounded by the bytes it
+  holds instead, and overload_policy decides what a producer (the listener,
+  or each decoder) does with a message that does not fit:
+
+    block   wait for the senders to make room.  The producer stops reading
+            from the routers, which TCP turns into backpressure on them.
+    drop    drop Statistics Reports once the queue is more than drop_level
+            full, and route monitoring and mirroring messages once it is
+            full.  Initiation, Termination and Peer Up/Down messages, which
+            the collector's view of the routers depends on, wait for room.
+    spill   write the message to a disk spool, and every following one until
+            the spool has been moved back into the queue as room frees up,
+            so the messages stay in order.  Messages the spool refuses, once
+            it reaches its max_size, are dropped.
+
+  The bytes held are counted in an anonymous shared mmap created before the
+  processes are forked: each producer adds the bytes it puts to its own
+  word, and the sender of the manager queue the bytes it gets to another, so
+  no lock is needed.  The shared ring buffer counts its bytes itself.  The
+  same mapping holds each producer's drop, stall and spill counters.
+"""
+import ctypes
+import logging
+import mmap
+import time
+
+from metrics import BMP_TYPE_NAMES
+from spool import Spool, EVICT_NEWEST
+
+POLICY_BLOCK = 'block'
+POLICY_DROP = 'drop'
+POLICY_SPILL = 'spill'
+POLICIES = (POLICY_BLOCK, POLICY_DROP, POLICY_SPILL)
+
+# BMP message types, by the byte at offset 5 of the message
+_STATISTICS_REPORT = 1
+_DROPPABLE = (0, 1, 6)      # route monitoring, statistics report, route mirroring
+_TYPES = 7
+
+# words of the control block: the bytes got by the consumer, then a cache line per producer
+_GOT = 0
+_PRODUCER = 8
+_P_BYTES = 0            # bytes put
+_P_DROPPED = 1          # 7 words, by BMP message type
+_P_STALLS = 8           # times a message had to wait for room
+_P_STALL_TIME = 9       # microseconds waited
+_P_SPILLED = 10         # messages written to the spool
+_P_SPOOLED = 11         # messages in the spool now
+_PRODUCER_WORDS = 16
+
+# polling intervals used while waiting for room, in seconds
+_MIN_WAIT = 0.00001
+_MAX_WAIT = 0.001
+
+# messages moved back from the spool at a time
+_PUMP_BATCH = 1000
+
+
+class Queue_budget(object):
+    """ Bytes held by the forward queue, and the overload counters of its producers """
+
+    def __init__(self, max_bytes, producers, names, ring=None):
+        """ Constructor
+
+            :param max_bytes:   Most bytes the queue may hold
+            :param producers:   Number of processes putting to the queue
+            :param names:       Name of each producer, for its metrics labels
+            :param ring:        ringbuffer.RingBuffer when that is the queue, which counts
+                                the bytes it holds itself; the budget is then at most its size
+        """
+        if ring is not None:
+            max_bytes = min(max_bytes, ring.capacity())
+        self.max_bytes = max_bytes
+        self.names = names
+        self._ring = ring
+
+        words = _PRODUCER + producers * _PRODUCER_WORDS
+        self._mm = mmap.mmap(-1, words * 8, flags=mmap.MAP_SHARED)
+        self._words = (ctypes.c_uint64 * words).from_buffer(self._mm)
+        self._producers = producers
+
+    def held(self):
+        """ Bytes in the queue """
+        if self._ring is not None:
+            return self._ring.used()
+        w = self._words
+        put = sum(w[_PRODUCER + i * _PRODUCER_WORDS + _P_BYTES] for i in range(self._producers))
+        return max(put - w[_GOT], 0)
+
+    def producer(self, queue, index, policy=POLICY_BLOCK, drop_level=0.5, spill=None):
+        """ Producer end of the queue, for the process at index
+
+            :param queue:       Forward queue to put to
+            :param index:       Producer number, from 0
+            :param policy:      POLICY_BLOCK, POLICY_DROP or POLICY_SPILL
+            :param drop_level:  Fraction of the budget above which Statistics Reports are dropped
+            :param spill:       Spool settings for POLICY_SPILL: directory, segment_size, max_size
+
+            :return: Budgeted_queue
+        """
+        return Budgeted_queue(self, queue, index, policy, drop_level, spill)
+
+    def consumer(self, queue):
+        """ Consumer end of the manager queue, for its sender
+
+            :return: Budgeted_reader
+        """
+        return Budgeted_reader(self, queue)
+
+    def counters(self):
+        """ The overload counters of every producer, as Metrics.render() counters """
+        w = self._words
+        counters = []
+        for (i, name) in enumerate(self.names):
+            base = _PRODUCER + i * _PRODUCER_WORDS
+            labels = {'producer': name}
+            for t in range(_TYPES):
+                counters.append(("bmp_proxy_queue_dropped_messages_total",
+                                 "Messages dropped because the forward queue was over its byte budget",
+                                 dict(labels, type=BMP_TYPE_NAMES[t]),
+                                 lambda word=base + _P_DROPPED + t: w[word]))
+            counters.append(("bmp_proxy_queue_stalls_total",
+                             "Times a message waited for room in the forward queue", labels,
+                             lambda word=base + _P_STALLS: w[word]))
+            counters.append(("bmp_proxy_queue_stall_seconds_total",
+                             "Time spent waiting for room in the forward queue", labels,
+                             lambda word=base + _P_STALL_TIME: w[word] / 1e6))
+            counters.append(("bmp_proxy_queue_spilled_messages_total",
+                             "Messages written to the overload spool", labels,
+                             lambda word=base + _P_SPILLED: w[word]))
+        return counters
+
+    def gauges(self):
+        """ The bytes held and the messages spooled, as Metrics.render() gauges """
+        w = self._words
+        gauges = [("bmp_proxy_queue_bytes", "Bytes held in the forward queue", {}, self.held)]
+        for (i, name) in enumerate(self.names):
+            gauges.append(("bmp_proxy_queue_spooled_messages", "Messages held in the overload spool",
+                           {'producer': name},
+                           lambda word=_PRODUCER + i * _PRODUCER_WORDS + _P_SPOOLED: w[word]))
+        return gauges
+
+
+class Budgeted_queue(object):
+    """ Producer end of the forward queue, keeping it within the byte budget
+
+        Offers the put() of the queue it wraps, used by a single process.
+    """
+
+    def __init__(self, budget, queue, index, policy, drop_level, spill):
+        if policy not in POLICIES:
+            raise ValueError("overload policy must be one of %s" % ", ".join(POLICIES))
+        if policy == POLICY_SPILL and not (spill and 'directory' in spill):
+            raise ValueError("overload policy '%s' needs a spill directory" % POLICY_SPILL)
+
+        self._budget = budget
+        self._queue = queue
+        self._words = budget._words
+        self._base = _PRODUCER + index * _PRODUCER_WORDS
+        self._name = budget.names[index]
+        self._policy = policy
+        self._drop_bytes = int(budget.max_bytes * drop_level)
+        self._spill = spill
+        self._spool = None
+        self._overloaded = False
+        self.LOG = logging.getLogger(self._name)
+
+    def put(self, msg):
+        """ Put a message, or wait, drop or spill it as the policy says when it does not fit
+
+            :param msg:     Message bytes
+        """
+        if self._policy == POLICY_SPILL:
+            if self._spool is None:
+                self._open_spool()
+            if len(self._spool) and not self.pump():
+                self._spill_msg(msg)
+                return
+
+        budget = self._budget.max_bytes
+        held = self._budget.held()
+        if held + len(msg) <= budget and (held < self._drop_bytes or self._policy != POLICY_DROP or
+                                          ord(msg[5:6]) != _STATISTICS_REPORT):
+            self._overloaded = False
+            self._put(msg)
+            return
+
+        self.overload()
+        msg_type = ord(msg[5:6])
+        if self._policy == POLICY_DROP and msg_type in _DROPPABLE:
+            self._words[self._base + _P_DROPPED + msg_type] += 1
+        elif self._policy == POLICY_SPILL:
+            self._spill_msg(msg)
+        else:
+            self._wait(len(msg))
+            self._put(msg)
+
+    def _put(self, msg):
+        self._words[self._base + _P_BYTES] += len(msg)
+        self._queue.put(msg)
+
+    def overload(self):
+        """ Log the start of an overload, once until a message fits again """
+        if not self._overloaded:
+            self._overloaded = True
+            if self._policy == POLICY_BLOCK:
+                action = "waiting for room"
+            elif self._policy == POLICY_DROP:
+                action = "dropping messages"
+            else:
+                action = "spilling to %s" % self._spill['directory']
+            self.LOG.warning("forward queue holds %d of %d bytes, %s" %
+                             (self._budget.held(), self._budget.max_bytes, action))
+
+    def _wait(self, length):
+        """ Poll until length bytes fit, backing off from a short spin to _MAX_WAIT sleeps """
+        started = time.time()
+        self._words[self._base + _P_STALLS] += 1
+        wait = _MIN_WAIT
+        # a message larger than the budget is let through once the queue is empty
+        while self._budget.held() + length > self._budget.max_bytes and self._budget.held() > 0:
+            time.sleep(wait)
+            wait = min(wait * 2, _MAX_WAIT)
+        self._words[self._base + _P_STALL_TIME] += int((time.time() - started) * 1e6)
+
+    def _open_spool(self):
+        spill = self._spill
+        self._spool = Spool(spill['directory'], spill.get('segment_size', 64 * 1024 * 1024),
+                            spill.get('max_size', 1024 * 1024 * 1024), EVICT_NEWEST)
+        if len(self._spool):
+            self.LOG.info("%d messages spilled by an earlier run are forwarded first" % len(self._spool))
+        self._words[self._base + _P_SPOOLED] = len(self._spool)
+
+    def _spill_msg(self, msg):
+        if self._spool.append(msg):
+            self._words[self._base + _P_SPILLED] += 1
+            self._words[self._base + _P_SPOOLED] = len(self._spool)
+        else:
+            self._words[self._base + _P_DROPPED + ord(msg[5:6])] += 1
+
+    def pump(self):
+        """ Move spilled messages back into the queue while there is room
+
+            Called by the producer from its loop, so that the spool drains while
+            the routers are quiet.
+
+            :return: True once the spool is empty
+        """
+        if self._spool is None:
+            if self._policy != POLICY_SPILL:
+                return True
+            self._open_spool()
+
+        while len(self._spool):
+            room = self._budget.max_bytes - self._budget.held()
+            msgs = self._spool.peek(_PUMP_BATCH, room)
+            moved = 0
+            for msg in msgs:
+                if len(msg) > room and (moved or self._budget.held() > 0):
+                    break
+                self._put(msg)
+                room -= len(msg)
+                moved += 1
+            if not moved:
+                break
+            self._spool.consume(msgs[:moved])
+            self._words[self._base + _P_SPOOLED] = len(self._spool)
+
+        if not len(self._spool):
+            self._overloaded = False
+            return True
+        return False
+
+    def stats(self):
+        w = self._words
+        base = self._base
+        return "%d stalls (%.1f seconds), %d dropped (%d statistics reports), %d spilled, %d still spooled" % (
+            w[base + _P_STALLS], w[base + _P_STALL_TIME] / 1e6,
+            sum(w[base + _P_DROPPED + t] for t in range(_TYPES)), w[base + _P_DROPPED + _STATISTICS_REPORT],
+            w[base + _P_SPILLED], len(self._spool) if self._spool is not None else 0)
+
+    def close(self):
+        """ Close the spool, keeping any messages still in it for the next run """
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+
+
+class Budgeted_reader(object):
+    """ Consumer end of the manager queue, counting the bytes taken out of it
+
+        Offers the subset of the Queue interface used by the sender.
+    """
+
+    def __init__(self, budget, queue):
+        self._budget = budget
+        self._queue = queue
+        self._words = budget._words
+
+    def get(self, block=True, timeout=None):
+        msg = self._queue.get(block, timeout)
+        self._words[_GOT] += len(msg)
+        return msg
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def empty(self):
+        return self._queue.empty()
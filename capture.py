@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+""" Capture files
+
+  A capture holds BMP messages as received, each with its receive time and
+  the router it came from, for replay with bmp-replay.py.  The file starts
+  with an 8 byte magic, followed by records of a 15 byte header (kind,
+  router number, timestamp, length) and a payload:
+
+    message     a BMP message received from the router
+    router      defines a router number, the payload is the router's name
+    index       written on close: the totals, the router names and the file
+                offset of the first record at least every INDEX_INTERVAL bytes
+
+  The file ends with the offset of the index record and a second magic.  A
+  capture that was not closed (the proxy was killed) has no index; it is read
+  from the start, up to its last complete record.
+"""
+import mmap
+import os
+import struct
+import time
+from bisect import bisect_right
+
+MAGIC = b'BMPCAP01'
+INDEX_MAGIC = b'BMPINDEX'
+
+RECORD_MESSAGE = 0
+RECORD_ROUTER = 1
+RECORD_INDEX = 2
+
+INDEX_INTERVAL = 1024 * 1024    # bytes of file between index entries
+
+_record = struct.Struct('!BHdI')            # kind, router, timestamp, payload length
+_index_header = struct.Struct('!QQddII')    # messages, bytes, first and last timestamps, routers, entries
+_index_entry = struct.Struct('!dQ')         # timestamp, offset of a record
+_name_length = struct.Struct('!H')
+_footer = struct.Struct('!Q8s')             # offset of the index record, INDEX_MAGIC
+
+
+class Capture_writer(object):
+    """ Appends received messages to a new capture file """
+
+    def __init__(self, filename, buffer_size=1024 * 1024):
+        """ Constructor
+
+            :param filename:        File to create, replacing any there
+            :param buffer_size:     Bytes buffered before writing to the file
+        """
+        self.filename = filename
+        self._file = open(filename, 'wb', buffer_size)
+        self._file.write(MAGIC)
+        self._offset = len(MAGIC)
+        self._routers = {}          # name -> number
+        self._names = []
+        self._index = []            # (timestamp, offset)
+        self._next_index = 0
+        self._last = 0.0
+        self.first = None
+        self.msgs = 0
+        self.bytes = 0
+
+    def write(self, router, msg, timestamp=None):
+        """ Append a message
+
+            :param router:      Name of the router it was received from
+            :param msg:         Raw BMP message
+            :param timestamp:   Time it was received, now by default
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        # replay relies on the times never going back
+        timestamp = max(timestamp, self._last)
+        self._last = timestamp
+        if self.first is None:
+            self.first = timestamp
+
+        number = self._routers.get(router)
+        if number is None:
+            number = len(self._names)
+            if number > 0xffff:
+                raise ValueError("capture %s has too many routers" % self.filename)
+            name = router.encode('utf-8')
+            self._routers[router] = number
+            self._names.append(name)
+            self._append(RECORD_ROUTER, number, timestamp, name)
+
+        if self._offset >= self._next_index:
+            self._index.append((timestamp, self._offset))
+            self._next_index = self._offset + INDEX_INTERVAL
+
+        self._append(RECORD_MESSAGE, number, timestamp, msg)
+        self.msgs += 1
+        self.bytes += len(msg)
+
+    def _append(self, kind, number, timestamp, payload):
+        self._file.write(_record.pack(kind, number, timestamp, len(payload)))
+        self._file.write(payload)
+        self._offset += _record.size + len(payload)
+
+    def close(self):
+        """ Write the index and close the file """
+        if self._file is None:
+            return
+        index = [_index_header.pack(self.msgs, self.bytes, self.first or 0.0, self._last,
+                                    len(self._names), len(self._index))]
+        index += [_name_length.pack(len(name)) + name for name in self._names]
+        index += [_index_entry.pack(timestamp, offset) for (timestamp, offset) in self._index]
+        offset = self._offset
+        self._append(RECORD_INDEX, 0, self._last, b''.join(index))
+        self._file.write(_footer.pack(offset, INDEX_MAGIC))
+        self._file.close()
+        self._file = None
+
+
+class Capture_reader(object):
+    """ Reads a capture through a memory map, so that captures of any size stream from disk """
+
+    def __init__(self, filename):
+        """ Constructor
+
+            :param filename:    Capture file
+
+            :raises ValueError: if the file is not a capture
+        """
+        self.filename = filename
+        self._file = open(filename, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        if size < len(MAGIC) or self._file.read(len(MAGIC)) != MAGIC:
+            self._file.close()
+            raise ValueError("%s is not a capture file" % filename)
+
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(self._map, 'madvise'):
+            self._map.madvise(mmap.MADV_SEQUENTIAL)
+
+        self._end = size
+        self.indexed = False
+        self.routers = {}           # number -> name
+        self._index = []
+        self.msgs = None            # totals, known only from the index
+        self.bytes = None
+        self.first = None
+        self.last = None
+
+        if size >= len(MAGIC) + _footer.size:
+            (offset, magic) = _footer.unpack_from(self._map, size - _footer.size)
+            if magic == INDEX_MAGIC and offset < size:
+                self._read_index(offset)
+
+    def _read_index(self, offset):
+        (kind, number, timestamp, length) = _record.unpack_from(self._map, offset)
+        if kind != RECORD_INDEX:
+            return
+        position = offset + _record.size
+        (self.msgs, self.bytes, self.first, self.last, routers, entries) = \
+            _index_header.unpack_from(self._map, position)
+        position += _index_header.size
+        for number in range(routers):
+            length = _name_length.unpack_from(self._map, position)[0]
+            position += _name_length.size
+            self.routers[number] = self._map[position:position + length].decode('utf-8')
+            position += length
+        for i in range(entries):
+            self._index.append(_index_entry.unpack_from(self._map, position))
+            position += _index_entry.size
+        self._end = offset
+        self.indexed = True
+
+    def records(self, start=None):
+        """ The messages of the capture, in the order received
+
+            :param start:       Skip the messages received before this time
+
+            :return: generator of (timestamp, router name, raw message)
+        """
+        offset = len(MAGIC)
+        if start is not None and self._index:
+            i = bisect_right([timestamp for (timestamp, position) in self._index], start)
+            if i > 0:
+                offset = self._index[i - 1][1]
+
+        routers = self.routers
+        end = self._end
+        data = self._map
+        while offset + _record.size <= end:
+            (kind, number, timestamp, length) = _record.unpack_from(data, offset)
+            offset += _record.size
+            if offset + length > end:
+                break           # torn record at the end of a capture that was not closed
+            if kind == RECORD_MESSAGE:
+                if start is None or timestamp >= start:
+                    yield (timestamp, routers[number], data[offset:offset + length])
+            elif kind == RECORD_ROUTER:
+                routers[number] = data[offset:offset + length].decode('utf-8')
+            else:
+                break
+            offset += length
+
+    def close(self):
+        self._map.close()
+        self._file.close()
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+""" Update coalescing
+
+  While a route flaps a peer can announce and withdraw the same prefixes many
+  times a second, each change a route monitoring message for the collector.
+  With coalescing the updates of each peer are held for a short window, as
+  the latest state of each prefix: announced with a set of path attributes,
+  or withdrawn.  When the window closes only that net state is forwarded,
+  re-encoded as route monitoring messages (one update per attribute set, and
+  one of the withdrawals) under the peer's latest per-peer header.
+
+  Route monitoring messages that cannot be merged this way (End-of-RIB, and
+  updates carrying multiprotocol NLRI in their attributes) flush the held
+  updates of their peer and are forwarded after them, so the collector sees
+  each peer's changes in order; a Peer Down discards them.  A Peer Up
+  flushes the updates still held for its peer, and a Termination those of
+  every peer of its router, so that they reach the collector before it.
+  Other messages are forwarded at once.  The prefixes held are bounded,
+  reaching the bound flushes every peer.
+"""
+from collections import OrderedDict
+
+from bgpparse import (encode_prefixes, encode_update, split_prefixes, BGP_UPDATE, BGP_header_length,
+                      BGP_max_message_length, BGP_TYPE_CODE_MP_REACH_NLRI, BGP_TYPE_CODE_MP_UNREACH_NLRI)
+from bmpparse import (encode_BMP_message, BMP_Route_Monitoring, BMP_Peer_Down_Notification, BMP_Peer_Up_Notification,
+                      BMP_Termination_Message)
+
+
+class _Held(object):
+    """ Updates held for one peer """
+
+    __slots__ = ('router', 'header', 'routes', 'start', 'msgs')
+
+    def __init__(self, router, start):
+        self.router = router
+        self.header = None      # per-peer header of the latest update
+        self.routes = {}        # (prefix, length) -> Path_attributes, or None if withdrawn
+        self.start = start      # time the first update was held
+        self.msgs = 0           # route monitoring messages held
+
+
+class Coalescer(object):
+    """ Holds and merges the route monitoring messages of every peer for a window """
+
+    def __init__(self, window=1.0, max_prefixes=100000, metrics=None):
+        """ Constructor
+
+            :param window:          Seconds to hold a peer's updates, from the first held
+            :param max_prefixes:    Most prefixes held for all peers
+            :param metrics:         metrics.Metrics to count in, or None
+        """
+        self.window = window
+        self.max_prefixes = max_prefixes
+        self._metrics = metrics
+        self._peers = OrderedDict()         # (router, peer hash) -> _Held, oldest first
+        self._held = 0
+
+        self.coalesced = 0      # route monitoring messages held
+        self.forwarded = 0      # messages forwarded for them
+        self.suppressed = 0     # held messages not forwarded, their changes merged or discarded
+        self.overflows = 0      # times max_prefixes was reached
+
+    def add(self, router, bmpmsg, raw_msg, now):
+        """ Hold a decoded message, or pass it on
+
+            :param router:      Name of the router it was received from
+            :param bmpmsg:      bmpparse.BMP_message
+            :param raw_msg:     Raw message
+            :param now:         Time it was received
+
+            :return: List of (router, raw message) to forward now, in order
+        """
+        if bmpmsg.msg_type == BMP_Peer_Down_Notification:
+            self.discard((router, bmpmsg.bmp_ppc_fixed_hash))
+            return [(router, raw_msg)]
+        if bmpmsg.msg_type == BMP_Termination_Message:
+            return self.flush_router(router) + [(router, raw_msg)]
+        if bmpmsg.msg_type == BMP_Peer_Up_Notification:
+            return self.flush((router, bmpmsg.bmp_ppc_fixed_hash)) + [(router, raw_msg)]
+        if bmpmsg.msg_type != BMP_Route_Monitoring:
+            return [(router, raw_msg)]
+
+        key = (router, bmpmsg.bmp_ppc_fixed_hash)
+        bgp = bmpmsg.bmp_RM_bgp_message
+        if bgp.bgp_type != BGP_UPDATE:
+            return self.flush(key) + [(router, raw_msg)]
+        attributes = bgp.attribute
+        if (bgp.withdrawn_count() == 0 and bgp.NLRI_count() == 0) or \
+                (attributes is None and bgp.NLRI_count()) or \
+                (attributes is not None and (BGP_TYPE_CODE_MP_REACH_NLRI in attributes or
+                                             BGP_TYPE_CODE_MP_UNREACH_NLRI in attributes)):
+            return self.flush(key) + [(router, raw_msg)]
+
+        held = self._peers.get(key)
+        if held is None:
+            held = _Held(router, now)
+            self._peers[key] = held
+        held.header = bmpmsg.per_peer_header()
+        held.msgs += 1
+        self.coalesced += 1
+
+        routes = held.routes
+        before = len(routes)
+        # withdrawals first, as BGP applies them
+        for (length, prefix) in bgp.withdrawn_block:
+            routes[(prefix, length)] = None
+        for (length, prefix) in bgp.NLRI_block:
+            routes[(prefix, length)] = attributes
+        self._held += len(routes) - before
+
+        if self._held > self.max_prefixes:
+            self.overflows += 1
+            return self.flush_all()
+        return []
+
+    def expired(self, now):
+        """ Flush the peers whose window has closed
+
+            :param now:     Current time
+
+            :return: List of (router, raw message) to forward
+        """
+        msgs = []
+        while self._peers:
+            key = next(iter(self._peers))
+            if now - self._peers[key].start < self.window:
+                break
+            msgs.extend(self.flush(key))
+        return msgs
+
+    def flush(self, key):
+        """ The net changes held for a peer, as route monitoring messages
+
+            :param key:     (router, per-peer header hash)
+
+            :return: List of (router, raw message)
+        """
+        held = self._peers.pop(key, None)
+        if held is None:
+            return []
+
+        announced = {}
+        withdrawn = []
+        for ((prefix, length), attributes) in held.routes.items():
+            if attributes is None:
+                withdrawn.append((length, prefix))
+            else:
+                announced.setdefault(attributes, []).append((length, prefix))
+
+        room = BGP_max_message_length - BGP_header_length - 4
+        msgs = []
+        if withdrawn:
+            for block in split_prefixes(encode_prefixes(withdrawn), room):
+                msgs.append(encode_BMP_message(BMP_Route_Monitoring, held.header + encode_update(block)))
+        for (attributes, prefixes) in announced.items():
+            for block in split_prefixes(encode_prefixes(prefixes), max(room - len(attributes.raw), 5)):
+                msgs.append(encode_BMP_message(BMP_Route_Monitoring,
+                                               held.header + encode_update(b'', attributes.raw, block)))
+
+        self._held -= len(held.routes)
+        self.forwarded += len(msgs)
+        self._count(held, len(msgs))
+        return [(held.router, msg) for msg in msgs]
+
+    def flush_all(self):
+        """ The net changes held for every peer
+
+            :return: List of (router, raw message)
+        """
+        msgs = []
+        for key in list(self._peers):
+            msgs.extend(self.flush(key))
+        return msgs
+
+    def discard(self, key):
+        """ Drop the updates held for a peer
+
+            :param key:     (router, per-peer header hash)
+        """
+        held = self._peers.pop(key, None)
+        if held is not None:
+            self._held -= len(held.routes)
+            self._count(held, 0)
+
+    def flush_router(self, router):
+        """ The net changes held for the peers of a router, when it disconnects
+
+            :param router:  Name of the router
+
+            :return: List of (router, raw message)
+        """
+        msgs = []
+        for key in [key for key in self._peers if key[0] == router]:
+            msgs.extend(self.flush(key))
+        return msgs
+
+    def _count(self, held, forwarded):
+        suppressed = max(held.msgs - forwarded, 0)
+        self.suppressed += suppressed
+        if self._metrics is not None:
+            router_metrics = self._metrics.router(held.router.rsplit(':', 1)[0])
+            if router_metrics is not None:
+                router_metrics.coalesced(held.msgs, suppressed)
+
+    def __len__(self):
+        """ Number of prefixes held """
+        return self._held
+
+    def stats(self):
+        return "%d messages held, %d forwarded for them, %d suppressed, %d prefixes held, %d overflows" % (
+            self.coalesced, self.forwarded, self.suppressed, self._held, self.overflows)
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+""" Decoder processes
+
+  Decoding BMP and BGP in the listener limits the proxy to one core however
+  many routers are sending.  With decoders configured the listener only
+  frames the messages and hands each to one of a pool of decoder processes,
+  chosen by a hash of the router, over a ring buffer of the decoder's own.
+  Every message of a router goes to the same decoder, which decodes them in
+  the order received, keeps the Adj-RIB-In of its peers and forwards the
+  messages on to the senders.  The messages are not spread by peer: each
+  decoder forwards on its own schedule, and a router's Initiation and
+  Termination have to reach the collector before and after the messages of
+  all its peers.
+"""
+import logging
+import multiprocessing
+import struct
+import time
+
+from bgpparse import Attribute_cache
+from bmpparse import (BMP_message, BMP_Route_Monitoring, BMP_Statistics_Report,
+                      BMP_Peer_Down_Notification)
+from logger import init_mp_logger, flush_mp_logger
+from rib import RIB_store
+from coalesce import Coalescer
+from budget import Budgeted_queue
+from scheduler import Scheduler
+
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty
+
+# record kinds on a decoder's input ring
+MESSAGE = 0
+ROUTER_DOWN = 1
+
+# kind, length of the router name that follows
+_record_header = struct.Struct('!BB')
+
+# seconds to wait for input before checking for a stop request
+POLL_INTERVAL = 0.2
+SCHEDULED_POLL_INTERVAL = 0.001
+
+
+def encode_record(kind, router, raw_msg=b''):
+    """ Input ring record carrying a message, or news of a router, to a decoder """
+    name = router.encode('ascii')
+    return _record_header.pack(kind, len(name)) + name + raw_msg
+
+
+def decode_record(record):
+    """ :return: (kind, router, raw message) """
+    (kind, name_length) = _record_header.unpack_from(record)
+    start = _record_header.size + name_length
+    return (kind, record[_record_header.size:start].decode('ascii'), record[start:])
+
+
+class Decoder(multiprocessing.Process):
+    """ BMP decoder
+
+        Decodes the messages of the routers sharded onto it, every message of a router
+        going to the same decoder, and forwards them to the senders.
+    """
+
+    def __init__(self, cfg, index, input_queue, forward_queue, log_queue, replay_server=None, metrics=None):
+        """ Constructor
+
+            :param cfg:             Configuration dictionary
+            :param index:           Decoder number, from 0
+            :param input_queue:     RingBuffer the listener writes this decoder's records to
+            :param forward_queue:   Output for BMP raw message forwarding
+            :param log_queue:       Logging queue - sync logging
+            :param replay_server:   replay.Replay_server for RIB dumps of this decoder's peers
+            :param metrics:         metrics.Metrics to count parse errors in, or None
+        """
+        multiprocessing.Process.__init__(self)
+        self._stop = multiprocessing.Event()
+
+        self._cfg = cfg
+        self._index = index
+        self._input_queue = input_queue
+        self._fwd_queue = forward_queue
+        self._log_queue = log_queue
+        self._replay_server = replay_server
+        self._metrics = metrics
+        self.LOG = None
+
+        self._attribute_cache = None
+        self._rib = None
+        self._coalescer = None
+        # both have pump(), stats() and close(), the scheduler takes the router with each message
+        self._budgeted = isinstance(forward_queue, (Budgeted_queue, Scheduler))
+        self._scheduled = isinstance(forward_queue, Scheduler)
+        self._msgs = 0
+        self._debug = False
+
+    def run(self):
+        """ Override """
+        self.LOG = init_mp_logger("decoder.%d" % self._index, self._log_queue, self._cfg.get('log_pipeline'))
+        self._debug = self.LOG.isEnabledFor(logging.DEBUG)
+        self.LOG.info("Running decoder")
+
+        listener_cfg = self._cfg['listener']
+        cache_size = listener_cfg.get('attribute_cache', 10000)
+        if cache_size > 0:
+            self._attribute_cache = Attribute_cache(cache_size)
+        if listener_cfg.get('rib', False):
+            self._rib = RIB_store(listener_cfg.get('rib_max_routes', 4000000) // listener_cfg['decoders'])
+        if listener_cfg.get('coalesce_window', 0) > 0:
+            self._coalescer = Coalescer(listener_cfg['coalesce_window'] / 1000.0,
+                                        listener_cfg.get('coalesce_max_prefixes', 100000) // listener_cfg['decoders'],
+                                        self._metrics)
+
+        try:
+            while not self.stopped():
+                if self._scheduled and self._fwd_queue.over():
+                    # a router has too much scheduled; its records cannot be told from the
+                    # others' on the input ring, so no input is taken until it is back under
+                    time.sleep(SCHEDULED_POLL_INTERVAL)
+                    self.pump_queue()
+                    continue
+                try:
+                    record = self._input_queue.get(True, self.poll_interval())
+                except Empty:
+                    self.serve_replay()
+                    self.flush_coalesced()
+                    self.pump_queue()
+                    continue
+
+                (kind, router, raw_msg) = decode_record(record)
+                if kind == MESSAGE:
+                    try:
+                        self.process_msg(router, raw_msg)
+                    except (AssertionError, struct.error) as e:
+                        self.parse_error(router, e)
+                    except ValueError as e:
+                        # larger than the forward ring
+                        self.LOG.error("cannot forward message from %s: %s", router, e)
+                elif kind == ROUTER_DOWN:
+                    self.router_down(router)
+                self.serve_replay()
+                self.flush_coalesced()
+                self.pump_queue()
+
+        except KeyboardInterrupt:
+            pass
+
+        if self._coalescer is not None:
+            self.forward(self._coalescer.flush_all())
+
+        if self._budgeted:
+            self.LOG.info("forward queue: %s", self._fwd_queue.stats())
+            self._fwd_queue.close()
+
+        self.LOG.info("decoder stopped after %d messages", self._msgs)
+        flush_mp_logger()
+
+    def process_msg(self, router, raw_msg):
+        """ Decode and forward a message
+
+            :param router:      Name of the router it was received from
+            :param raw_msg:     Complete BMP message
+        """
+        bmpmsg = BMP_message(raw_msg, self._attribute_cache)
+        self._msgs += 1
+        if bmpmsg.msg_type == BMP_Statistics_Report:
+            if self._debug:
+                self.LOG.debug("-- BMP stats report rcvd, length %d", bmpmsg.length)
+        elif bmpmsg.msg_type == BMP_Route_Monitoring:
+            bgpmsg = bmpmsg.bmp_RM_bgp_message
+            if self._rib is not None:
+                self._rib.update(router, bmpmsg)
+        else:
+            if bmpmsg.msg_type == BMP_Peer_Down_Notification and self._rib is not None:
+                self._rib.peer_down(router, bmpmsg.bmp_ppc_fixed_hash)
+            if self._debug:
+                self.LOG.debug("-- BMP non RM rcvd, BmP msg type was %d, length %d", bmpmsg.msg_type, bmpmsg.length)
+        if self._coalescer is not None:
+            self.forward(self._coalescer.add(router, bmpmsg, raw_msg, time.time()))
+        else:
+            self.put(raw_msg, router)
+
+    def parse_error(self, router, e):
+        self.LOG.error("cannot parse message from %s: %r", router, e)
+        if self._metrics is not None:
+            router_metrics = self._metrics.router(router.rsplit(':', 1)[0])
+            if router_metrics is not None:
+                router_metrics.parse_error()
+
+    def router_down(self, router):
+        if self._rib is not None:
+            self._rib.router_down(router)
+            self.LOG.info("router %s disconnected, Adj-RIB-In: %s", router, self._rib.stats())
+        if self._attribute_cache is not None:
+            self.LOG.info("attribute cache: %s", self._attribute_cache.stats())
+        if self._coalescer is not None:
+            self.forward(self._coalescer.flush_router(router))
+            self.LOG.info("coalescing: %s", self._coalescer.stats())
+
+    def flush_coalesced(self):
+        """ Forward the updates whose coalescing window has closed """
+        if self._coalescer is not None:
+            self.forward(self._coalescer.expired(time.time()))
+
+    def put(self, raw_msg, router):
+        """ Put a message to the forward queue
+
+            :param raw_msg:     Complete BMP message
+            :param router:      Name of the router it was received from
+        """
+        if self._scheduled:
+            self._fwd_queue.put(raw_msg, router)
+        else:
+            self._fwd_queue.put(raw_msg)
+
+    def forward(self, msgs):
+        """ Put the messages returned by the coalescer to the forward queue
+
+            :param msgs:    List of (router, raw message)
+        """
+        for (router, msg) in msgs:
+            self.put(msg, router)
+
+    def poll_interval(self):
+        """ Seconds to wait for input, shorter while the scheduler holds messages """
+        if self._scheduled and len(self._fwd_queue):
+            return SCHEDULED_POLL_INTERVAL
+        return POLL_INTERVAL
+
+    def pump_queue(self):
+        """ Move messages spilled while the forward queue was over its byte budget back into it """
+        if self._budgeted:
+            self._fwd_queue.pump()
+
+    def serve_replay(self):
+        """ Pass the RIB dumps asked for by the senders on to them, a chunk at a time """
+        if self._replay_server is not None and self._rib is not None:
+            self._replay_server.serve(self._rib)
+
+    def stop(self):
+        self._stop.set()
+
+    def stopped(self):
+        return self._stop.is_set()
+
+
+def shard(router, decoders):
+    """ Decoder the messages of a router are to be handled by
+
+        :return: decoder index
+    """
+    return hash(router) % decoders
@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+""" Message filtering and rewriting
+
+  The 'filters' section of the configuration is a list of rules, each
+  matching messages by type, peer AS and peer address and then dropping,
+  accepting or rewriting them.  The rules are compiled once at startup into
+  tests on the raw bytes of the common and per-peer headers, the fields
+  BMP_message decodes, so the listener classifies a message before, and
+  instead of, decoding it:
+
+    - the rules that can match each message type are found in advance, so a
+      message of a type no rule is about costs one list lookup
+    - peer ASes and host addresses are looked up in sets of their packed
+      bytes, prefixes compared as integers under their mask
+    - a rewrite patches fields of fixed size in place, so the message keeps
+      its length and is not encoded again
+
+  Rules are tried in order.  The first drop or accept rule that matches
+  decides, a rewrite rule that matches changes the message and lets the
+  following rules see the result.  Messages no rule decides are forwarded.
+
+  Each rule counts its hits in an anonymous shared mmap created before the
+  listener processes are forked, a row of counters per listener so that no
+  lock is needed.
+"""
+import ctypes
+import mmap
+import socket
+import struct
+
+from bmpparse import BMP_Initiation_Message, BMP_Termination_Message, BMP_Peer_Flag_IPv6
+from metrics import BMP_TYPE_NAMES
+
+ACTION_DROP = 'drop'
+ACTION_ACCEPT = 'accept'
+ACTION_REWRITE = 'rewrite'
+ACTIONS = (ACTION_DROP, ACTION_ACCEPT, ACTION_REWRITE)
+
+# offsets of the per-peer header fields in a message (bmpparse.BMP_message.parse_per_peer_header)
+_PEER_FLAGS = 7
+_PEER_DISTINGUISHER = 8
+_PEER_ADDRESS = 16
+_PEER_IPV4_ADDRESS = 28     # an IPv4 address is in the last 4 bytes of the address field
+_PEER_AS = 32
+_PEER_BGP_ID = 36
+_TIMESTAMP = 40
+_PER_PEER_END = 48
+
+# fields a rewrite rule may set or strip (set to zero): offset, size
+_FIELDS = {
+    'peer_distinguisher': (_PEER_DISTINGUISHER, 8),
+    'peer_as': (_PEER_AS, 4),
+    'peer_bgp_id': (_PEER_BGP_ID, 4),
+    'timestamp': (_TIMESTAMP, 8),
+}
+
+# keys of a rule: its conditions, then the rest
+_MATCHES = ('type', 'peer_as', 'peer_address')
+_KEYS = _MATCHES + ('name', 'action', 'set', 'strip')
+
+# message types carrying a per-peer header
+_PER_PEER_TYPES = tuple(t for t in range(len(BMP_TYPE_NAMES))
+                        if t not in (BMP_Initiation_Message, BMP_Termination_Message))
+
+_ipv6 = struct.Struct('!QQ')
+_ipv4 = struct.Struct('!I')
+
+
+class _Rule(object):
+    """ A compiled rule """
+
+    __slots__ = ('name', 'types', 'tests', 'action', 'patches')
+
+    def __init__(self, name, types, tests, action, patches):
+        self.name = name
+        self.types = types          # message types it can match
+        self.tests = tests          # functions of the message, all of which must hold
+        self.action = action
+        self.patches = patches      # (offset, bytes) written by a rewrite
+
+
+def _as_list(value):
+    return value if isinstance(value, list) else [value]
+
+
+def _compile_types(name, values):
+    types = set()
+    for value in _as_list(values):
+        if value in BMP_TYPE_NAMES:
+            types.add(BMP_TYPE_NAMES.index(value))
+        elif isinstance(value, int) and 0 <= value < len(BMP_TYPE_NAMES):
+            types.add(value)
+        else:
+            raise ValueError("rule %s: unknown message type %r, must be one of %s" %
+                             (name, value, ", ".join(BMP_TYPE_NAMES)))
+    return types
+
+
+def _compile_peer_as(name, values):
+    try:
+        packed = frozenset(_ipv4.pack(asn) for asn in _as_list(values))
+    except struct.error:
+        raise ValueError("rule %s: peer_as must be a list of AS numbers" % name)
+
+    def test(msg):
+        return msg[_PEER_AS:_PEER_AS + 4] in packed
+    return test
+
+
+def _parse_prefix(name, value):
+    """ (family, network, mask, packed address) of an address or prefix, network and mask as integers """
+    (address, _, length) = str(value).partition('/')
+    family = socket.AF_INET6 if ':' in address else socket.AF_INET
+    bits = 128 if family == socket.AF_INET6 else 32
+    try:
+        packed = socket.inet_pton(family, address)
+        length = int(length) if length else bits
+    except (socket.error, ValueError):
+        raise ValueError("rule %s: bad peer address %r" % (name, value))
+    if not 0 <= length <= bits:
+        raise ValueError("rule %s: bad prefix length in %r" % (name, value))
+    if family == socket.AF_INET6:
+        (high, low) = _ipv6.unpack(packed)
+        network = (high << 64) | low
+    else:
+        network = _ipv4.unpack(packed)[0]
+    mask = ((1 << length) - 1) << (bits - length)
+    return (family, network & mask, mask, packed)
+
+
+def _compile_peer_address(name, values):
+    # hosts are looked up by their bytes, prefixes compared under their mask
+    hosts = {socket.AF_INET: set(), socket.AF_INET6: set()}
+    prefixes = {socket.AF_INET: [], socket.AF_INET6: []}
+    for value in _as_list(values):
+        (family, network, mask, packed) = _parse_prefix(name, value)
+        if mask == (1 << (128 if family == socket.AF_INET6 else 32)) - 1:
+            hosts[family].add(packed)
+        else:
+            prefixes[family].append((network, mask))
+    (hosts4, hosts6) = (frozenset(hosts[socket.AF_INET]), frozenset(hosts[socket.AF_INET6]))
+    (prefixes4, prefixes6) = (tuple(prefixes[socket.AF_INET]), tuple(prefixes[socket.AF_INET6]))
+
+    def test(msg):
+        if ord(msg[_PEER_FLAGS:_PEER_FLAGS + 1]) & BMP_Peer_Flag_IPv6:
+            packed = msg[_PEER_ADDRESS:_PEER_ADDRESS + 16]
+            if packed in hosts6:
+                return True
+            if prefixes6:
+                (high, low) = _ipv6.unpack(packed)
+                address = (high << 64) | low
+                for (network, mask) in prefixes6:
+                    if address & mask == network:
+                        return True
+        else:
+            packed = msg[_PEER_IPV4_ADDRESS:_PEER_IPV4_ADDRESS + 4]
+            if packed in hosts4:
+                return True
+            if prefixes4:
+                address = _ipv4.unpack(packed)[0]
+                for (network, mask) in prefixes4:
+                    if address & mask == network:
+                        return True
+        return False
+    return test
+
+
+def _compile_patches(name, rule):
+    patches = []
+    for field in _as_list(rule.get('strip') or []):
+        if field not in _FIELDS:
+            raise ValueError("rule %s: cannot strip %r, only %s" % (name, field, ", ".join(sorted(_FIELDS))))
+        (offset, size) = _FIELDS[field]
+        patches.append((offset, b'\0' * size))
+
+    for (field, value) in sorted((rule.get('set') or {}).items()):
+        if field not in _FIELDS or field == 'timestamp':
+            raise ValueError("rule %s: cannot set %r, only %s" %
+                             (name, field, ", ".join(sorted(f for f in _FIELDS if f != 'timestamp'))))
+        try:
+            if field == 'peer_bgp_id' and isinstance(value, str):
+                packed = socket.inet_pton(socket.AF_INET, str(value))
+            elif field == 'peer_distinguisher':
+                packed = struct.pack('!Q', value)
+            else:
+                packed = _ipv4.pack(value)
+        except (socket.error, struct.error, TypeError):
+            raise ValueError("rule %s: bad value %r for %s" % (name, value, field))
+        patches.append((_FIELDS[field][0], packed))
+
+    if not patches:
+        raise ValueError("rule %s: a rewrite needs 'set' or 'strip'" % name)
+    return tuple(patches)
+
+
+def compile_rules(rules):
+    """ Compile the rules of the configuration's 'filters' section
+
+        :param rules:   List of dictionaries, each with an optional name, the conditions
+                        type, peer_as and peer_address, an action, and for a rewrite
+                        the fields to set and to strip
+
+        :return: List of compiled rules, for Rule_set
+
+        :raises ValueError: a rule is not valid
+    """
+    if not isinstance(rules, list):
+        raise ValueError("must be a list of rules")
+
+    compiled = []
+    for (i, rule) in enumerate(rules):
+        if not isinstance(rule, dict):
+            raise ValueError("rule %d is not a dictionary" % i)
+        name = "%s" % rule.get('name', i)
+        unknown = sorted(key for key in rule if key not in _KEYS)
+        if unknown:
+            # a misspelt condition would otherwise match every message
+            raise ValueError("rule %s: unknown %s, a rule has %s" % (name, ", ".join(unknown), ", ".join(_KEYS)))
+        action = rule.get('action')
+        if action not in ACTIONS:
+            raise ValueError("rule %s: action must be one of %s" % (name, ", ".join(ACTIONS)))
+
+        types = set(range(len(BMP_TYPE_NAMES)))
+        if 'type' in rule:
+            types = _compile_types(name, rule['type'])
+        tests = []
+        if 'peer_as' in rule:
+            tests.append(_compile_peer_as(name, rule['peer_as']))
+        if 'peer_address' in rule:
+            tests.append(_compile_peer_address(name, rule['peer_address']))
+
+        patches = ()
+        if action == ACTION_REWRITE:
+            patches = _compile_patches(name, rule)
+        if tests or patches:
+            # only messages with a per-peer header have the fields
+            types &= set(_PER_PEER_TYPES)
+            if not types:
+                raise ValueError("rule %s: no message of its types has a per-peer header" % name)
+
+        compiled.append(_Rule(name, frozenset(types), tuple(tests), action, patches))
+    return compiled
+
+
+class Rule_set(object):
+    """ The compiled rules, and the hit counters of every listener """
+
+    def __init__(self, rules, processes):
+        """ Constructor
+
+            :param rules:       Rules returned by compile_rules()
+            :param processes:   Number of listener processes applying them
+        """
+        self.rules = rules
+        self._processes = processes
+        words = max(len(rules) * processes, 1)
+        self._mm = mmap.mmap(-1, words * 8, flags=mmap.MAP_SHARED)
+        self._words = (ctypes.c_uint64 * words).from_buffer(self._mm)
+
+    def filter(self, index):
+        """ The filter applied by one listener process
+
+            :param index:   Listener number, from 0
+
+            :return: Message_filter
+        """
+        return Message_filter(self, index)
+
+    def hits(self, rule):
+        """ Messages a rule has matched in all the listeners """
+        w = self._words
+        count = len(self.rules)
+        return sum(w[i * count + rule] for i in range(self._processes))
+
+    def counters(self):
+        """ The hits of every rule, as Metrics.render() counters """
+        return [("bmp_proxy_filter_hits_total", "Messages matched by a filter rule",
+                 {'rule': rule.name, 'action': rule.action}, lambda i=i: self.hits(i))
+                for (i, rule) in enumerate(self.rules)]
+
+
+class Message_filter(object):
+    """ Applies the rules in one listener process """
+
+    def __init__(self, rule_set, index):
+        self._words = rule_set._words
+        self._base = index * len(rule_set.rules)
+        self._names = [rule.name for rule in rule_set.rules]
+
+        # (counter word, rule) of the rules that can match each message type
+        self._by_type = [[] for t in range(256)]
+        for (i, rule) in enumerate(rule_set.rules):
+            for t in rule.types:
+                self._by_type[t].append((self._base + i, rule))
+
+        self.dropped = 0
+        self.rewritten = 0
+
+    def apply(self, raw_msg):
+        """ Run a message through the rules
+
+            :param raw_msg:     Complete BMP message
+
+            :return: The message to forward, rewritten if a rule says so, or None to drop it
+        """
+        msg_type = ord(raw_msg[5:6])
+        rules = self._by_type[msg_type]
+        if not rules:
+            return raw_msg
+        if len(raw_msg) < _PER_PEER_END and msg_type in _PER_PEER_TYPES:
+            # too short for its per-peer header, left for the parser to report
+            return raw_msg
+
+        for (word, rule) in rules:
+            for test in rule.tests:
+                if not test(raw_msg):
+                    break
+            else:
+                self._words[word] += 1
+                if rule.action == ACTION_DROP:
+                    self.dropped += 1
+                    return None
+                if rule.action == ACTION_ACCEPT:
+                    return raw_msg
+                msg = bytearray(raw_msg)
+                for (offset, value) in rule.patches:
+                    msg[offset:offset + len(value)] = value
+                raw_msg = bytes(msg)
+                self.rewritten += 1
+        return raw_msg
+
+    def __len__(self):
+        """ Number of rules """
+        return len(self._names)
+
+    def stats(self):
+        w = self._words
+        return "%d dropped, %d rewritten, rule hits: %s" % (
+            self.dropped, self.rewritten,
+            ", ".join("%s %d hits" % (name, w[self._base + i]) for (i, name) in enumerate(self._names)))
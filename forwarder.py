@@ -9,10 +9,163 @@
   .. moduleauthor:: Tim Evens <tievens@cisco.com>
 """
 import socket
+import select
+import errno
+import os
+import random
+import logging
 import multiprocessing
 
-from time import sleep
-from logger import init_mp_logger
+from time import sleep, time
+from logger import init_mp_logger, flush_mp_logger
+from spool import Spool
+from replay import END_OF_DUMP
+from transport import Compressor, TRANSPORT_ZLIB
+
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty
+
+# Most iovecs the kernel accepts in one sendmsg() call
+IOV_MAX = 1024
+
+# Reconnect backoff of a collector endpoint: doubles from the minimum after each
+# failure up to the maximum, and a random part of it is taken off (milliseconds)
+RECONNECT_MIN = 100
+RECONNECT_MAX = 10000
+
+# Milliseconds to wait for a collector endpoint to accept a connection
+CONNECT_TIMEOUT = 1000
+
+# Milliseconds sent data may stay unacknowledged before the connection is failed,
+# where the platform supports it (TCP_USER_TIMEOUT)
+USER_TIMEOUT = 5000
+
+# Milliseconds between health checks of the connection, and attempts to fail back
+# to an endpoint of higher priority
+HEALTH_INTERVAL = 1000
+
+# Messages sent from, or moved to, the spool at a time while replaying
+REPLAY_MESSAGES = 1000
+
+# Seconds to wait for RIB dump messages when there is no live traffic
+REPLAY_WAIT = 0.1
+
+# Batching defaults of the compressed transport, each batch is compressed as a frame
+COMPRESSED_BATCH_MESSAGES = 1000
+COMPRESSED_BATCH_LINGER = 10000     # microseconds
+
+
+class Endpoint(object):
+    """ One address of a collector, and when it may next be tried """
+
+    def __init__(self, host, port, min_backoff, max_backoff):
+        """ Constructor
+
+            :param host:            Host name or address
+            :param port:            Port
+            :param min_backoff:     Seconds before the first retry after a failure
+            :param max_backoff:     Most seconds between retries
+        """
+        self.host = host
+        self.port = port
+        self._min_backoff = min_backoff
+        self._max_backoff = max_backoff
+        self.failures = 0
+        self.next_attempt = 0.0
+
+    def name(self):
+        return "%s:%d" % (self.host, self.port)
+
+    def due(self, now):
+        return now >= self.next_attempt
+
+    def failed(self, now):
+        """ Back off from the endpoint, exponentially with jitter so that proxies do not retry in step """
+        backoff = min(self._min_backoff * (2 ** min(self.failures, 20)), self._max_backoff)
+        self.failures += 1
+        self.next_attempt = now + random.uniform(backoff / 2, backoff)
+
+    def succeeded(self):
+        self.failures = 0
+        self.next_attempt = 0.0
+
+
+def open_connection(endpoint, timeout, user_timeout=None):
+    """ Connect to an endpoint without waiting longer than timeout for it to accept
+
+        :param endpoint:        Endpoint
+        :param timeout:         Seconds to wait
+        :param user_timeout:    Seconds sent data may stay unacknowledged before the
+                                kernel fails the connection, or None
+
+        :return: connected blocking socket
+
+        :raises socket.error: if it could not connect
+    """
+    (sock, connected) = start_connection(endpoint)
+    try:
+        if not connected and not connection_ready(sock, timeout):
+            raise socket.timeout("connect timed out after %d ms" % (timeout * 1000))
+        return finish_connection(sock, user_timeout)
+
+    except socket.error:
+        sock.close()
+        raise
+
+
+def start_connection(endpoint):
+    """ Start connecting to an endpoint without waiting for it to accept
+
+        :param endpoint:        Endpoint
+
+        :return: (non-blocking socket, True if it is connected already)
+
+        :raises socket.error: if the connection was refused at once
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    err = sock.connect_ex((endpoint.host, endpoint.port))
+    if err in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+        return (sock, False)
+    if err:
+        sock.close()
+        raise socket.error(err, os.strerror(err))
+    return (sock, True)
+
+
+def connection_ready(sock, timeout=0):
+    """ Wait up to timeout seconds for a connection started by start_connection()
+
+        :return: True once it is connected, False while it is still under way
+
+        :raises socket.error: if it failed
+    """
+    poller = select.poll()
+    poller.register(sock.fileno(), select.POLLOUT)
+    if not poller.poll(int(timeout * 1000)):
+        return False
+    err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+    if err:
+        raise socket.error(err, os.strerror(err))
+    return True
+
+
+def finish_connection(sock, user_timeout=None):
+    """ Make a socket connected by start_connection() ready to send on
+
+        :param sock:            Connected socket
+        :param user_timeout:    Seconds sent data may stay unacknowledged before the
+                                kernel fails the connection, or None
+
+        :return: the socket, blocking
+    """
+    sock.setblocking(True)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if user_timeout and hasattr(socket, 'TCP_USER_TIMEOUT'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, int(user_timeout * 1000))
+    return sock
 
 
 class Sender(multiprocessing.Process):
@@ -21,12 +174,19 @@ class Sender(multiprocessing.Process):
         Pops messages from forwarder queue and transmits them to remote bmp collector.
     """
 
-    def __init__(self, cfg, forward_queue, log_queue):
+    def __init__(self, cfg, forward_queue, log_queue, index=0,
+                 state_table=None, replay_requests=None, replay_queue=None, metrics=None):
         """ Constructor
 
             :param cfg:             Configuration dictionary
             :param forward_queue:   Output for BMP raw message forwarding
             :param log_queue:       Logging queue - sync logging
+            :param index:           Position of this sender's collector in the collectors list
+            :param state_table:     replay.State_table replayed on connecting, or None
+            :param replay_requests: Queue to ask the listener for a RIB dump on, or a list of
+                                    them, one per decoder process, or None
+            :param replay_queue:    Queue the RIB dump is returned on
+            :param metrics:         metrics.Metrics to count in, or None
         """
         multiprocessing.Process.__init__(self)
         self._stop = multiprocessing.Event()
@@ -34,17 +194,87 @@ class Sender(multiprocessing.Process):
         self._cfg = cfg
         self._fwd_queue = forward_queue
         self._log_queue = log_queue
+        self._index = index
         self.LOG = None
+        self._debug = False
         self._isConnected = False
 
+        self._collector = cfg['collectors'][index]
+        self._msgs_sent = 0
+        self._bytes_sent = 0
+        self._dropped = 0
+
         self._sock = None
 
+        # Endpoints of the collector in priority order, the first being its host and port
+        # unless an 'endpoints' list is given, and the one connected to
+        self._endpoints = [Endpoint(endpoint['host'], endpoint.get('port', 5000),
+                                    self._collector.get('reconnect_min', RECONNECT_MIN) / 1000.0,
+                                    self._collector.get('reconnect_max', RECONNECT_MAX) / 1000.0)
+                           for endpoint in self._collector.get('endpoints') or [self._collector]]
+        self._active = None
+        self._connect_timeout = self._collector.get('connect_timeout', CONNECT_TIMEOUT) / 1000.0
+        self._user_timeout = self._collector.get('user_timeout', USER_TIMEOUT) / 1000.0
+        self._health_interval = self._collector.get('health_interval', HEALTH_INTERVAL) / 1000.0
+        self._failback = self._collector.get('failback', True)
+        self._next_check = 0
+        self._failovers = 0
+        self._failback_connection = None    # (endpoint index, socket, deadline) being connected to
+
+        # Compressed transport to another proxy, a new compression stream per connection
+        self._compressed = self._collector.get('transport') == TRANSPORT_ZLIB
+        self._compression_level = self._collector.get('compression_level', 6)
+        self._compressor = None
+        self._wire_bytes = 0
+
+        # Batching, disabled unless batch_messages is greater than 1
+        self._batch_messages = self._collector.get('batch_messages',
+                                                   COMPRESSED_BATCH_MESSAGES if self._compressed else 1)
+        self._batch_bytes = self._collector.get('batch_bytes', 1024 * 1024)
+        self._batch_linger = self._collector.get('batch_linger',
+                                                 COMPRESSED_BATCH_LINGER if self._compressed else 0) / 1000000.0
+
+        # Disk spool, opened by the sender process
+        self._spool = None
+        self._spool_dropped = 0
+
+        # Initial state replay
+        self._state_table = state_table
+        if replay_requests is not None and not isinstance(replay_requests, list):
+            replay_requests = [replay_requests]
+        self._replay_requests = replay_requests
+        self._replay_queue = replay_queue
+        self._replay_rate = self._collector.get('replay_rate', 5000)
+        self._replaying = 0         # RIB dumps still to finish
+        # generation of the latest dump requested, counted from the time in milliseconds so that
+        # a replacement process does not take up a generation of the sender it replaces
+        self._replay_generation = int(time() * 1000)
+        self._replay_credit = 0.0
+        self._replay_time = 0
+
+        # Metrics, and the times the messages being sent entered the forward queue
+        self._metrics = metrics.collector(index) if metrics is not None else None
+        self._ingress = []
+
     def run(self):
         """ Override """
-        self.LOG = init_mp_logger("sender", self._log_queue)
-
-        self.LOG.info("Running sender")
-
+        self.LOG = init_mp_logger("sender.%d" % self._index, self._log_queue, self._cfg.get('log_pipeline'))
+        self._debug = self.LOG.isEnabledFor(logging.DEBUG)
+
+        self.LOG.info("Running sender for %s:%d", self._collector['host'], self._collector['port'])
+
+        if 'spool' in self._collector:
+            spool_cfg = self._collector['spool']
+            self._spool = Spool(spool_cfg['directory'],
+                                spool_cfg.get('segment_size', 64 * 1024 * 1024),
+                                spool_cfg.get('max_size', 1024 * 1024 * 1024),
+                                spool_cfg.get('eviction', 'oldest'))
+            self.LOG.info("Spooling to %s, %d messages held from an earlier run",
+                          spool_cfg['directory'], len(self._spool))
+
+        if len(self._endpoints) > 1:
+            self.LOG.info("Collector endpoints in priority order: %s",
+                          ", ".join(endpoint.name() for endpoint in self._endpoints))
         self.connect()
 
         try:
@@ -56,62 +286,521 @@ class Sender(multiprocessing.Process):
             # Read queue
             while not self.stopped():
 
+                if time() >= self._next_check:
+                    self.health_check()
+
                 # Do not pop any message unless connected
                 if self._isConnected:
-                    msg = self._fwd_queue.get()
-
-                    sent = False
-                    while not sent:
-                        sent = self.send(msg.BMP_MSG)
-
-                    self.LOG.debug("Received bmp message: %s %s %s", msg.COLLECTOR_ADMIN_ID,
-                                   msg.ROUTER_IP, msg.ROUTER_NAME)
+                    if self._spool is not None and not self._spool.empty():
+                        self.replay_spool()
+
+                    elif self._replaying and self._fwd_queue.empty():
+                        self.replay_rib(REPLAY_WAIT)
+
+                    elif self._batch_messages > 1:
+                        msgs = self.get_batch()
+
+                        # messages not sent when no endpoint is up are sent once one is,
+                        # or spooled
+                        sent = self.send_batch(msgs)
+                        while sent < len(msgs) and self._spool is None and not self.stopped():
+                            self.reconnect()
+                            sent += self.send_batch(msgs[sent:])
+
+                        if sent:
+                            self.count_sent(msgs[:sent], True)
+                            if self._debug:
+                                self.LOG.debug("Forwarded %d bmp messages", sent)
+                        if sent < len(msgs) and self._spool is not None:
+                            self.spool_messages(msgs[sent:])
+                        self._ingress = []
+
+                    else:
+                        try:
+                            msg = self._fwd_queue.get(True, self._health_interval)
+                        except Empty:
+                            continue
+                        self.note_ingress()
+
+                        sent = self.send(msg)
+                        while not sent and self._spool is None and not self.stopped():
+                            self.reconnect()
+                            sent = self.send(msg)
+
+                        if sent:
+                            self.count_sent([msg], True)
+                            if self._debug:
+                                self.LOG.debug("Forwarded bmp message, length %d", len(msg))
+                        elif self._spool is not None:
+                            self.spool_messages([msg])
+                        self._ingress = []
+
+                    self.check_dropped()
+                    if self._replaying:
+                        self.replay_rib()
                 else:
-                    self.LOG.info("Not connected, attempting to reconnect")
-                    sleep(10)
-                    self.connect()
+                    if self._spool is not None:
+                        self.spool_queued(self.next_attempt())
+                        self.connect()
+                    else:
+                        self.reconnect()
 
         except KeyboardInterrupt:
             pass
 
-        self.LOG.info("rewrite stopped")
+        if self._spool is not None:
+            self.LOG.info("%d messages left in the spool", len(self._spool))
+            self._spool.close()
+
+        self.LOG.info("sender stopped after %d messages, %d bytes, %d dropped, %d failovers",
+                      self._msgs_sent, self._bytes_sent, self._dropped + self._spool_dropped, self._failovers)
+        if self._compressed:
+            self.LOG.info("compressed transport sent %d bytes", self._wire_bytes)
+        flush_mp_logger()
+
+    def connect(self, endpoints=None):
+        """ Connect to the first collector endpoint, in priority order, that accepts
+
+        :param endpoints:   Number of endpoints from the first to try, all by default.
+                            Those backing off from a failure are skipped.
+
+        :return: True if connected, False otherwise/error
+        """
+        now = time()
+        for (i, endpoint) in enumerate(self._endpoints[:endpoints]):
+            if endpoint.due(now) and self.open(i):
+                return True
+        return self._isConnected
+
+    def open(self, index, sock=None):
+        """ Connect to an endpoint and replay the state to it, replacing any connection
+            to another endpoint once it has
 
-    def connect(self):
-        """ Connect to remote collector
+        :param index:   Position of the endpoint in the endpoints list
+        :param sock:    Socket already connected to it, or None to connect
 
         :return: True if connected, False otherwise/error
         """
+        endpoint = self._endpoints[index]
         try:
-            self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self._sock.connect((self._cfg['collector']['host'], self._cfg['collector']['port']))
-            self._isConnected = True
-            self.LOG.info("Connected to remote collector: %s:%d", self._cfg['collector']['host'],
-                          self._cfg['collector']['port'])
+            if sock is None:
+                sock = open_connection(endpoint, self._connect_timeout, self._user_timeout)
+            previous = self._sock
+            compressor = self._compressor
+            self._sock = sock
+            if self._compressed:
+                self._compressor = Compressor(self._compression_level)
+
+            try:
+                self.replay_state()
+            except socket.error:
+                self._sock = previous
+                self._compressor = compressor
+                raise
 
         except socket.error as msg:
-            self.LOG.error("Failed to connect to remote collector: %r", msg)
-            self._isConnected = False
+            if sock is not None:
+                sock.close()
+            endpoint.failed(time())
+            self.LOG.error("Failed to connect to remote collector %s: %r", endpoint.name(), msg)
+            return False
+
+        if previous is not None:
+            previous.close()
+        endpoint.succeeded()
+        self._active = index
+        self._isConnected = True
+        if self._metrics is not None:
+            self._metrics.connected(endpoint=index)
+        self.LOG.info("Connected to remote collector: %s", endpoint.name())
+        return True
+
+    def failover(self):
+        """ Drop the connection that failed and connect to the next endpoint that is up
+
+        :return: True if connected, False if no endpoint could be reached
+        """
+        self._endpoints[self._active].failed(time())
+        self.disconnect()
+        self._failovers += 1
+        if self._metrics is not None:
+            self._metrics.failover()
+        return self.connect()
+
+    def next_attempt(self):
+        """ Time of the next endpoint connection attempt """
+        return min(endpoint.next_attempt for endpoint in self._endpoints)
+
+    def reconnect(self):
+        """ Wait for an endpoint to be due another attempt, and try to connect """
+        if not self._isConnected:
+            sleep(max(min(self.next_attempt() - time(), self._health_interval), 0))
+            self.connect()
+
+    def health_check(self):
+        """ Fail over if the collector has closed the connection, and fail back to an
+            endpoint of higher priority once it accepts connections again
+
+            The connection to the endpoint failed back to is made without waiting for
+            it: it is started by one health check and taken up by a later one once it
+            has connected, so that sending is not held up by an endpoint that does
+            not answer.
+        """
+        now = time()
+        self._next_check = now + self._health_interval
+        if not self.check_alive():
+            return
+
+        if self._failback_connection is not None:
+            (index, sock, deadline) = self._failback_connection
+            try:
+                if not connection_ready(sock):
+                    if now < deadline:
+                        return
+                    raise socket.timeout("connect timed out after %d ms" % (self._connect_timeout * 1000))
+            except socket.error as msg:
+                self._failback_connection = None
+                sock.close()
+                self._endpoints[index].failed(now)
+                self.LOG.error("Failed to connect to remote collector %s: %r", self._endpoints[index].name(), msg)
+                return
+            self._failback_connection = None
+            self.fail_back(index, sock)
+
+        elif self._failback and self._active > 0:
+            for (index, endpoint) in enumerate(self._endpoints[:self._active]):
+                if endpoint.due(now):
+                    break
+            else:
+                return
+            try:
+                (sock, connected) = start_connection(endpoint)
+            except socket.error as msg:
+                endpoint.failed(now)
+                self.LOG.error("Failed to connect to remote collector %s: %r", endpoint.name(), msg)
+                return
+            if connected:
+                self.fail_back(index, sock)
+            else:
+                self._failback_connection = (index, sock, now + self._connect_timeout)
+
+    def fail_back(self, index, sock):
+        """ Move to an endpoint of higher priority, between sends so that nothing is in flight
+
+        :param index:   Position of the endpoint in the endpoints list
+        :param sock:    Socket connected to it
+        """
+        active = self._active
+        if self.open(index, finish_connection(sock, self._user_timeout)):
+            self.LOG.info("Failed back from remote collector %s", self._endpoints[active].name())
+
+    def check_alive(self):
+        """ Fail over if the collector has closed the connection
+
+            A collector sends nothing, so the socket is readable only once it has been
+            closed.  Checked before each send, so that messages are not written to a
+            connection the collector has already closed.
+
+            :return: True if connected
+        """
+        while self._isConnected:
+            try:
+                if self._sock.recv(4096, socket.MSG_DONTWAIT) != b'':
+                    continue
+                error = "connection closed"
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return True
+                error = repr(e)
+            self.LOG.error("Remote collector %s failed: %s", self._endpoints[self._active].name(), error)
+            self.failover()
+        return False
 
     def send(self, msg):
         """ Send BMP message to socket.
 
+            On a failure the message is sent whole to the next endpoint that is up.
+            Messages sent before it that the collector had not yet received are lost,
+            see send_batch().
+
             :param msg:     Message to send/write
 
             :return: True if sent, False if not sent
         """
-        sent = False
+        while self.check_alive():
+            try:
+                self._sock.sendall(self.frame(msg))
+                return True
+
+            except socket.error as e:
+                self.LOG.error("Failed to send message to collector %s: %r",
+                               self._endpoints[self._active].name(), e)
+                if self._metrics is not None:
+                    self._metrics.send_error()
+                self.failover()
+
+        return False
 
+    def frame(self, data):
+        """ Messages as they are sent: compressed into a frame with the compressed transport,
+            else unchanged
+
+            :param data:    One or more BMP messages
+        """
+        if self._compressor is None:
+            return data
+        before = self._compressor.bytes_out
+        data = self._compressor.frame(data)
+        self._wire_bytes += self._compressor.bytes_out - before
+        return data
+
+    def get_batch(self):
+        """ Pop the next message and any that follow within the batch limits
+
+            Waits for the first message (up to the health check interval, returning
+            no messages if none comes), then takes messages already queued until
+            batch_messages or batch_bytes is reached, waiting up to batch_linger
+            microseconds from the first message for more to arrive.
+
+            :return: List of messages
+        """
         try:
-            self._sock.sendall(msg)
-            sent = True
+            msg = self._fwd_queue.get(True, self._health_interval)
+        except Empty:
+            return []
+        self.note_ingress()
+        msgs = [msg]
+        size = len(msg)
+        deadline = time() + self._batch_linger
+
+        while len(msgs) < self._batch_messages and size < self._batch_bytes:
+            try:
+                msg = self._fwd_queue.get_nowait()
+
+            except Empty:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    break
+                try:
+                    msg = self._fwd_queue.get(True, remaining)
+                except Empty:
+                    break
 
-        except socket.error as msg:
-            self.LOG.error("Failed to send message to collector: %r", msg)
-            self.disconnect()
-            sleep(1)
-            self.connect()
+            self.note_ingress()
+            msgs.append(msg)
+            size += len(msg)
+
+        return msgs
+
+    def note_ingress(self):
+        """ Keep the time the message just taken entered the forward queue, where it is known """
+        if self._metrics is not None:
+            put_time = getattr(self._fwd_queue, 'put_time', None)
+            if put_time is not None:
+                self._ingress.append(put_time)
+
+    def count_sent(self, msgs, live=False):
+        """ Count messages sent
+
+            :param msgs:    List of messages
+            :param live:    True if they came straight from the forward queue, so that
+                            their latency is known
+        """
+        length = sum(len(msg) for msg in msgs)
+        self._msgs_sent += len(msgs)
+        self._bytes_sent += length
+
+        if self._metrics is not None:
+            self._metrics.sent(len(msgs), length)
+            if live:
+                now = time()
+                for put_time in self._ingress:
+                    self._metrics.latency(now - put_time)
+
+    def send_batch(self, msgs):
+        """ Send a batch of BMP messages to the socket, with one system call where possible.
 
-        return sent
+            On a failure the messages not completely written are sent to the next endpoint
+            that is up, after the state replay.  Those written already are not: the ones
+            still in the socket's send buffer when the collector dies or the path to it
+            goes dark are lost, as many as can be sent in user_timeout at most.
+
+            :param msgs:    List of messages to send/write
+
+            :return: Number of messages sent, from the first; fewer than all when
+                     no endpoint could be reached
+        """
+        if self._compressor is not None or not hasattr(socket.socket, 'sendmsg'):
+            return len(msgs) if self.send(b''.join(msgs)) else 0
+
+        buffers = [memoryview(msg) for msg in msgs]
+        first = 0
+        while first < len(buffers) and self.check_alive():
+            try:
+                written = self._sock.sendmsg(buffers[first:first + IOV_MAX])
+
+                # step over what was written, a message may have been sent in part
+                while written > 0:
+                    if written >= len(buffers[first]):
+                        written -= len(buffers[first])
+                        first += 1
+                    else:
+                        buffers[first] = buffers[first][written:]
+                        written = 0
+
+            except socket.error as e:
+                self.LOG.error("Failed to send messages to collector %s: %r",
+                               self._endpoints[self._active].name(), e)
+                if self._metrics is not None:
+                    self._metrics.send_error()
+                # a message sent in part is sent again whole
+                buffers[first] = memoryview(msgs[first])
+                self.failover()
+
+        return first
+
+    def spool_messages(self, msgs):
+        """ Append messages to the spool, reporting any it has to discard
+
+            :param msgs:    List of messages
+        """
+        for msg in msgs:
+            self._spool.append(msg)
+
+        if self._spool.dropped != self._spool_dropped:
+            self.LOG.warning("Spool full, %d messages discarded", self._spool.dropped - self._spool_dropped)
+            self._spool_dropped = self._spool.dropped
+
+        if self._metrics is not None:
+            self._metrics.spooled(len(self._spool))
+
+    def spool_queued(self, deadline=None):
+        """ Move messages from the forward queue to the spool
+
+            :param deadline:    Keep moving messages as they arrive until this time. If None,
+                                move at most REPLAY_MESSAGES of those already queued.
+        """
+        msgs = []
+        while not self.stopped():
+            try:
+                if deadline is None:
+                    if len(msgs) >= REPLAY_MESSAGES:
+                        break
+                    msg = self._fwd_queue.get_nowait()
+                else:
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        break
+                    msg = self._fwd_queue.get(True, min(remaining, 1))
+
+            except Empty:
+                if deadline is None:
+                    break
+                continue
+
+            msgs.append(msg)
+            if len(msgs) >= REPLAY_MESSAGES:
+                self.spool_messages(msgs)
+                msgs = []
+
+        self.spool_messages(msgs)
+        self.check_dropped()
+
+    def replay_spool(self):
+        """ Send a batch of the oldest spooled messages
+
+            Messages queued meanwhile are moved to the end of the spool first, so that
+            the collector receives everything in order.
+        """
+        self.spool_queued()
+
+        msgs = self._spool.peek(max(self._batch_messages, REPLAY_MESSAGES), self._batch_bytes)
+        sent = self.send_batch(msgs)
+        if sent:
+            self._spool.consume(msgs[:sent])
+            self.count_sent(msgs[:sent])
+            if self._metrics is not None:
+                self._metrics.spooled(len(self._spool))
+
+            if self._spool.empty():
+                self.LOG.info("Spool replayed")
+
+    def replay_state(self):
+        """ Send the Initiation and Peer Up messages of the routers and peers that are up,
+            then ask the listener for a dump of their routes.
+        """
+        if self._state_table is None:
+            return
+
+        msgs = self._state_table.messages()
+        if msgs:
+            self._sock.sendall(self.frame(b''.join(msgs)))
+            self.LOG.info("Replayed %d initiation and peer up messages", len(msgs))
+
+        if self._replay_requests is not None:
+            # discard what is left of an earlier dump; the listener may still be putting
+            # more of it, which replay_rib() tells by its generation
+            while True:
+                try:
+                    self._replay_queue.get_nowait()
+                except Empty:
+                    break
+            self._replay_generation += 1
+            for requests in self._replay_requests:
+                requests.put((self._index, self._replay_generation))
+            self._replaying = len(self._replay_requests)
+            self._replay_credit = 0.0
+            self._replay_time = time()
+
+    def replay_rib(self, wait=0):
+        """ Send the RIB dump messages that the replay rate allows
+
+            :param wait:    Seconds to wait for the listener, when there is nothing to send
+        """
+        now = time()
+        self._replay_credit = min(self._replay_credit + (now - self._replay_time) * self._replay_rate,
+                                  max(self._replay_rate / 10.0, 1))
+        self._replay_time = now
+
+        msgs = []
+        while len(msgs) < self._replay_credit:
+            try:
+                if msgs or not wait:
+                    (generation, msg) = self._replay_queue.get_nowait()
+                else:
+                    (generation, msg) = self._replay_queue.get(True, wait)
+            except Empty:
+                break
+            if generation != self._replay_generation:
+                # left of a dump requested before the last connection
+                continue
+            if msg == END_OF_DUMP:
+                self._replaying -= 1
+                if not self._replaying:
+                    self.LOG.info("RIB dump replayed")
+                    break
+                continue
+            msgs.append(msg)
+
+        if not msgs:
+            if wait and self._replaying and self._replay_credit < 1:
+                sleep(wait)
+            return
+
+        self._replay_credit -= len(msgs)
+        self.count_sent(msgs[:self.send_batch(msgs)])
+
+    def check_dropped(self):
+        """ Report messages the shared ring overwrote before this sender could read them
+        """
+        if hasattr(self._fwd_queue, 'dropped'):
+            dropped = self._fwd_queue.dropped()
+            if dropped != self._dropped:
+                self.LOG.warning("Collector %s:%d is falling behind, %d messages dropped",
+                                 self._collector['host'], self._collector['port'], dropped - self._dropped)
+                self._dropped = dropped
+                if self._metrics is not None:
+                    self._metrics.dropped(dropped)
 
     def disconnect(self):
         """ Disconnect from remote collector
@@ -119,8 +808,14 @@ class Sender(multiprocessing.Process):
         if self._sock:
             self._sock.close()
             self._sock = None
+        if self._failback_connection is not None:
+            self._failback_connection[1].close()
+            self._failback_connection = None
 
         self._isConnected = False
+        self._active = None
+        if self._metrics is not None:
+            self._metrics.connected(False)
 
     def stop(self):
         self._stop.set()
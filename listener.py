@@ -1,33 +1,94 @@
 # -*- coding: utf-8 -*-
+import logging
 import multiprocessing
 import socket
+import select
+import errno
+import struct
 import copy
 import time
 import sys
 from bgpparse import *
 from bmpparse import *
 
-from logger import init_mp_logger
+from logger import init_mp_logger, flush_mp_logger
+from rib import RIB_store
+from coalesce import Coalescer
+from capture import Capture_writer
+from transport import FRAME_MAGIC, Decompressor
+from budget import Budgeted_queue
+from scheduler import Scheduler
+from decoder import encode_record, shard, MESSAGE, ROUTER_DOWN
 
-def eprint(s):
-   sys.stderr.write(s+'\n')
+POLL_TIMEOUT = 200 # milliseconds, bounds the time taken to notice a stop request
+SCHEDULED_POLL_TIMEOUT = 1 # milliseconds, while the scheduler has messages queued
+
+RECV_SIZE = 0x10000 # bytes read at a time from a compressed stream
+
+class BMP_session(object):
+    """ State held for one connected router
+
+        Each router connection owns its receive buffer, the table of peers it has
+        reported up and its message counters, so that any number of sessions can be
+        served side by side.
+    """
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.framer = BMP_framer()
+        self.peers = {}             # per-peer header hash -> (peer address, peer AS)
+        self.msgs = 0
+        self.bytes = 0
+        self.msgs_by_type = [0] * 7
+        self.filtered = 0           # messages dropped by the filter rules
+        self.connected_at = time.time()
+        self.metrics = None         # metrics.Router_metrics, when metrics are kept
+        self.started = False        # the first bytes, telling BMP from a compressed stream, were read
+        self.decompressor = None    # transport.Decompressor, when the peer is a proxy compressing
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def name(self):
+        return "%s:%d" % self.address[:2]
 
-MAXM = 0x1000000
 
 class Listener(multiprocessing.Process):
 
-    def __init__(self, cfg, forward_queue, log_queue):
+    def __init__(self, cfg, forward_queue, log_queue, state_table=None, replay_server=None,
+                 decoder_queues=None, metrics=None, index=None, message_filter=None):
         multiprocessing.Process.__init__(self)
         self._stop = multiprocessing.Event()
+        # number of this listener when several share the port, else None
+        self._index = index
+        self._name = "listener" if index is None else "listener.%d" % index
 
         self._cfg = cfg
         self._fwd_queue = forward_queue
         self._log_queue = log_queue
         self.LOG = None
+        self._debug = False
+        self._max_msg_len = 0
+        self._handle_msg = self.process_msg
+        self._attribute_cache = None
+        self._rib = None
+        self._state_table = state_table
+        self._replay_server = replay_server
+        self._decoder_queues = decoder_queues
+        self._metrics = metrics
+        self._capture = None
+        self._coalescer = None
+        self._filter = message_filter     # filters.Message_filter, applied before anything else
+        self._accept_compressed = False   # expand the frames of a proxy sending the zlib transport
+        # both have pump(), stats() and close(), the scheduler takes the router with each message
+        self._budgeted = isinstance(forward_queue, (Budgeted_queue, Scheduler))
+        self._scheduled = isinstance(forward_queue, Scheduler)
 
     def run(self):
         """ Override """
-        self.LOG = init_mp_logger("listener", self._log_queue)
+        self.LOG = init_mp_logger(self._name, self._log_queue, self._cfg.get('log_pipeline'))
+        self._debug = self.LOG.isEnabledFor(logging.DEBUG)
         self.LOG.info("Running listener")
 
         if not ( self._cfg and 'listener' in self._cfg):
@@ -36,33 +97,322 @@ class Listener(multiprocessing.Process):
         try:
 
             port = self._cfg['listener']['port']
-            self.LOG.info("listening to %d " % port)
+            mode = self._cfg['listener'].get('mode', 'blocking')
+            self._accept_compressed = self._cfg['listener'].get('accept_compressed', False)
+            self.LOG.info("listening to %d (%s mode)" % (port, mode))
+
+            if self._cfg['listener'].get('passthrough', False):
+                self.LOG.info("passthrough enabled, messages are forwarded without decoding")
+                self._handle_msg = self.forward_msg
+            elif self._decoder_queues:
+                self.LOG.info("decoding in %d decoder processes, sharded by router" % len(self._decoder_queues))
+                self._handle_msg = self.dispatch_msg
+
+            if self._handle_msg == self.process_msg:
+                cache_size = self._cfg['listener'].get('attribute_cache', 10000)
+                if cache_size > 0:
+                    self._attribute_cache = Attribute_cache(cache_size)
+
+                if self._cfg['listener'].get('rib', False):
+                    self._rib = RIB_store(self._cfg['listener'].get('rib_max_routes', 4000000))
+                    self.LOG.info("keeping an Adj-RIB-In per peer, at most %d routes" % self._rib.max_routes)
+
+                window = self._cfg['listener'].get('coalesce_window', 0)
+                if window > 0:
+                    self._coalescer = Coalescer(window / 1000.0,
+                                                self._cfg['listener'].get('coalesce_max_prefixes', 100000),
+                                                self._metrics)
+                    self.LOG.info("coalescing updates over %d ms" % window)
+
+            if self._cfg['listener'].get('capture'):
+                filename = time.strftime(self._cfg['listener']['capture'])
+                if self._index is not None:
+                    filename += ".%d" % self._index
+                self._capture = Capture_writer(filename)
+                self.LOG.info("capturing received messages to %s" % self._capture.filename)
+
+            if self._filter is not None:
+                self.LOG.info("filtering with %d rules" % len(self._filter))
 
             rcvsock = socket.socket( socket.AF_INET, socket.SOCK_STREAM)
+            rcvsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self._index is not None:
+                # the listeners share the port, the kernel spreads the connections between them
+                rcvsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             rcvsock.bind(('', port))
-            rcvsock.listen(1)
-            max_msg_len = 0
-            while not self.stopped():
-                (clientsocket, address) = rcvsock.accept()
-                eprint("connection received from %s:%d " % address)
-                while not self.stopped():
-                    msg = clientsocket.recv(MAXM) # BGP max message size is 4096......
-                    if len(msg) > max_msg_len:
-                        max_msg_len = len(msg)
-                        sys.stderr.write("*****! msg received with length %d " % len(msg))
-                    assert MAXM > len(msg)
-                    if 0 == len(msg):
-                        break
-                    else:
-                        self.process_msg(msg)
-                eprint("disconnected")
+
+            if mode == 'event':
+                self.serve_events(rcvsock)
+            else:
+                self.serve_blocking(rcvsock)
 
             prev_ts = time.time()
 
         except KeyboardInterrupt:
             pass
 
+        if self._coalescer is not None:
+            self.forward(self._coalescer.flush_all())
+
+        if self._budgeted:
+            self.LOG.info("forward queue: %s" % self._fwd_queue.stats())
+            self._fwd_queue.close()
+
+        if self._capture is not None:
+            self._capture.close()
+            self.LOG.info("captured %d messages, %d bytes to %s" %
+                          (self._capture.msgs, self._capture.bytes, self._capture.filename))
+
         self.LOG.info("consumer stopped")
+        flush_mp_logger()
+
+    def serve_blocking(self, rcvsock):
+        """ Serve one router at a time, the next is accepted when it disconnects
+
+            :param rcvsock:     Bound listening socket
+        """
+        rcvsock.listen(1)
+        # held, spilled or scheduled messages to move on and RIB dumps to serve
+        # while the router is quiet, or none is connected
+        polling = self._coalescer is not None or self._budgeted or self._replay_server is not None
+        if polling:
+            rcvsock.settimeout(POLL_TIMEOUT / 1000.0)
+        while not self.stopped():
+            try:
+                (clientsocket, address) = rcvsock.accept()
+            except socket.timeout:
+                self.serve_replay()
+                self.flush_coalesced()
+                self.pump_queue()
+                continue
+            if polling:
+                clientsocket.settimeout(POLL_TIMEOUT / 1000.0)
+            session = self.open_session(clientsocket, address)
+            while not self.stopped():
+                if self.paused(session):
+                    # not read, so that TCP pushes back on it, until the scheduler has moved its messages on
+                    time.sleep(SCHEDULED_POLL_TIMEOUT / 1000.0)
+                elif not self.read_session(session):
+                    break
+                self.serve_replay()
+                self.flush_coalesced()
+                self.pump_queue()
+            self.close_session(session)
+
+    def serve_events(self, rcvsock):
+        """ Serve every connected router from a single poll() loop
+
+            :param rcvsock:     Bound listening socket
+        """
+        rcvsock.listen(socket.SOMAXCONN)
+        rcvsock.setblocking(False)
+
+        poller = select.poll()
+        poller.register(rcvsock.fileno(), select.POLLIN)
+        sessions = {}
+        paused = {}         # fd -> session not polled while the scheduler holds too much of it
+
+        while not self.stopped():
+            for (fd, event) in poller.poll(self.poll_timeout()):
+                if fd == rcvsock.fileno():
+                    while True:
+                        try:
+                            (clientsocket, address) = rcvsock.accept()
+                        except socket.error as e:
+                            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                                break
+                            raise
+                        clientsocket.setblocking(False)
+                        session = self.open_session(clientsocket, address)
+                        sessions[session.fileno()] = session
+                        poller.register(session.fileno(), select.POLLIN)
+
+                elif fd in sessions:
+                    session = sessions[fd]
+                    if not self.read_session(session):
+                        poller.unregister(fd)
+                        del sessions[fd]
+                        self.close_session(session)
+                    elif self.paused(session):
+                        # the other routers are still read, TCP pushes back on this one
+                        poller.unregister(fd)
+                        paused[fd] = session
+
+            self.serve_replay()
+            self.flush_coalesced()
+            self.pump_queue()
+
+            for fd in [fd for (fd, session) in paused.items() if not self.paused(session)]:
+                poller.register(fd, select.POLLIN)
+                del paused[fd]
+
+        for session in sessions.values():
+            self.close_session(session)
+
+    def open_session(self, sock, address):
+        session = BMP_session(sock, address)
+        self.LOG.info("connection received from %s" % session.name())
+        if self._metrics is not None:
+            session.metrics = self._metrics.router(address[0])
+            if session.metrics is not None:
+                session.metrics.connected()
+        return session
+
+    def close_session(self, session):
+        session.sock.close()
+        if session.metrics is not None:
+            session.metrics.disconnected()
+        self.LOG.info("router %s disconnected after %d messages, %d bytes, %d peers up" %
+                      (session.name(), session.msgs, session.bytes, len(session.peers)))
+        if self._filter is not None:
+            self.LOG.info("filter: %d messages from %s dropped; in all %s" %
+                          (session.filtered, session.name(), self._filter.stats()))
+        if session.decompressor is not None:
+            self.LOG.info("compressed stream from %s: %d bytes received for %d bytes of messages" %
+                          (session.name(), session.decompressor.bytes_in, session.decompressor.bytes_out))
+        if self._attribute_cache is not None:
+            self.LOG.info("attribute cache: %s" % self._attribute_cache.stats())
+        if self._rib is not None:
+            self._rib.router_down(session.name())
+            self.LOG.info("Adj-RIB-In: %s" % self._rib.stats())
+        if self._coalescer is not None:
+            self.forward(self._coalescer.flush_router(session.name()))
+            self.LOG.info("coalescing: %s" % self._coalescer.stats())
+        if self._state_table is not None:
+            self._state_table.router_down(session.name())
+        if self._decoder_queues:
+            record = encode_record(ROUTER_DOWN, session.name())
+            for queue in self._decoder_queues:
+                queue.put(record)
+
+    def flush_coalesced(self):
+        """ Forward the updates whose coalescing window has closed """
+        if self._coalescer is not None:
+            self.forward(self._coalescer.expired(time.time()))
+
+    def put(self, raw_msg, router):
+        """ Put a message to the forward queue
+
+            :param raw_msg:     Complete BMP message
+            :param router:      Name of the router it was received from
+        """
+        if self._scheduled:
+            self._fwd_queue.put(raw_msg, router)
+        else:
+            self._fwd_queue.put(raw_msg)
+
+    def forward(self, msgs):
+        """ Put the messages returned by the coalescer to the forward queue
+
+            :param msgs:    List of (router, raw message)
+        """
+        for (router, msg) in msgs:
+            self.put(msg, router)
+
+    def poll_timeout(self):
+        """ Milliseconds to wait for the routers, shorter while the scheduler holds messages """
+        if self._scheduled and len(self._fwd_queue):
+            return SCHEDULED_POLL_TIMEOUT
+        return POLL_TIMEOUT
+
+    def paused(self, session):
+        """ Whether the scheduler holds more than router_queue_bytes of a router's messages,
+            so that it is not to be read until it has moved them on
+        """
+        return self._scheduled and self._fwd_queue.over(session.name())
+
+    def pump_queue(self):
+        """ Move messages spilled while the forward queue was over its byte budget back into it """
+        if self._budgeted:
+            self._fwd_queue.pump()
+
+    def serve_replay(self):
+        """ Pass the RIB dumps asked for by the senders on to them, a chunk at a time """
+        if self._replay_server is not None and self._rib is not None:
+            self._replay_server.serve(self._rib)
+
+    def read_session(self, session):
+        """ Read from a router and process every complete message received
+
+            :param session:     BMP_session to read from
+
+            :return: False once the session has ended, True otherwise
+        """
+        try:
+            if session.decompressor is not None:
+                data = session.sock.recv(RECV_SIZE)
+                if not data:
+                    return False
+                session.framer.feed(session.decompressor.feed(data))
+            elif 0 == session.framer.recv(session.sock):
+                return False
+            if not session.started and not self.start_session(session):
+                return True
+            received = time.time()
+            for frame in session.framer.frames():
+                if len(frame) > self._max_msg_len:
+                    self._max_msg_len = len(frame)
+                    self.LOG.info("longest message so far received, length %d", len(frame))
+                raw_msg = frame.tobytes()
+                if self._capture is not None:
+                    self._capture.write(session.name(), raw_msg, received)
+                if self._filter is not None:
+                    raw_msg = self._filter.apply(raw_msg)
+                    if raw_msg is None:
+                        session.filtered += 1
+                        continue
+                try:
+                    self._handle_msg(raw_msg, session)
+                except (AssertionError, struct.error) as e:
+                    # the message is framed correctly, only its content is bad
+                    self.LOG.error("cannot parse message from %s: %r" % (session.name(), e))
+                    if session.metrics is not None:
+                        session.metrics.parse_error()
+                except ValueError as e:
+                    # not handled, a message larger than the ring it is put on for one;
+                    # the stream is still in step
+                    self.LOG.error("cannot pass on message from %s: %s" % (session.name(), e))
+
+        except socket.timeout:
+            return True
+
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return True
+            self.LOG.error("receive error from %s: %r" % (session.name(), e))
+            return False
+
+        except ValueError as e:
+            # from the framer or the decompressor, those of one message are caught above:
+            # the stream cannot be resynchronised, drop the router and let it reconnect
+            self.LOG.error("dropping connection from %s: %s" % (session.name(), e))
+            if session.metrics is not None:
+                session.metrics.parse_error()
+            return False
+
+        return True
+
+    def start_session(self, session):
+        """ Tell from the first bytes received whether a router or a proxy sending
+            compressed frames is connected, and expand the frames received so far.
+            Without accept_compressed every connection is taken to be a router.
+
+            :param session:     BMP_session read from
+
+            :return: False if too few bytes have been received to tell, True otherwise
+        """
+        if not self._accept_compressed:
+            session.started = True
+            return True
+        head = session.framer.peek(len(FRAME_MAGIC))
+        if FRAME_MAGIC.startswith(head):
+            if len(head) < len(FRAME_MAGIC):
+                return False
+            self.LOG.info("compressed stream from %s" % session.name())
+            session.decompressor = Decompressor()
+            session.framer.feed(session.decompressor.feed(session.framer.take()))
+        session.started = True
+        return True
 
     def stop(self):
         self._stop.set()
@@ -70,13 +420,76 @@ class Listener(multiprocessing.Process):
     def stopped(self):
         return self._stop.is_set()
 
-    def process_msg(self, raw_msg):
-        bmpmsgs = get_BMP_messages(raw_msg)
-        for bmpmsg in bmpmsgs:
-            if bmpmsg.msg_type == BMP_Statistics_Report:
-                eprint("-- BMP stats report rcvd, length %d" % bmpmsg.length)
-            elif bmpmsg.msg_type == BMP_Route_Monitoring:
-                bgpmsg = bmpmsg.bmp_RM_bgp_message
-                ## eprint("-- BMP RM rcvd, length %d" % bmpmsg.length)
+    def forward_msg(self, raw_msg, session):
+        """ Count and forward a message using only its common header
+
+            :param raw_msg:     Complete BMP message
+            :param session:     BMP_session it was received on
+        """
+        self.count_msg(raw_msg, session)
+        self.put(raw_msg, session.name())
+
+    def dispatch_msg(self, raw_msg, session):
+        """ Count a message and pass it to the decoder for its router
+
+            :param raw_msg:     Complete BMP message
+            :param session:     BMP_session it was received on
+        """
+        self.count_msg(raw_msg, session)
+        name = session.name()
+        queue = self._decoder_queues[shard(name, len(self._decoder_queues))]
+        queue.put(encode_record(MESSAGE, name, raw_msg))
+
+    def count_msg(self, raw_msg, session):
+        """ Update the session counters and state table from the common header
+
+            :param raw_msg:     Complete BMP message
+            :param session:     BMP_session it was received on
+        """
+        session.msgs += 1
+        session.bytes += len(raw_msg)
+        msg_type = ord(raw_msg[5:6])
+        session.msgs_by_type[msg_type] += 1
+        if session.metrics is not None:
+            session.metrics.received(msg_type, len(raw_msg))
+        if self._state_table is not None and msg_type in (BMP_Initiation_Message, BMP_Peer_Up_Notification,
+                                                          BMP_Peer_Down_Notification):
+            peer_hash = hash(raw_msg[6:40])
+            if msg_type == BMP_Peer_Down_Notification:
+                self._state_table.peer_down(session.name(), peer_hash)
             else:
-                eprint("-- BMP non RM rcvd, BmP msg type was %d, length %d" % (bmpmsg.msg_type,bmpmsg.length))
+                self._state_table.update(session.name(), msg_type, peer_hash, raw_msg)
+
+    def process_msg(self, raw_msg, session):
+        bmpmsg = BMP_message(raw_msg, self._attribute_cache)
+        session.msgs += 1
+        session.bytes += len(raw_msg)
+        session.msgs_by_type[bmpmsg.msg_type] += 1
+        if session.metrics is not None:
+            session.metrics.received(bmpmsg.msg_type, len(raw_msg))
+        if bmpmsg.msg_type == BMP_Statistics_Report:
+            if self._debug:
+                self.LOG.debug("-- BMP stats report rcvd, length %d", bmpmsg.length)
+        elif bmpmsg.msg_type == BMP_Route_Monitoring:
+            bgpmsg = bmpmsg.bmp_RM_bgp_message
+            if self._rib is not None:
+                self._rib.update(session.name(), bmpmsg)
+        else:
+            if bmpmsg.msg_type == BMP_Peer_Up_Notification:
+                session.peers[bmpmsg.bmp_ppc_fixed_hash] = (bmpmsg.bmp_ppc_Peer_Address, bmpmsg.bmp_ppc_Peer_AS)
+                if self._state_table is not None:
+                    self._state_table.update(session.name(), bmpmsg.msg_type, bmpmsg.bmp_ppc_fixed_hash, raw_msg)
+            elif bmpmsg.msg_type == BMP_Peer_Down_Notification:
+                session.peers.pop(bmpmsg.bmp_ppc_fixed_hash, None)
+                if self._rib is not None:
+                    self._rib.peer_down(session.name(), bmpmsg.bmp_ppc_fixed_hash)
+                if self._state_table is not None:
+                    self._state_table.peer_down(session.name(), bmpmsg.bmp_ppc_fixed_hash)
+            elif bmpmsg.msg_type == BMP_Initiation_Message and self._state_table is not None:
+                self._state_table.update(session.name(), bmpmsg.msg_type, None, raw_msg)
+            if self._debug:
+                self.LOG.debug("-- BMP non RM rcvd, BmP msg type was %d, length %d", bmpmsg.msg_type, bmpmsg.length)
+        if self._coalescer is not None:
+            self.forward(self._coalescer.add(session.name(), bmpmsg, raw_msg, time.time()))
+        else:
+            self.put(raw_msg, session.name())
@@ -11,8 +11,18 @@ import logging
 import logging.handlers
 import logging.config
 import threading
+import time
 
-from Queue import Empty
+try:
+    from Queue import Empty, Full
+except ImportError:
+    from queue import Empty, Full
+
+# Defaults for the log_pipeline settings of the multiprocess loggers
+DEFAULT_LEVEL = 'INFO'
+DEFAULT_BATCH = 100             # records sent to the logger thread at a time
+DEFAULT_FLUSH_INTERVAL = 0.5    # seconds a record may wait for its batch to fill
+DEFAULT_RATE_LIMIT = 10         # records per second per message, 0 for no limit
 
 def init_main_logger(config):
     """ Initialize a new main logger instance
@@ -31,39 +41,146 @@ def init_main_logger(config):
     return root
 
 
-def init_mp_logger(name, queue):
+def init_mp_logger(name, queue, options=None):
     """ Initialize a new multiprocess logger instance
 
     :param name:            logger name
     :param queue:           multiprocessing.Queue
+    :param options:         log_pipeline configuration dictionary: level, batch,
+                            flush_interval and rate_limit
 
     :return: logger instance
     """
-    handler = QueueHandler(queue)
+    options = options or {}
+    handler = QueueHandler(queue, options.get('batch', DEFAULT_BATCH),
+                           options.get('flush_interval', DEFAULT_FLUSH_INTERVAL))
+    rate_limit = options.get('rate_limit', DEFAULT_RATE_LIMIT)
+    if rate_limit:
+        handler.addFilter(RateLimitFilter(rate_limit))
+
     root = logging.getLogger()
 
     for h in root.handlers:
         root.removeHandler(h)
 
     root.addHandler(handler)
-    root.setLevel(logging.INFO)
+    root.setLevel(logging.getLevelName(options.get('level', DEFAULT_LEVEL)))
 
     log = logging.getLogger(name)
 
     return log
 
 
+def flush_mp_logger():
+    """ Send the records a multiprocess logger still holds, before the process exits """
+    for h in logging.getLogger().handlers:
+        h.flush()
+
+
 class QueueHandler(logging.Handler):
     """
     This is a logging handler which sends events to a multiprocessing queue.
+
+    Records are formatted down to their message and sent as a list, once batch
+    records are held or the oldest has waited flush_interval seconds, so that the
+    queue is written (and pickled to) once per batch rather than per record.  A
+    batch that does not fit in the queue is dropped rather than blocking the process.
     """
 
-    def __init__(self, queue):
+    def __init__(self, queue, batch=1, flush_interval=0):
         logging.Handler.__init__(self)
         self.queue = queue
+        self._batch = batch
+        self._flush_interval = flush_interval
+        self._records = []
+        self._first = 0
+        self._flusher = None
+        self.dropped = 0
+
+    def prepare(self, record):
+        """ Reduce a record to what the logger thread needs, cheap to pickle """
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
 
     def emit(self, record):
-        self.queue.put_nowait(record)
+        record = self.prepare(record)
+        if self._batch <= 1:
+            self.send([record])
+            return
+
+        with self.lock:
+            if not self._records:
+                self._first = time.time()
+            self._records.append(record)
+            full = len(self._records) >= self._batch
+
+        if full:
+            self.flush()
+        elif self._flusher is None:
+            # flush stragglers from a thread of this process, started on first use
+            # since threads do not survive the fork
+            self._flusher = threading.Thread(target=self._flush_periodically)
+            self._flusher.daemon = True
+            self._flusher.start()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self._flush_interval)
+            if self._records and time.time() - self._first >= self._flush_interval:
+                self.flush()
+
+    def flush(self):
+        with self.lock:
+            records = self._records
+            self._records = []
+        if records:
+            self.send(records)
+
+    def send(self, records):
+        try:
+            self.queue.put_nowait(records)
+        except Full:
+            self.dropped += len(records)
+
+
+class RateLimitFilter(logging.Filter):
+    """ Let through at most rate records a second of each message, by logger and format string
+
+        The first record let through after some were held back says how many.
+    """
+
+    MAX_MESSAGES = 1000     # distinct messages tracked, the table is cleared beyond this
+
+    def __init__(self, rate, interval=1.0):
+        logging.Filter.__init__(self)
+        self._rate = rate
+        self._interval = interval
+        self._windows = {}      # (logger, message) -> [window start, passed, suppressed]
+
+    def filter(self, record):
+        key = (record.name, record.msg)
+        now = time.time()
+        window = self._windows.get(key)
+        if window is None or now - window[0] >= self._interval:
+            if window is None and len(self._windows) >= self.MAX_MESSAGES:
+                self._windows.clear()
+            suppressed = window[2] if window is not None else 0
+            self._windows[key] = [now, 1, 0]
+            if suppressed:
+                record.msg = "%s (%d similar messages suppressed)" % (record.getMessage(), suppressed)
+                record.args = None
+            return True
+
+        if window[1] < self._rate:
+            window[1] += 1
+            return True
+
+        window[2] += 1
+        return False
 
 
 class LoggerThread(threading.Thread):
@@ -80,20 +197,24 @@ class LoggerThread(threading.Thread):
         self._log_cfg = log_cfg
         self._queue = queue
         self._log = init_main_logger(self._log_cfg)
-        self._stop = threading.Event()
+        self._stop_event = threading.Event()     # not _stop, which python 3 threads use
 
     def run(self):
         """ Override """
 
         while not self.stopped():
             try:
-                record = self._queue.get(True, 0.2)
+                records = self._queue.get(True, 0.2)
 
-                if record is None:
+                if records is None:
                     continue
 
-                logger = logging.getLogger(record.name)
-                logger.handle(record)
+                if not isinstance(records, list):
+                    records = [records]
+
+                for record in records:
+                    logger = logging.getLogger(record.name)
+                    logger.handle(record)
 
             except Empty:
                 continue
@@ -102,9 +223,9 @@ class LoggerThread(threading.Thread):
                 break
 
     def stop(self):
-        self._stop.set()
+        self._stop_event.set()
 
     def stopped(self):
-        return self._stop.isSet()
+        return self._stop_event.is_set()
 
 
@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+""" Metrics
+
+  Counters, gauges and latency histograms for the routers and collectors,
+  kept in an anonymous shared mmap created before the listener, decoder and
+  sender processes are forked, so that updating one is a store to memory
+  rather than a message to another process.  Each counter has a single
+  writer (the listener for a router, the sender for a collector) and so
+  needs no lock; the few updates made from elsewhere take the lock.  With
+  several listener processes two connections from one router address may
+  be served by different listeners, and its counters take the lock too.
+
+  The main process reads them, together with gauges it computes itself such
+  as queue depths, and serves them in the Prometheus text format over HTTP.
+"""
+import ctypes
+import mmap
+import threading
+from bisect import bisect_left
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+# words of a router slot
+_R_IN_USE = 0
+_R_MSGS = 1             # 7 words, by BMP message type
+_R_BYTES = 8
+_R_PARSE_ERRORS = 9
+_R_CONNECTIONS = 10
+_R_CONNECTED = 11
+_R_COALESCED = 12
+_R_SUPPRESSED = 13
+_R_QUEUE_DELAY_SUM = 14     # microseconds
+_R_QUEUE_DELAY_COUNT = 15
+_ROUTER_WORDS = 16
+_NAME_BYTES = 64
+
+# words of a collector slot
+_C_MSGS = 0
+_C_BYTES = 1
+_C_DROPPED = 2
+_C_SPOOLED = 3
+_C_SEND_ERRORS = 4
+_C_CONNECTIONS = 5
+_C_CONNECTED = 6
+_C_LATENCY_COUNT = 7
+_C_LATENCY_SUM = 8      # microseconds
+_C_LATENCY_BUCKETS = 9  # one word per bucket, and one for +Inf
+_C_FAILOVERS = 26
+_C_ENDPOINT = 27        # position of the endpoint connected to in the collector's endpoints
+_COLLECTOR_WORDS = 32
+
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+BMP_TYPE_NAMES = ('route_monitoring', 'statistics_report', 'peer_down', 'peer_up',
+                  'initiation', 'termination', 'route_mirroring')
+
+
+def _labels(pairs):
+    """ Label set of a sample, its values escaped as the text format requires
+
+        :param pairs:   (name, value) of each label
+
+        :return: text, braces included
+    """
+    return "{%s}" % ",".join('%s="%s"' % (name, ("%s" % value).replace('\\', '\\\\').replace('"', '\\"')
+                                         .replace('\n', '\\n'))
+                             for (name, value) in pairs)
+
+
+class Metrics(object):
+    """ Shared memory metrics of every router and collector """
+
+    def __init__(self, collectors, max_routers=256, lock=None, listeners=1):
+        """ Constructor
+
+            :param collectors:  List of collector configurations, for their labels
+            :param max_routers: Number of router slots, routers beyond this are not counted
+            :param lock:        supervisor.Worker_lock, taken to claim a router slot
+            :param listeners:   Number of listener processes counting the routers
+        """
+        self._collector_names = ["%s:%d" % (c['host'], c['port']) for c in collectors]
+        self._max_routers = max_routers
+        self._lock = lock if lock is not None else threading.Lock()
+        self._shared_routers = listeners > 1
+
+        words = max_routers * _ROUTER_WORDS + len(collectors) * _COLLECTOR_WORDS
+        self._names_size = max_routers * _NAME_BYTES
+        self._mm = mmap.mmap(-1, words * 8 + self._names_size, flags=mmap.MAP_SHARED)
+        self._words = (ctypes.c_uint64 * words).from_buffer(self._mm)
+        self._collector_base = max_routers * _ROUTER_WORDS
+        self._names_offset = words * 8
+
+    def router(self, name):
+        """ Metrics of a router, claiming a slot for it if it has none
+
+            A router that reconnects gets its slot back, so the counters carry on.
+
+            :param name:    Router name, its address
+
+            :return: Router_metrics, or None if all the slots are taken
+        """
+        encoded = name.encode('ascii')[:_NAME_BYTES].ljust(_NAME_BYTES, b'\0')
+        with self._lock:
+            free = None
+            for slot in range(self._max_routers):
+                base = slot * _ROUTER_WORDS
+                if not self._words[base + _R_IN_USE]:
+                    if free is None:
+                        free = slot
+                    continue
+                offset = self._names_offset + slot * _NAME_BYTES
+                if self._mm[offset:offset + _NAME_BYTES] == encoded:
+                    return Router_metrics(self, base)
+
+            if free is None:
+                return None
+            offset = self._names_offset + free * _NAME_BYTES
+            self._mm[offset:offset + _NAME_BYTES] = encoded
+            self._words[free * _ROUTER_WORDS + _R_IN_USE] = 1
+            return Router_metrics(self, free * _ROUTER_WORDS)
+
+    def collector(self, index):
+        """ Metrics of the collector at index in the collectors list """
+        return Collector_metrics(self, self._collector_base + index * _COLLECTOR_WORDS)
+
+    def _router_names(self):
+        names = []
+        for slot in range(self._max_routers):
+            if self._words[slot * _ROUTER_WORDS + _R_IN_USE]:
+                offset = self._names_offset + slot * _NAME_BYTES
+                names.append((slot * _ROUTER_WORDS,
+                              self._mm[offset:offset + _NAME_BYTES].rstrip(b'\0').decode('ascii')))
+        return names
+
+    def render(self, gauges=(), counters=()):
+        """ All metrics in the Prometheus text format
+
+            :param gauges:      (name, help, labels, function) of gauges computed when rendered,
+                                labels being a dictionary
+            :param counters:    Counters kept elsewhere, in the same form
+
+            :return: text
+        """
+        w = self._words
+        lines = []
+
+        def family(name, kind, text, samples):
+            lines.append("# HELP %s %s" % (name, text))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for (labels, value) in samples:
+                lines.append("%s%s %s" % (name, _labels(labels), value))
+
+        routers = self._router_names()
+        family("bmp_proxy_router_messages_total", "counter", "BMP messages received from a router",
+               [((("router", name), ("type", BMP_TYPE_NAMES[t])), w[base + _R_MSGS + t])
+                for (base, name) in routers for t in range(len(BMP_TYPE_NAMES))])
+        family("bmp_proxy_router_bytes_total", "counter", "Bytes received from a router",
+               [((("router", name),), w[base + _R_BYTES]) for (base, name) in routers])
+        family("bmp_proxy_router_parse_errors_total", "counter", "Messages from a router that could not be parsed",
+               [((("router", name),), w[base + _R_PARSE_ERRORS]) for (base, name) in routers])
+        family("bmp_proxy_router_coalesced_messages_total", "counter",
+               "Route monitoring messages from a router held for coalescing",
+               [((("router", name),), w[base + _R_COALESCED]) for (base, name) in routers])
+        family("bmp_proxy_router_suppressed_messages_total", "counter",
+               "Route monitoring messages from a router merged or discarded by coalescing",
+               [((("router", name),), w[base + _R_SUPPRESSED]) for (base, name) in routers])
+        name = "bmp_proxy_router_queue_delay_seconds"
+        lines.append("# HELP %s Time the messages of a router waited in its scheduler sub-queue" % name)
+        lines.append("# TYPE %s summary" % name)
+        for (base, router) in routers:
+            labels = _labels((("router", router),))
+            lines.append('%s_sum%s %f' % (name, labels, w[base + _R_QUEUE_DELAY_SUM] / 1e6))
+            lines.append('%s_count%s %d' % (name, labels, w[base + _R_QUEUE_DELAY_COUNT]))
+        family("bmp_proxy_router_connections_total", "counter", "Connections accepted from a router",
+               [((("router", name),), w[base + _R_CONNECTIONS]) for (base, name) in routers])
+        family("bmp_proxy_router_connected", "gauge", "Whether a router is connected",
+               [((("router", name),), w[base + _R_CONNECTED]) for (base, name) in routers])
+
+        collectors = [(self._collector_base + i * _COLLECTOR_WORDS, name)
+                      for (i, name) in enumerate(self._collector_names)]
+        for (word, name, kind, text) in (
+                (_C_MSGS, "messages_total", "counter", "BMP messages sent to a collector"),
+                (_C_BYTES, "bytes_total", "counter", "Bytes sent to a collector"),
+                (_C_DROPPED, "dropped_total", "counter", "Messages a collector missed because it fell behind"),
+                (_C_SEND_ERRORS, "send_errors_total", "counter", "Failed sends to a collector"),
+                (_C_CONNECTIONS, "connections_total", "counter", "Connections made to a collector"),
+                (_C_CONNECTED, "connected", "gauge", "Whether a collector is connected"),
+                (_C_FAILOVERS, "failovers_total", "counter", "Times a collector connection failed and was replaced"),
+                (_C_ENDPOINT, "active_endpoint", "gauge",
+                 "Priority of the collector endpoint connected to, 0 for the first"),
+                (_C_SPOOLED, "spooled_messages", "gauge", "Messages held in a collector's disk spool")):
+            family("bmp_proxy_collector_" + name, kind, text,
+                   [((("collector", collector),), w[base + word]) for (base, collector) in collectors])
+
+        name = "bmp_proxy_collector_latency_seconds"
+        lines.append("# HELP %s Time from a message entering the forward queue to it being sent" % name)
+        lines.append("# TYPE %s histogram" % name)
+        for (base, collector) in collectors:
+            total = 0
+            for (i, bound) in enumerate(LATENCY_BUCKETS + (float('inf'),)):
+                total += w[base + _C_LATENCY_BUCKETS + i]
+                le = "+Inf" if i == len(LATENCY_BUCKETS) else repr(bound)
+                lines.append('%s_bucket%s %d' % (name, _labels((("collector", collector), ("le", le))), total))
+            labels = _labels((("collector", collector),))
+            lines.append('%s_sum%s %f' % (name, labels, w[base + _C_LATENCY_SUM] / 1e6))
+            lines.append('%s_count%s %d' % (name, labels, w[base + _C_LATENCY_COUNT]))
+
+        for (kind, samples) in (("gauge", gauges), ("counter", counters)):
+            # one family per name, in the order first given
+            families = []
+            values = {}
+            for (name, text, labels, function) in samples:
+                if name not in values:
+                    families.append((name, text))
+                    values[name] = []
+                values[name].append((tuple(sorted(labels.items())), function()))
+            for (name, text) in families:
+                family(name, kind, text, values[name])
+
+        return "\n".join(lines) + "\n"
+
+
+class Router_metrics(object):
+    """ Counters of one router, written by the process serving it """
+
+    def __init__(self, metrics, base):
+        self._metrics = metrics
+        self._words = metrics._words
+        self._base = base
+        # the router's address may be served by several listener processes at once
+        self._shared = metrics._shared_routers
+
+    def received(self, msg_type, length):
+        if self._shared:
+            with self._metrics._lock:
+                self._received(msg_type, length)
+        else:
+            self._received(msg_type, length)
+
+    def _received(self, msg_type, length):
+        w = self._words
+        if msg_type < len(BMP_TYPE_NAMES):
+            w[self._base + _R_MSGS + msg_type] += 1
+        w[self._base + _R_BYTES] += length
+
+    def parse_error(self):
+        # may be counted by a decoder process as well as the listener
+        with self._metrics._lock:
+            self._words[self._base + _R_PARSE_ERRORS] += 1
+
+    def coalesced(self, held, suppressed):
+        # may be counted by several decoder processes: decoding is sharded by router,
+        # address and port, and the counters are the address's
+        with self._metrics._lock:
+            self._words[self._base + _R_COALESCED] += held
+            self._words[self._base + _R_SUPPRESSED] += suppressed
+
+    def queue_delay(self, seconds, msgs):
+        """ Record the time msgs messages waited in the scheduler, seconds in all """
+        # may be counted by several decoder processes: decoding is sharded by router,
+        # address and port, and the counters are the address's
+        with self._metrics._lock:
+            self._words[self._base + _R_QUEUE_DELAY_SUM] += int(seconds * 1e6)
+            self._words[self._base + _R_QUEUE_DELAY_COUNT] += msgs
+
+    def connected(self):
+        with self._metrics._lock:
+            self._words[self._base + _R_CONNECTIONS] += 1
+            self._words[self._base + _R_CONNECTED] = 1
+
+    def disconnected(self):
+        self._words[self._base + _R_CONNECTED] = 0
+
+
+class Collector_metrics(object):
+    """ Counters of one collector, written by its sender """
+
+    def __init__(self, metrics, base):
+        self._words = metrics._words
+        self._base = base
+
+    def sent(self, msgs, length):
+        self._words[self._base + _C_MSGS] += msgs
+        self._words[self._base + _C_BYTES] += length
+
+    def dropped(self, total):
+        self._words[self._base + _C_DROPPED] = total
+
+    def spooled(self, count):
+        self._words[self._base + _C_SPOOLED] = count
+
+    def send_error(self):
+        self._words[self._base + _C_SEND_ERRORS] += 1
+
+    def connected(self, up=True, endpoint=0):
+        if up:
+            self._words[self._base + _C_CONNECTIONS] += 1
+            self._words[self._base + _C_ENDPOINT] = endpoint
+        self._words[self._base + _C_CONNECTED] = 1 if up else 0
+
+    def failover(self):
+        self._words[self._base + _C_FAILOVERS] += 1
+
+    def latency(self, seconds):
+        """ Record the time a message took from ingress to being sent """
+        w = self._words
+        w[self._base + _C_LATENCY_BUCKETS + bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        w[self._base + _C_LATENCY_SUM] += int(seconds * 1e6)
+        w[self._base + _C_LATENCY_COUNT] += 1
+
+
+class Metrics_server(threading.Thread):
+    """ Serves the metrics over HTTP, from a thread of the main process """
+
+    def __init__(self, metrics, address, port, gauges=(), counters=()):
+        """ Constructor
+
+            :param metrics:     Metrics
+            :param address:     Address to listen on
+            :param port:        Port to listen on
+            :param gauges:      Gauges computed when scraped, see Metrics.render()
+            :param counters:    Counters kept outside Metrics, see Metrics.render()
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split('?')[0] not in ('/', '/metrics'):
+                    handler.send_error(404)
+                    return
+                body = metrics.render(gauges, counters).encode('utf-8')
+                handler.send_response(200)
+                handler.send_header('Content-Type', 'text/plain; version=0.0.4')
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, format, *args):
+                pass
+
+        self._server = HTTPServer((address, port), Handler)
+
+    def run(self):
+        """ Override """
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
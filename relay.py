@@ -0,0 +1,439 @@
+# -*- coding: utf-8 -*-
+""" Zero-copy relay
+
+  With nothing to inspect the listener and sender only copy each router's
+  messages to the collector, through Python and the forward queue.  In the
+  'relay' listener mode a single process does it instead and the messages
+  stay in the kernel: each router has a pipe, the body of each message is
+  spliced from the router's socket into the pipe and, once the message is
+  complete, from the pipe into the collector's socket.
+
+  Only the common header of each message is read, for its length, and
+  written to the pipe ahead of the body, so the collector still receives
+  whole messages, one router's after another's.  Initiation, Peer Up and
+  Peer Down messages are read whole, to keep the state replayed to the
+  collector when it connects.
+
+  The collector endpoints, backoff, health checks and failback are those of
+  the sender.  On a failover the messages held in the pipes go to the next
+  endpoint after the state replay, but a message that was being spliced
+  when the connection failed cannot be sent again: the rest of it is
+  discarded and it is counted as lost.  While no endpoint is up the routers
+  are not read, so TCP pushes back on them.
+
+  Needs os.splice(), Python 3.10 or later on Linux.
+"""
+import collections
+import errno
+import fcntl
+import os
+import select
+import socket
+import struct
+from time import time
+
+from bmpparse import (BMP_common_header_length, BMP_Initiation_Message, BMP_Peer_Up_Notification,
+                      BMP_Peer_Down_Notification)
+from forwarder import Sender
+from listener import POLL_TIMEOUT
+from logger import init_mp_logger, flush_mp_logger
+
+# Size asked for each router's pipe, which holds its messages until they are sent.
+# A message longer than the pipe cannot be relayed.
+PIPE_SIZE = 1024 * 1024
+
+# Most messages read from a router before the others get a turn
+READ_MESSAGES = 256
+
+_common_header = struct.Struct('!BIB')      # version, length, type
+
+# messages read whole, for the state table
+_STATE_TYPES = (BMP_Initiation_Message, BMP_Peer_Up_Notification, BMP_Peer_Down_Notification)
+
+
+class Relay_session(object):
+    """ A connected router, and the pipe holding its messages until they are sent """
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        (self.pipe_out, self.pipe_in) = os.pipe()
+        os.set_blocking(self.pipe_in, False)
+        try:
+            fcntl.fcntl(self.pipe_in, fcntl.F_SETPIPE_SZ, PIPE_SIZE)
+        except (IOError, OSError):
+            pass                    # over /proc/sys/fs/pipe-max-size, keep the default
+        self.pipe_size = fcntl.fcntl(self.pipe_in, fcntl.F_GETPIPE_SZ)
+
+        self.header = b''           # common header of the next message, as far as read
+        self.length = 0             # length of the message being read, 0 between messages
+        self.msg_type = 0
+        self.remaining = 0          # bytes of it still to read
+        self.msg = None             # the message, when it is read whole
+        self.written = 0            # bytes of it written to the pipe
+        self.held = 0               # bytes in the pipe
+        self.queued = collections.deque()   # lengths of the complete messages in the pipe
+        self.ready = 0              # bytes of them
+        self.sent = 0               # bytes of the first of them already sent
+
+        self.msgs = 0
+        self.bytes = 0
+        self.metrics = None         # metrics.Router_metrics, when metrics are kept
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def name(self):
+        return "%s:%d" % self.address[:2]
+
+    def close(self):
+        self.sock.close()
+        os.close(self.pipe_in)
+        os.close(self.pipe_out)
+
+
+class Relay(Sender):
+    """ Listener and sender in one, relaying the routers' messages to the collector kernel side """
+
+    def __init__(self, cfg, log_queue, state_table=None, metrics=None):
+        """ Constructor
+
+            :param cfg:             Configuration dictionary
+            :param log_queue:       Logging queue - sync logging
+            :param state_table:     replay.State_table, kept by this process and replayed
+                                    on connecting, or None
+            :param metrics:         metrics.Metrics to count in, or None
+        """
+        Sender.__init__(self, cfg, None, log_queue, 0, state_table, None, None, metrics)
+        self._router_metrics = metrics
+        self._sessions = {}
+        self._collector_fd = None
+        self._lost = 0
+
+    def run(self):
+        """ Override """
+        self.LOG = init_mp_logger("relay", self._log_queue, self._cfg.get('log_pipeline'))
+
+        port = self._cfg['listener']['port']
+        self.LOG.info("Running relay from %d to %s:%d", port, self._collector['host'], self._collector['port'])
+        if len(self._endpoints) > 1:
+            self.LOG.info("Collector endpoints in priority order: %s",
+                          ", ".join(endpoint.name() for endpoint in self._endpoints))
+
+        rcvsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        rcvsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        rcvsock.bind(('', port))
+        rcvsock.listen(socket.SOMAXCONN)
+        rcvsock.setblocking(False)
+
+        poller = select.poll()
+        poller.register(rcvsock.fileno(), select.POLLIN)
+        self.connect()
+
+        try:
+            while not self.stopped():
+                if not self._isConnected:
+                    # the routers wait, TCP holding back what they send
+                    self.reconnect()
+                    if self._isConnected:
+                        self.resume_routers(poller)
+                    continue
+
+                if time() >= self._next_check:
+                    self.health_check()
+                self.watch_collector(poller)
+
+                for (fd, event) in poller.poll(POLL_TIMEOUT):
+                    if fd == rcvsock.fileno():
+                        self.accept(rcvsock, poller)
+
+                    elif fd in self._sessions:
+                        session = self._sessions[fd]
+                        if not self.read_router(session):
+                            poller.unregister(fd)
+                            self.close_router(session)
+
+                    elif fd == self._collector_fd:
+                        # a collector sends nothing, it is readable once it has closed
+                        self.check_alive()
+
+        except KeyboardInterrupt:
+            pass
+
+        for session in list(self._sessions.values()):
+            self.close_router(session)
+        self.disconnect()
+
+        self.LOG.info("relay stopped after %d messages, %d bytes, %d lost, %d failovers",
+                      self._msgs_sent, self._bytes_sent, self._lost, self._failovers)
+        flush_mp_logger()
+
+    def watch_collector(self, poller):
+        """ Poll the collector's socket for it closing, following failovers """
+        fd = self._sock.fileno() if self._sock is not None else None
+        if fd != self._collector_fd:
+            if self._collector_fd is not None and self._collector_fd not in self._sessions:
+                try:
+                    poller.unregister(self._collector_fd)
+                except KeyError:
+                    pass
+            if fd is not None:
+                poller.register(fd, select.POLLIN)
+            self._collector_fd = fd
+
+    def accept(self, rcvsock, poller):
+        while True:
+            try:
+                (sock, address) = rcvsock.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            sock.setblocking(False)
+            session = Relay_session(sock, address)
+            self.LOG.info("connection received from %s" % session.name())
+            if self._router_metrics is not None:
+                session.metrics = self._router_metrics.router(address[0])
+                if session.metrics is not None:
+                    session.metrics.connected()
+            self._sessions[session.fileno()] = session
+            poller.register(session.fileno(), select.POLLIN)
+
+    def close_router(self, session):
+        """ Send what is complete of a router's messages and drop the connection """
+        if self._isConnected:
+            self.flush(session)
+        del self._sessions[session.fileno()]
+        session.close()
+        if session.metrics is not None:
+            session.metrics.disconnected()
+        if self._state_table is not None:
+            self._state_table.router_down(session.name())
+        self.LOG.info("router %s disconnected after %d messages, %d bytes" %
+                      (session.name(), session.msgs, session.bytes))
+
+    def resume_routers(self, poller):
+        """ Send the messages held while no collector endpoint was up, and read on """
+        for session in list(self._sessions.values()):
+            if not self.read_router(session):
+                poller.unregister(session.fileno())
+                self.close_router(session)
+
+    def read_router(self, session):
+        """ Move the messages a router has sent into its pipe, and send those complete
+
+            :param session:     Relay_session to read from
+
+            :return: False once the router has disconnected, True otherwise
+        """
+        try:
+            for i in range(READ_MESSAGES):
+                if not session.length:
+                    if len(session.header) < BMP_common_header_length:
+                        data = session.sock.recv(BMP_common_header_length - len(session.header))
+                        if not data:
+                            return False
+                        session.header += data
+                        if len(session.header) < BMP_common_header_length:
+                            break
+                    if not self.start_msg(session):
+                        break
+
+                elif session.remaining and session.msg is not None:
+                    data = session.sock.recv(session.remaining)
+                    if not data:
+                        return False
+                    session.msg += data
+                    session.remaining -= len(data)
+
+                elif session.remaining:
+                    if not self.splice_body(session):
+                        break
+
+                if not session.remaining and not self.end_msg(session):
+                    break
+
+        except EOFError:
+            return False
+
+        except (socket.error, OSError) as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                self.LOG.error("receive error from %s: %r" % (session.name(), e))
+                return False
+
+        except ValueError as e:
+            # the stream cannot be resynchronised, drop the router and let it reconnect
+            self.LOG.error("dropping connection from %s: %s" % (session.name(), e))
+            if session.metrics is not None:
+                session.metrics.parse_error()
+            return False
+
+        if session.ready and self._isConnected:
+            self.flush(session)
+        return True
+
+    def start_msg(self, session):
+        """ Take the length of the message from its common header, and pass the header on
+
+            :return: False if the pipe has no room for it until the collector is back,
+                     True otherwise
+
+            :raises ValueError: the header is not that of a BMP message, or the message
+                                is longer than the pipe
+        """
+        (version, length, msg_type) = _common_header.unpack(session.header)
+        if version != 3 or msg_type > 6 or length < BMP_common_header_length:
+            raise ValueError("BMP framing error (version %d, length %d, type %d)" % (version, length, msg_type))
+        if length > session.pipe_size:
+            raise ValueError("message of %d bytes does not fit in the %d byte pipe" % (length, session.pipe_size))
+
+        if self._state_table is not None and msg_type in _STATE_TYPES:
+            session.msg = session.header
+        elif not self.write_pipe(session, session.header):
+            # written whole or not at all, being shorter than PIPE_BUF
+            return False
+
+        session.length = length
+        session.msg_type = msg_type
+        session.remaining = length - BMP_common_header_length
+        session.header = b''
+        return True
+
+    def splice_body(self, session):
+        """ Splice what has arrived of the message's body into the pipe
+
+            A pipe holds a number of pages rather than of bytes, each header written and
+            each piece spliced taking at least one, so it may be full before its size is
+            reached.  The messages complete in it are then sent; if there are none, the
+            message being read fills it, and it is moved out to be read whole instead.
+
+            :return: False once nothing more can be read, True otherwise
+
+            :raises EOFError: the router has closed the connection
+        """
+        try:
+            moved = os.splice(session.sock.fileno(), session.pipe_in, session.remaining,
+                              flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        except (socket.error, OSError) as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+            if session.ready:
+                # the router may have sent nothing more, or the pipe may be full
+                if self._isConnected:
+                    self.flush(session)
+                return self._isConnected
+            if session.held > session.ready and self.pipe_full(session):
+                part = session.held - session.ready
+                session.msg = b''
+                while len(session.msg) < part:
+                    session.msg += os.read(session.pipe_out, part - len(session.msg))
+                session.held -= part
+                return True
+            return False
+
+        if not moved:
+            raise EOFError()
+        session.remaining -= moved
+        session.held += moved
+        return True
+
+    def pipe_full(self, session):
+        """ Whether a router's pipe has no page free, rather than its router nothing to read """
+        poller = select.poll()
+        poller.register(session.pipe_in, select.POLLOUT)
+        return not poller.poll(0)
+
+    def write_pipe(self, session, data):
+        """ Write to a router's pipe, sending the messages complete in it first if it is full
+
+            :return: Bytes written, fewer than all if it is full and no collector endpoint is up
+        """
+        written = 0
+        while written < len(data):
+            try:
+                written += os.write(session.pipe_in, data[written:])
+                continue
+            except (IOError, OSError) as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+            if not (session.ready and self._isConnected):
+                break
+            self.flush(session)
+        session.held += written
+        return written
+
+    def end_msg(self, session):
+        """ Count the message just read, now complete in the pipe
+
+            :return: False if a message read whole could not all be written to the pipe
+                     until the collector is back, True otherwise
+        """
+        msg = session.msg
+        if msg is not None:
+            if self._state_table is not None and session.msg_type in _STATE_TYPES and not session.written:
+                peer_hash = hash(msg[6:40])
+                if session.msg_type == BMP_Peer_Down_Notification:
+                    self._state_table.peer_down(session.name(), peer_hash)
+                else:
+                    self._state_table.update(session.name(), session.msg_type, peer_hash, msg)
+            session.written += self.write_pipe(session, msg[session.written:])
+            if session.written < len(msg):
+                return False
+            session.msg = None
+            session.written = 0
+
+        session.queued.append(session.length)
+        session.ready += session.length
+        session.msgs += 1
+        session.bytes += session.length
+        if session.metrics is not None:
+            session.metrics.received(session.msg_type, session.length)
+        session.length = 0
+        return True
+
+    def flush(self, session):
+        """ Splice the complete messages held in a router's pipe to the collector
+
+            On a failure the messages not yet sent go to the next endpoint that is up,
+            and the one sent in part is discarded.
+        """
+        sent = 0
+        msgs = 0
+        while session.ready and self._isConnected:
+            try:
+                moved = os.splice(session.pipe_out, self._sock.fileno(), session.ready, flags=os.SPLICE_F_MOVE)
+            except (socket.error, OSError) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                self.LOG.error("Failed to send messages to collector %s: %r",
+                               self._endpoints[self._active].name(), e)
+                if self._metrics is not None:
+                    self._metrics.send_error()
+                self.discard_partial(session)
+                self.failover()
+                continue
+
+            sent += moved
+            session.ready -= moved
+            session.held -= moved
+            session.sent += moved
+            while session.queued and session.sent >= session.queued[0]:
+                session.sent -= session.queued.popleft()
+                msgs += 1
+
+        self._msgs_sent += msgs
+        self._bytes_sent += sent
+        if self._metrics is not None and sent:
+            self._metrics.sent(msgs, sent)
+
+    def discard_partial(self, session):
+        """ Drop the rest of a message sent in part from the pipe, it cannot be sent again """
+        if not session.sent:
+            return
+        rest = session.queued.popleft() - session.sent
+        session.ready -= rest
+        session.held -= rest
+        session.sent = 0
+        while rest:
+            rest -= len(os.read(session.pipe_out, rest))
+        self._lost += 1
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+""" Initial state replay
+
+  A collector that connects after the routers did has missed their
+  Initiation and Peer Up messages, and the table dumps that followed, and
+  would stay incomplete until the routers reset their sessions.  To avoid
+  this the listener records the latest Initiation message of each router and
+  the Peer Up message of each peer that is up, in a State_table shared with
+  the senders, and each sender replays it whenever it connects.
+
+  Where the listener keeps the Adj-RIB-In of the peers, a sender can then
+  ask for a dump of it, which the listener builds as route monitoring
+  messages (one update per attribute set, ending with an End-of-RIB per
+  peer) and hands over on a queue of the sender's own.  The dump is made a
+  chunk at a time, only while that queue has room, and the sender sends it
+  at a limited rate between live messages, so live traffic is not held
+  back.  Each peer's routes are copied as its dump starts, and as each
+  batch of them is encoded those that have since been withdrawn or changed
+  are left out, their new state having been forwarded live.  A route that
+  changes after that can still reach the collector live before its older
+  state does in the dump; the window is bounded by the depth of the replay
+  queue and one batch.
+
+  Every request carries a generation, which the listener puts with each
+  message of the dump, so that a sender that reconnected while a dump was
+  under way can tell the rest of the old dump from the new one.
+"""
+from bgpparse import encode_prefixes, encode_update, split_prefixes, BGP_max_message_length, BGP_header_length
+from bmpparse import encode_BMP_message, BMP_Route_Monitoring, BMP_Initiation_Message, BMP_Peer_Up_Notification
+
+try:
+    from Queue import Empty, Full
+except ImportError:
+    from queue import Empty, Full
+
+# messages the listener puts on a sender's replay queue at a time
+REPLAY_CHUNK = 100
+
+# prefixes gathered before the pending updates of a dump are flushed
+DUMP_PREFIXES = 10000
+
+# marks the end of a RIB dump on the replay queue
+END_OF_DUMP = b''
+
+
+class State_table(object):
+    """ Latest Initiation of each router and Peer Up of each peer that is up
+
+        Held in a dictionary shared between processes (a Manager dict), written by
+        the listener and read by the senders.
+    """
+
+    def __init__(self, shared):
+        """ Constructor
+
+            :param shared:  Dictionary shared between the processes
+        """
+        self._shared = shared
+
+    def update(self, router, msg_type, peer_hash, raw_msg):
+        """ Record a message if it is part of the state
+
+            :param router:      Name of the router it was received from
+            :param msg_type:    BMP message type
+            :param peer_hash:   Per-peer header hash, for peer messages
+            :param raw_msg:     Complete BMP message
+        """
+        if msg_type == BMP_Initiation_Message:
+            self._shared[(router, 0, None)] = raw_msg
+        elif msg_type == BMP_Peer_Up_Notification:
+            self._shared[(router, 1, peer_hash)] = raw_msg
+
+    def peer_down(self, router, peer_hash):
+        self._shared.pop((router, 1, peer_hash), None)
+
+    def router_down(self, router):
+        for key in list(self._shared.keys()):
+            if key[0] == router:
+                self._shared.pop(key, None)
+
+    def messages(self):
+        """ Messages to replay, each router's Initiation before its Peer Ups """
+        state = self._shared.copy()
+        return [state[key] for key in sorted(state, key=lambda key: (key[0], key[1]))]
+
+
+def rib_dump(rib_store):
+    """ Route monitoring messages restating every route held
+
+        :param rib_store:   rib.RIB_store
+
+        :return: generator of raw BMP messages
+    """
+    for (key, rib) in rib_store.peers():
+        if rib.peer_header is None:
+            continue
+        room = BGP_max_message_length - BGP_header_length - 4
+
+        # the trie is updated between chunks and may reuse the nodes of withdrawn
+        # routes, so the walk is done before the first message is handed out
+        routes = list(rib.routes)
+        pending = {}            # Path_attributes -> encoded prefixes
+        gathered = 0
+        for (prefix, length, attributes) in routes:
+            prefixes = pending.setdefault(attributes, [])
+            prefixes.append((length, prefix))
+            gathered += 1
+            if gathered >= DUMP_PREFIXES:
+                # stop if the peer went down meanwhile, it has been reported already
+                if rib_store.rib(*key) is not rib:
+                    break
+                for msg in _updates(rib.peer_header, _current(rib, pending), room):
+                    yield msg
+                pending = {}
+                gathered = 0
+
+        if rib_store.rib(*key) is not rib:
+            continue
+        for msg in _updates(rib.peer_header, _current(rib, pending), room):
+            yield msg
+        # End-of-RIB
+        yield encode_BMP_message(BMP_Route_Monitoring, rib.peer_header + encode_update())
+
+
+def _current(rib, pending):
+    """ The pending routes the peer still has with the same attributes
+
+        The others were withdrawn or changed after the walk, and the collector has been sent
+        their new state live.
+    """
+    get = rib.routes.get
+    current = {}
+    for (attributes, prefixes) in pending.items():
+        prefixes = [(length, prefix) for (length, prefix) in prefixes if get(prefix, length) is attributes]
+        if prefixes:
+            current[attributes] = prefixes
+    return current
+
+
+def _updates(peer_header, pending, room):
+    """ One update per attribute set, split where the prefixes do not fit in one message """
+    for (attributes, prefixes) in pending.items():
+        for nlri in split_prefixes(encode_prefixes(prefixes), max(room - len(attributes.raw), 5)):
+            yield encode_BMP_message(BMP_Route_Monitoring, peer_header + encode_update(b'', attributes.raw, nlri))
+
+
+class Replay_server(object):
+    """ Listener end of the RIB dumps
+
+        Senders put their index and a generation on the request queue when they
+        connect; the listener calls serve() from its loop to feed each requested
+        dump on to the sender's replay queue, each message with the generation
+        of the request, as long as the queue has room.
+    """
+
+    def __init__(self, requests, queues):
+        """ Constructor
+
+            :param requests:    Queue of (sender index, generation) asking for a dump
+            :param queues:      Replay queue of each sender
+        """
+        self._requests = requests
+        self._queues = queues
+        self._dumps = {}            # sender index -> (generation, generator)
+        self._held = {}             # sender index -> (generation, message) that did not fit
+
+    def serve(self, rib_store):
+        """ Start requested dumps and move the next chunk of each along
+
+            :param rib_store:   rib.RIB_store to dump
+        """
+        while True:
+            try:
+                (index, generation) = self._requests.get_nowait()
+            except Empty:
+                break
+            # a sender that reconnected starts over
+            self._dumps[index] = (generation, rib_dump(rib_store))
+            self._held.pop(index, None)
+
+        for index in list(self._dumps):
+            queue = self._queues[index]
+            (generation, dump) = self._dumps[index]
+            for i in range(REPLAY_CHUNK):
+                item = self._held.pop(index, None)
+                if item is None:
+                    item = (generation, next(dump, END_OF_DUMP))
+                try:
+                    queue.put_nowait(item)
+                except Full:
+                    self._held[index] = item
+                    break
+                if item[1] == END_OF_DUMP:
+                    del self._dumps[index]
+                    break
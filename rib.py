@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+""" Adj-RIB-In store
+
+  Keeps the routes each monitored peer has announced, as reported in BMP
+  route monitoring messages, so that the proxy holds the current state of
+  every peer.  Routes are held in a path compressed binary (Patricia) trie
+  per peer.  The trie is stored in parallel arrays rather than as one
+  Python object per node, which keeps the cost of a route to a few tens of
+  bytes.  The attributes of a route are a reference to the Path_attributes
+  object shared, via the attribute cache, by every route that carries them.
+
+  Only IPv4 unicast routes are held, since those are the only NLRI the BGP
+  parser decodes (IPv6 arrives in MP_REACH_NLRI attributes).
+"""
+from array import array
+
+from bgpparse import BGP_UPDATE
+
+_NIL = -1
+_WIDTH = 32
+
+
+def _mask(length):
+    return (0xffffffff << (_WIDTH - length)) & 0xffffffff
+
+
+def _bit(prefix, position):
+    """ Bit of prefix at position, counting from the most significant bit """
+    return (prefix >> (_WIDTH - 1 - position)) & 1
+
+
+class Prefix_trie(object):
+    """ Patricia trie of IPv4 prefixes
+
+        Node i is key[i]/length[i], with children child[0][i] and child[1][i] and
+        value[i], which is None for the nodes that only join two branches.
+        Freed nodes are reused before the arrays are grown.
+    """
+
+    def __init__(self):
+        self._key = array('I')
+        self._length = array('B')
+        self._child = (array('i'), array('i'))
+        self._value = []
+        self._free = []
+        self._root = _NIL
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def _new_node(self, prefix, length, value):
+        if self._free:
+            node = self._free.pop()
+            self._key[node] = prefix
+            self._length[node] = length
+            self._child[0][node] = _NIL
+            self._child[1][node] = _NIL
+            self._value[node] = value
+        else:
+            node = len(self._value)
+            self._key.append(prefix)
+            self._length.append(length)
+            self._child[0].append(_NIL)
+            self._child[1].append(_NIL)
+            self._value.append(value)
+        return node
+
+    def _free_node(self, node):
+        self._value[node] = None
+        self._free.append(node)
+
+    def _replace(self, parent, node, new):
+        """ Put new where node hangs from parent """
+        if parent == _NIL:
+            self._root = new
+        elif self._child[0][parent] == node:
+            self._child[0][parent] = new
+        else:
+            self._child[1][parent] = new
+
+    def insert(self, prefix, length, value):
+        """ Add or replace a route
+
+            :param prefix:      Address as an integer
+            :param length:      Prefix length
+            :param value:       Route attributes, not None
+
+            :return: True if the prefix was not held before
+        """
+        prefix &= _mask(length)
+        parent = _NIL
+        node = self._root
+        key = self._key
+        lengths = self._length
+        child = self._child
+
+        while node != _NIL:
+            node_length = lengths[node]
+            common = min(length, node_length)
+            diff = (prefix ^ key[node]) & _mask(common)
+            if diff:
+                common = _WIDTH - diff.bit_length()
+
+            if common == node_length == length:
+                added = self._value[node] is None
+                self._value[node] = value
+                self._count += added
+                return added
+
+            if common == node_length:
+                # node covers the prefix, go on down
+                parent = node
+                node = child[_bit(prefix, node_length)][node]
+                continue
+
+            new = self._new_node(prefix, length, value)
+            if common == length:
+                # the prefix covers node
+                child[_bit(key[node], length)][new] = node
+            else:
+                # they part at bit common, join them with a valueless node
+                join = self._new_node(prefix & _mask(common), common, None)
+                child[_bit(prefix, common)][join] = new
+                child[_bit(key[node], common)][join] = node
+                new = join
+            self._replace(parent, node, new)
+            self._count += 1
+            return True
+
+        new = self._new_node(prefix, length, value)
+        if parent == _NIL:
+            self._root = new
+        else:
+            child[_bit(prefix, lengths[parent])][parent] = new
+        self._count += 1
+        return True
+
+    def remove(self, prefix, length):
+        """ Withdraw a route
+
+            :return: True if the prefix was held
+        """
+        prefix &= _mask(length)
+        grandparent = _NIL
+        parent = _NIL
+        node = self._root
+        key = self._key
+        lengths = self._length
+        child = self._child
+
+        while node != _NIL and lengths[node] < length:
+            if (prefix ^ key[node]) & _mask(lengths[node]):
+                return False
+            grandparent = parent
+            parent = node
+            node = child[_bit(prefix, lengths[node])][node]
+
+        if node == _NIL or lengths[node] != length or key[node] != prefix or self._value[node] is None:
+            return False
+
+        self._count -= 1
+        left = child[0][node]
+        right = child[1][node]
+        if left != _NIL and right != _NIL:
+            # still joins two branches
+            self._value[node] = None
+            return True
+
+        # splice the node out, and its parent too if that only joined it to a sibling
+        self._replace(parent, node, left if left != _NIL else right)
+        self._free_node(node)
+        if left == _NIL and right == _NIL and parent != _NIL and self._value[parent] is None:
+            sibling = child[0][parent] if child[0][parent] != _NIL else child[1][parent]
+            self._replace(grandparent, parent, sibling)
+            self._free_node(parent)
+        return True
+
+    def get(self, prefix, length):
+        """ Attributes of an exact prefix, or None """
+        prefix &= _mask(length)
+        node = self._root
+        while node != _NIL and self._length[node] < length:
+            node = self._child[_bit(prefix, self._length[node])][node]
+        if node != _NIL and self._length[node] == length and self._key[node] == prefix:
+            return self._value[node]
+        return None
+
+    def lookup(self, address):
+        """ Longest match for an address
+
+            :return: (prefix, length, attributes) or None
+        """
+        best = None
+        node = self._root
+        while node != _NIL:
+            node_length = self._length[node]
+            if (address ^ self._key[node]) & _mask(node_length):
+                break
+            if self._value[node] is not None:
+                best = node
+            if node_length == _WIDTH:
+                break
+            node = self._child[_bit(address, node_length)][node]
+        if best is None:
+            return None
+        return (self._key[best], self._length[best], self._value[best])
+
+    def __iter__(self):
+        """ (prefix, length, attributes) of every route, in prefix order
+
+            The trie must not change until the iteration is over: a removal can free,
+            and an insertion reuse, a node still to be visited.
+        """
+        stack = [self._root] if self._root != _NIL else []
+        while stack:
+            node = stack.pop()
+            if self._value[node] is not None:
+                yield (self._key[node], self._length[node], self._value[node])
+            for side in (1, 0):
+                if self._child[side][node] != _NIL:
+                    stack.append(self._child[side][node])
+
+    def clear(self):
+        self.__init__()
+
+    def memory(self):
+        """ Bytes held by the node arrays (not counting the shared attributes) """
+        nodes = len(self._value)
+        return (nodes * (self._key.itemsize + self._length.itemsize + 2 * self._child[0].itemsize) +
+                nodes * 8 + len(self._free) * 8)
+
+
+class Adj_RIB_In(object):
+    """ The routes received from one peer """
+
+    def __init__(self, address, asn, peer_header=None):
+        """ Constructor
+
+            :param address:     Peer address
+            :param asn:         Peer AS
+            :param peer_header: Raw BMP per-peer header, to build messages about the peer
+        """
+        self.address = address
+        self.asn = asn
+        self.peer_header = peer_header
+        self.routes = Prefix_trie()
+        self.updates = 0
+
+    def __len__(self):
+        return len(self.routes)
+
+
+class RIB_store(object):
+    """ Adj-RIB-In of every peer of every monitored router
+
+        Peers are identified by the router's name together with the per-peer
+        header hash.  Routes beyond max_routes, counted over all peers, are
+        not stored and are counted as refused.
+    """
+
+    def __init__(self, max_routes):
+        """ Constructor
+
+            :param max_routes:  Most routes held over all peers
+        """
+        self.max_routes = max_routes
+        self.routes = 0
+        self.refused = 0
+        self._ribs = {}
+
+    def __len__(self):
+        return len(self._ribs)
+
+    def rib(self, router, peer_hash):
+        """ Adj_RIB_In of a peer, or None """
+        return self._ribs.get((router, peer_hash))
+
+    def update(self, router, bmpmsg):
+        """ Apply a route monitoring message
+
+            :param router:      Name of the router it was received from
+            :param bmpmsg:      BMP_message of type route monitoring
+        """
+        bgpmsg = bmpmsg.bmp_RM_bgp_message
+        if bgpmsg.bgp_type != BGP_UPDATE:
+            return
+
+        key = (router, bmpmsg.bmp_ppc_fixed_hash)
+        rib = self._ribs.get(key)
+        if rib is None:
+            rib = Adj_RIB_In(bmpmsg.bmp_ppc_Peer_Address, bmpmsg.bmp_ppc_Peer_AS, bmpmsg.per_peer_header())
+            self._ribs[key] = rib
+        rib.updates += 1
+
+        routes = rib.routes
+        for (length, prefix) in bgpmsg.withdrawn_block:
+            if routes.remove(prefix, length):
+                self.routes -= 1
+
+        nlri = bgpmsg.NLRI_block
+        if len(nlri):
+            attributes = bgpmsg.attribute
+            for (length, prefix) in nlri:
+                if self.routes >= self.max_routes and routes.get(prefix, length) is None:
+                    self.refused += 1
+                elif routes.insert(prefix, length, attributes):
+                    self.routes += 1
+
+    def peer_down(self, router, peer_hash):
+        """ Discard the routes of a peer that has gone down """
+        rib = self._ribs.pop((router, peer_hash), None)
+        if rib is not None:
+            self.routes -= len(rib)
+
+    def peers(self):
+        """ ((router, peer hash), Adj_RIB_In) of every peer """
+        return list(self._ribs.items())
+
+    def router_down(self, router):
+        """ Discard the routes of every peer of a router """
+        for key in [key for key in self._ribs if key[0] == router]:
+            self.peer_down(*key)
+
+    def memory(self):
+        """ Bytes held by the tries """
+        return sum(rib.routes.memory() for rib in self._ribs.values())
+
+    def stats(self):
+        return "%d peers, %d routes, %d refused, %d bytes" % (len(self._ribs), self.routes, self.refused, self.memory())
@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+""" Shared memory ring buffer
+
+  A single producer / multiple consumer queue of raw byte strings held in an
+  anonymous shared mmap, to be created before the producer and consumer
+  processes are forked.  Every consumer (reader) sees every message, so a
+  message is written once however many consumers there are.
+
+  Records are stored as a header (length, sequence number and the time the
+  message was put) followed by the message, padded to 8 bytes.  The producer owns the head position and each
+  reader owns its tail position, each stored in the mapping as a
+  monotonically increasing 64 bit counter, so no lock is needed: a record is
+  written before the head is advanced past it and is copied out before the
+  tail is advanced past it.  This relies on stores becoming visible to the
+  other process in program order, which is the case on x86.
+
+  When the buffer is full the producer discards the oldest records, but only
+  as far as the slowest of the readers that are keeping up (less than half
+  the buffer behind), so that one slow reader cannot hold back the others.
+  If no reader is keeping up the producer waits.  A reader that has been
+  overtaken skips to the oldest record still held and counts the messages
+  it missed.
+
+  Several producer processes may share a ring if it is given a lock; each
+  put() then takes the lock, waiting no longer than it would for space, and
+  reloads the producer's fields from the mapping.  A producer that dies
+  holding it leaves no record half written, the head being advanced last.
+"""
+import ctypes
+import mmap
+import struct
+import time
+
+try:
+    from Queue import Empty, Full
+except ImportError:
+    from queue import Empty, Full
+
+# control block of 64 bit words, the producer and each reader on their own cache line.
+# These are accessed through ctypes, which loads and stores each word in one go;
+# struct.pack_into clears its destination before packing and so cannot be used
+# for a value the other process may be reading.
+_HEAD = 0           # position after the newest record
+_PUTS = 1           # messages written
+_LOW = 2            # position of the oldest record held
+_READER = 8         # first reader's words, then one cache line per reader
+_TAIL = 0           #   position of the next record to read
+_GETS = 1           #   messages read or dropped
+_DROPS = 2          #   messages overwritten before they were read
+_WORDS_PER_LINE = 8
+
+_HEADER = struct.Struct('@IxxxxQd')     # message length, sequence number, time put
+
+_WRAP = 0xffffffff
+
+# polling intervals used while waiting for data or space, in seconds
+_MIN_WAIT = 0.00001
+_MAX_WAIT = 0.001
+
+
+def _record_size(length):
+    return (_HEADER.size + length + 7) & ~7
+
+
+def _wait(ready, block, timeout, exc):
+    """ Poll until ready() holds, backing off from a short spin to _MAX_WAIT sleeps """
+    if not block:
+        raise exc()
+
+    deadline = None if timeout is None else time.time() + timeout
+    wait = _MIN_WAIT
+    while not ready():
+        if deadline is not None and time.time() >= deadline:
+            raise exc()
+        time.sleep(wait)
+        wait = min(wait * 2, _MAX_WAIT)
+
+
+class RingBuffer(object):
+    """ Shared memory queue of byte strings
+
+        Offers the subset of the Queue interface used by the listener and sender;
+        get() and friends read as the first reader.
+    """
+
+    def __init__(self, size, readers=1, lock=None):
+        """ Constructor
+
+            :param size:        Capacity in bytes, rounded up to a multiple of the page size
+            :param readers:     Number of consumers, each of which receives every message
+            :param lock:        supervisor.Worker_lock shared by the producers, if there are several
+        """
+        size = ((size + mmap.PAGESIZE - 1) // mmap.PAGESIZE) * mmap.PAGESIZE
+        words = _READER + readers * _WORDS_PER_LINE
+        self._size = size
+        self._control_size = words * 8
+        self._mm = mmap.mmap(-1, self._control_size + size, flags=mmap.MAP_SHARED)
+        self._control = (ctypes.c_uint64 * words).from_buffer(self._mm)
+
+        # private copies of the fields the producer owns
+        self._head = 0
+        self._low = 0
+        self._seq = 0
+        self._lock = lock
+
+        self._readers = [RingReader(self, i) for i in range(readers)]
+
+    def capacity(self):
+        return self._size
+
+    def reader(self, index):
+        """ Consumer end for one reader
+
+            :param index:   Reader number, from 0
+
+            :return: RingReader
+        """
+        return self._readers[index]
+
+    def _make_room(self, needed):
+        """ Advance the oldest record held until needed bytes are free at the head
+
+            :return: True if there is room, False if the producer has to wait
+        """
+        tails = [self._control[reader._base + _TAIL] for reader in self._readers]
+        low = max(self._low, min(tails))
+        keeping_up = [tail for tail in tails if self._head - tail <= self._size // 2]
+        limit = min(keeping_up) if keeping_up else low
+
+        while self._head + needed - low > self._size and low < limit:
+            # discard the oldest record, overtaking the readers that have not read it
+            index = low % self._size
+            if self._size - index < _HEADER.size:
+                low += self._size - index
+                continue
+
+            length = _HEADER.unpack_from(self._mm, self._control_size + index)[0]
+            if length == _WRAP:
+                low += self._size - index
+            else:
+                low += _record_size(length)
+
+        if low != self._low:
+            self._low = low
+            self._control[_LOW] = low
+
+        return self._head + needed - low <= self._size
+
+    def put(self, msg, block=True, timeout=None):
+        """ Append a message, waiting for space if the buffer is full
+
+            :param msg:         Message bytes
+            :param block:       Wait for space rather than raising Full
+            :param timeout:     Maximum time to wait, in seconds
+
+            :raises Full: no space, or the lock, became available
+        """
+        if self._lock is None:
+            return self._put(msg, block, timeout)
+
+        started = time.time()
+        if not self._lock.acquire(block, timeout):
+            raise Full()
+        try:
+            # another producer may have written since this one last did
+            self._head = self._control[_HEAD]
+            self._low = self._control[_LOW]
+            self._seq = self._control[_PUTS]
+            if timeout is not None:
+                timeout = max(timeout - (time.time() - started), 0)
+            return self._put(msg, block, timeout)
+        finally:
+            self._lock.release()
+
+    def _put(self, msg, block, timeout):
+        length = len(msg)
+        record = _record_size(length)
+        if record > self._size:
+            raise ValueError("message of %d bytes does not fit in a %d byte ring" % (length, self._size))
+
+        head = self._head
+        index = head % self._size
+        to_end = self._size - index
+        needed = record if record <= to_end else to_end + record
+
+        if head + needed - self._low > self._size:
+            if not self._make_room(needed):
+                _wait(lambda: self._make_room(needed), block, timeout, Full)
+
+        if record > to_end:
+            # mark the skipped space, if there is room for the marker
+            if to_end >= _HEADER.size:
+                _HEADER.pack_into(self._mm, self._control_size + index, _WRAP, 0, 0)
+            head += to_end
+            index = 0
+
+        offset = self._control_size + index
+        _HEADER.pack_into(self._mm, offset, length, self._seq, time.time())
+        offset += _HEADER.size
+        self._mm[offset:offset + length] = msg
+
+        self._seq += 1
+        self._head = head + record
+        self._control[_PUTS] = self._seq
+        self._control[_HEAD] = self._head
+
+    def put_nowait(self, msg):
+        self.put(msg, False)
+
+    def resume(self):
+        """ Reload the producer's fields from the mapping, so that a producer process
+            started in place of one that died carries on from where it stopped
+        """
+        self._head = self._control[_HEAD]
+        self._low = self._control[_LOW]
+        self._seq = self._control[_PUTS]
+
+    def used(self):
+        """ Bytes held for the slowest of the readers that are keeping up, as _make_room() counts them """
+        control = self._control
+        head = control[_HEAD]
+        tails = [control[reader._base + _TAIL] for reader in self._readers]
+        keeping_up = [tail for tail in tails if head - tail <= self._size // 2]
+        return head - min(keeping_up or tails)
+
+    def get(self, block=True, timeout=None):
+        return self._readers[0].get(block, timeout)
+
+    def get_nowait(self):
+        return self._readers[0].get(False)
+
+    def qsize(self):
+        return self._readers[0].qsize()
+
+    def empty(self):
+        return self._readers[0].empty()
+
+
+class RingReader(object):
+    """ Consumer end of a RingBuffer, for use by a single process """
+
+    def __init__(self, ring, index):
+        self._ring = ring
+        self._base = _READER + index * _WORDS_PER_LINE
+
+        # private copies of the fields this reader owns
+        self._tail = 0
+        self._seq = 0
+        self._drops = 0
+
+        # time the message last returned by get() was put, for latency measurement
+        self.put_time = None
+
+    def get(self, block=True, timeout=None):
+        """ Remove and return the oldest message not yet read
+
+            :param block:       Wait for a message rather than raising Empty
+            :param timeout:     Maximum time to wait, in seconds
+
+            :raises Empty: no message became available
+        """
+        ring = self._ring
+        control = ring._control
+        size = ring._size
+
+        tail = self._tail
+        if control[_HEAD] == tail:
+            _wait(lambda: control[_HEAD] != tail, block, timeout, Empty)
+
+        while True:
+            if tail < control[_LOW]:
+                tail = control[_LOW]
+
+            index = tail % size
+            if size - index < _HEADER.size:
+                tail += size - index
+                continue
+
+            (length, seq, put_time) = _HEADER.unpack_from(ring._mm, ring._control_size + index)
+            if length == _WRAP:
+                tail += size - index
+                continue
+
+            offset = ring._control_size + index + _HEADER.size
+            msg = ring._mm[offset:offset + length]
+
+            # the producer moves the low mark before reusing space, if it has not
+            # moved past this record then the copy is intact
+            if tail >= control[_LOW]:
+                break
+
+        if seq > self._seq:
+            self._drops += seq - self._seq
+            control[self._base + _DROPS] = self._drops
+
+        self._seq = seq + 1
+        self._tail = tail + _record_size(length)
+        self.put_time = put_time
+        control[self._base + _GETS] = self._seq
+        control[self._base + _TAIL] = self._tail
+        return msg
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def resume(self):
+        """ Reload this reader's fields from the mapping, see RingBuffer.resume() """
+        control = self._ring._control
+        self._tail = control[self._base + _TAIL]
+        self._seq = control[self._base + _GETS]
+        self._drops = control[self._base + _DROPS]
+
+    def qsize(self):
+        """ Number of messages waiting """
+        control = self._ring._control
+        return control[_PUTS] - control[self._base + _GETS]
+
+    def empty(self):
+        control = self._ring._control
+        return control[_HEAD] == control[self._base + _TAIL]
+
+    def dropped(self):
+        """ Number of messages overwritten before this reader could read them """
+        return self._ring._control[self._base + _DROPS]
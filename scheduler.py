@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+""" Per-router fair scheduling
+
+  The forward queue is a single FIFO, so a router sending its full table
+  after a reset can fill it and hold up the Peer Down and live updates of
+  every other router for as long as the dump takes to send.  A Scheduler
+  sits between a producer (the listener, or a decoder) and the forward
+  queue and keeps a sub-queue per router instead.  Messages are moved on to
+  the forward queue only while it holds fewer than depth bytes, so the
+  choice of what is sent next is made as late as possible:
+
+    - Initiation, Termination, Peer Up and Peer Down messages first, in the
+      order received.  The route monitoring and statistics messages of the
+      peer a Peer Down is for (of the router, for a Termination) still
+      queued before it are superseded by it and dropped, so the collector
+      never sees a peer's routes after its Peer Down.  Those queued before
+      a Peer Up go to the priority lane ahead of it instead, so that the
+      updates the coalescer flushes for a peer before its Peer Up still
+      reach the collector first.
+    - then the routers' other messages by deficit round robin: each router
+      in turn sends messages up to its quantum of bytes, times its weight,
+      carrying over what it did not use while it has messages queued.
+
+  put() never waits.  A router whose sub-queue grows past router_queue_bytes
+  is reported by over(), and the listener stops reading its connection until
+  release() has brought it back under, so that TCP pushes back on that router
+  alone rather than the proxy buffering its dump.  A decoder, which cannot
+  tell one router's input from another's, stops taking input while any of
+  its routers is over.  The time each message spent in its router's
+  sub-queue is kept in the router's metrics.
+"""
+import collections
+import time
+
+from bmpparse import (BMP_Peer_Down_Notification, BMP_Peer_Up_Notification, BMP_Initiation_Message,
+                      BMP_Termination_Message)
+
+# bytes a router may send per round, times its weight
+DEFAULT_QUANTUM = 65536
+
+# bytes the forward queue is filled to
+DEFAULT_DEPTH = 1024 * 1024
+
+# bytes queued for a router before the producer stops reading it
+DEFAULT_ROUTER_QUEUE_BYTES = 16 * 1024 * 1024
+
+_PRIORITY = (BMP_Initiation_Message, BMP_Termination_Message, BMP_Peer_Up_Notification,
+             BMP_Peer_Down_Notification)
+
+# seconds between updates of the routers' queue delay metrics
+_PUBLISH_INTERVAL = 0.2
+
+
+class _Router(object):
+    """ Sub-queue of one router """
+
+    __slots__ = ('name', 'quantum', 'msgs', 'bytes', 'deficit', 'turn', 'active',
+                 'delay', 'delayed', 'stalled', 'metrics')
+
+    def __init__(self, name, quantum):
+        self.name = name
+        self.quantum = quantum
+        self.msgs = collections.deque()     # (message, time queued)
+        self.bytes = 0
+        self.deficit = 0
+        self.turn = False       # its turn in the round has started
+        self.active = False     # it is in the round
+        self.delay = 0.0        # seconds its messages released since the last update waited
+        self.delayed = 0        # and how many there were
+        self.stalled = None     # time it went over router_queue_bytes, while it is
+        self.metrics = None     # metrics.Router_metrics, when metrics are kept
+
+
+class Scheduler(object):
+    """ Producer end of the forward queue, sending the routers' messages in fair turns
+
+        Offers a put() taking the router a message came from, used by a single process.
+    """
+
+    def __init__(self, queue, held, depth=DEFAULT_DEPTH, quantum=DEFAULT_QUANTUM,
+                 router_queue_bytes=DEFAULT_ROUTER_QUEUE_BYTES, weights=None, metrics=None):
+        """ Constructor
+
+            :param queue:               Forward queue to put to, or the budgeted producer end of it
+            :param held:                Function returning the bytes in the forward queue
+            :param depth:               Bytes the forward queue is filled to
+            :param quantum:             Bytes a router of weight 1 may send per round
+            :param router_queue_bytes:  Bytes queued for a router before over() reports it
+            :param weights:             Dictionary of weights by router address, 1 by default
+            :param metrics:             metrics.Metrics to keep the queue delays in, or None
+        """
+        self._queue = queue
+        self._held = held
+        self.depth = depth
+        self.quantum = quantum
+        self.router_queue_bytes = router_queue_bytes
+        self._weights = weights or {}
+        self._metrics = metrics
+
+        self._routers = {}                      # name -> _Router
+        self._round = collections.deque()       # _Router in the round, the one whose turn it is first
+        self._priority = collections.deque()    # (message, time queued, _Router)
+        self._stalled = set()                   # _Router over router_queue_bytes
+        self._next_publish = 0
+
+        self.msgs = 0
+        self.priority_msgs = 0
+        self.superseded = 0
+        self.stalls = 0
+        self.stall_time = 0.0
+
+    def put(self, msg, router):
+        """ Queue a message, without waiting: the producer checks over() afterwards
+
+            :param msg:     Message bytes
+            :param router:  Name of the router it came from
+        """
+        sub = self._routers.get(router)
+        if sub is None:
+            sub = _Router(router, self.quantum * self._weights.get(router.rsplit(':', 1)[0], 1))
+            if self._metrics is not None:
+                sub.metrics = self._metrics.router(router.rsplit(':', 1)[0])
+            self._routers[router] = sub
+
+        self.msgs += 1
+        msg_type = ord(msg[5:6])
+        if msg_type in _PRIORITY:
+            if msg_type == BMP_Peer_Down_Notification:
+                self.supersede(sub, msg[6:40])
+            elif msg_type == BMP_Termination_Message:
+                self.supersede(sub)
+            elif msg_type == BMP_Peer_Up_Notification:
+                self.promote(sub, msg[6:40])
+            self._priority.append((msg, time.time(), sub))
+            self.priority_msgs += 1
+        else:
+            sub.msgs.append((msg, time.time()))
+            sub.bytes += len(msg)
+            if not sub.active:
+                sub.active = True
+                self._round.append(sub)
+
+        self.release()
+        if sub.bytes > self.router_queue_bytes and sub.stalled is None:
+            sub.stalled = time.time()
+            self._stalled.add(sub)
+            self.stalls += 1
+
+    def over(self, router=None):
+        """ Whether a router has more than router_queue_bytes queued, so that its producer
+            should stop reading it until release() brings it back under
+
+            :param router:  Name of the router, or None for any router
+        """
+        if router is None:
+            return bool(self._stalled)
+        sub = self._routers.get(router)
+        return sub is not None and sub.stalled is not None
+
+    def unstall(self, sub, now):
+        """ Count the time a router spent over router_queue_bytes once it is back under """
+        if sub.bytes <= self.router_queue_bytes:
+            self.stall_time += now - sub.stalled
+            sub.stalled = None
+            self._stalled.discard(sub)
+
+    def supersede(self, sub, peer=None):
+        """ Drop the messages queued for a router, or one of its peers, overtaken by a
+            Peer Down or Termination
+
+            :param sub:     _Router
+            :param peer:    Per-peer header up to the timestamp, or None for every peer
+        """
+        kept = collections.deque(entry for entry in sub.msgs if peer is not None and entry[0][6:40] != peer)
+        self.superseded += len(sub.msgs) - len(kept)
+        sub.msgs = kept
+        sub.bytes = sum(len(entry[0]) for entry in kept)
+        if sub.stalled is not None:
+            self.unstall(sub, time.time())
+
+    def promote(self, sub, peer):
+        """ Move the messages queued for one of a router's peers to the priority lane,
+            where they go ahead of the Peer Up about to be put there
+
+            :param sub:     _Router
+            :param peer:    Per-peer header up to the timestamp
+        """
+        kept = collections.deque()
+        for entry in sub.msgs:
+            if entry[0][6:40] == peer:
+                self._priority.append((entry[0], entry[1], sub))
+                sub.bytes -= len(entry[0])
+            else:
+                kept.append(entry)
+        sub.msgs = kept
+        if sub.stalled is not None:
+            self.unstall(sub, time.time())
+
+    def release(self, room=None):
+        """ Move messages to the forward queue while it has room, priority messages first
+
+            :param room:    Bytes to move, by default as many as the forward queue is short of depth
+
+            :return: Number of messages moved
+        """
+        if room is None:
+            room = self.depth - self._held()
+        moved = 0
+        now = time.time()
+        while room > 0:
+            if self._priority:
+                (msg, queued, sub) = self._priority.popleft()
+
+            elif self._round:
+                sub = self._round[0]
+                if not sub.msgs:
+                    # superseded while in the round
+                    self.leave(sub)
+                    continue
+                if not sub.turn:
+                    sub.turn = True
+                    sub.deficit += sub.quantum
+                if len(sub.msgs[0][0]) > sub.deficit:
+                    # its turn is over, the deficit is carried over to the next
+                    sub.turn = False
+                    self._round.rotate(-1)
+                    continue
+                (msg, queued) = sub.msgs.popleft()
+                sub.bytes -= len(msg)
+                sub.deficit -= len(msg)
+                if not sub.msgs:
+                    self.leave(sub)
+                if sub.stalled is not None:
+                    self.unstall(sub, now)
+
+            else:
+                break
+
+            self._queue.put(msg)
+            room -= len(msg)
+            moved += 1
+            sub.delay += now - queued
+            sub.delayed += 1
+
+        if now >= self._next_publish:
+            self.publish(now)
+        return moved
+
+    def leave(self, sub):
+        """ Take a router whose sub-queue is empty out of the round """
+        self._round.remove(sub)
+        sub.active = False
+        sub.turn = False
+        sub.deficit = 0
+
+    def publish(self, now):
+        """ Add the queue delays of the messages released since the last time to the routers' metrics,
+            and forget the routers with nothing queued since then
+        """
+        self._next_publish = now + _PUBLISH_INTERVAL
+        for sub in list(self._routers.values()):
+            if sub.delayed:
+                if sub.metrics is not None:
+                    sub.metrics.queue_delay(sub.delay, sub.delayed)
+                sub.delay = 0.0
+                sub.delayed = 0
+            elif not sub.active and not any(entry[2] is sub for entry in self._priority):
+                # idle, as are the routers that have disconnected
+                del self._routers[sub.name]
+
+    def pump(self):
+        """ Move messages on as the forward queue drains, called by the producer from its loop """
+        if hasattr(self._queue, 'pump'):
+            self._queue.pump()
+        self.release()
+
+    def __len__(self):
+        """ Number of messages queued """
+        return len(self._priority) + sum(len(sub.msgs) for sub in self._round)
+
+    def stats(self):
+        text = "%d messages scheduled, %d priority, %d superseded, %d stalls (%.1f seconds), %d still queued" % (
+            self.msgs, self.priority_msgs, self.superseded, self.stalls, self.stall_time, len(self))
+        if hasattr(self._queue, 'stats'):
+            text += "; " + self._queue.stats()
+        return text
+
+    def close(self):
+        """ Move every message still queued to the forward queue """
+        while self._priority or self._round:
+            self.release(float('inf'))
+        self.publish(time.time())
+        if hasattr(self._queue, 'close'):
+            self._queue.close()
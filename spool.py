@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+""" Disk spool
+
+  An append-only queue of messages kept in a directory of segment files, used
+  to hold messages while a collector cannot be reached.  Each record is a 4
+  byte length followed by the message.  A new segment is started once the
+  current one reaches the segment size, and a segment is deleted once every
+  message in it has been read.  Segments left behind by an earlier run are
+  picked up and read first, from the read position saved by close(); after
+  a crash the oldest segment is read again from its start.
+"""
+import os
+import struct
+
+_LENGTH = struct.Struct('!I')
+_SUFFIX = '.spool'
+_POSITION = 'position'
+
+EVICT_OLDEST = 'oldest'
+EVICT_NEWEST = 'newest'
+
+
+class Spool(object):
+    """ Segmented on-disk message queue """
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024, max_size=1024 * 1024 * 1024,
+                 eviction=EVICT_OLDEST):
+        """ Constructor
+
+            :param directory:       Directory holding the segment files, created if needed
+            :param segment_size:    Size at which a new segment file is started
+            :param max_size:        Most bytes held on disk
+            :param eviction:        When full, EVICT_OLDEST deletes the oldest segment,
+                                    EVICT_NEWEST refuses further messages
+        """
+        if eviction not in (EVICT_OLDEST, EVICT_NEWEST):
+            raise ValueError("spool eviction must be '%s' or '%s'" % (EVICT_OLDEST, EVICT_NEWEST))
+
+        self._dir = directory
+        self._segment_size = segment_size
+        self._max_size = max_size
+        self._eviction = eviction
+
+        # [number, bytes, unread message count] for each segment, oldest first
+        self._segments = []
+        self._size = 0
+        self._count = 0
+        self.dropped = 0
+
+        self._writer = None
+        self._reader = None
+        self._read_segment = None
+        self._read_offset = 0
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(_SUFFIX):
+                self._recover(int(name[:-len(_SUFFIX)]))
+
+        self._restore_position()
+
+    def _path(self, number):
+        return os.path.join(self._dir, "%016d%s" % (number, _SUFFIX))
+
+    def _recover(self, number):
+        """ Count the complete records in a segment left by an earlier run, dropping a torn tail """
+        path = self._path(number)
+        count = 0
+        offset = 0
+        with open(path, 'rb') as f:
+            while True:
+                header = f.read(_LENGTH.size)
+                if len(header) < _LENGTH.size:
+                    break
+                length = _LENGTH.unpack(header)[0]
+                if len(f.read(length)) < length:
+                    break
+                offset += _LENGTH.size + length
+                count += 1
+
+        if offset != os.path.getsize(path):
+            with open(path, 'r+b') as f:
+                f.truncate(offset)
+
+        if count:
+            self._segments.append([number, offset, count])
+            self._size += offset
+            self._count += count
+        else:
+            os.remove(path)
+
+    def _restore_position(self):
+        """ Skip the messages of the oldest segment that were read before the last close() """
+        path = os.path.join(self._dir, _POSITION)
+        if not os.path.exists(path):
+            return
+
+        with open(path, 'r') as f:
+            (number, offset) = [int(field) for field in f.read().split()]
+        os.remove(path)
+
+        if self._segments and self._segments[0][0] == number:
+            self.consume(self.peek(self._segments[0][2], offset)[:self._count_before(offset)])
+
+    def _count_before(self, offset):
+        """ Number of records of the open read segment that end at or before offset """
+        self._reader.seek(0)
+        count = 0
+        position = 0
+        while True:
+            header = self._reader.read(_LENGTH.size)
+            if len(header) < _LENGTH.size:
+                break
+            position += _LENGTH.size + _LENGTH.unpack(header)[0]
+            if position > offset:
+                break
+            self._reader.seek(position)
+            count += 1
+        return count
+
+    def __len__(self):
+        """ Number of messages held """
+        return self._count
+
+    def empty(self):
+        return self._count == 0
+
+    def size(self):
+        """ Bytes held on disk, including read messages in the oldest segment """
+        return self._size
+
+    def append(self, msg):
+        """ Add a message at the end of the spool
+
+            :param msg:     Message bytes
+
+            :return: True if stored, False if the spool is full and refused it
+        """
+        record = _LENGTH.size + len(msg)
+
+        while self._size + record > self._max_size:
+            if self._eviction == EVICT_NEWEST or len(self._segments) < 2:
+                self.dropped += 1
+                return False
+            self._evict()
+
+        if self._writer is None or self._segments[-1][1] + record > self._segment_size:
+            self._start_segment()
+
+        self._writer.write(_LENGTH.pack(len(msg)))
+        self._writer.write(msg)
+
+        segment = self._segments[-1]
+        segment[1] += record
+        segment[2] += 1
+        self._size += record
+        self._count += 1
+        return True
+
+    def _start_segment(self):
+        if self._writer is not None:
+            self._writer.close()
+
+        number = self._segments[-1][0] + 1 if self._segments else 0
+        self._writer = open(self._path(number), 'ab')
+        self._segments.append([number, 0, 0])
+
+    def _evict(self):
+        """ Delete the oldest segment, including any part of it already read """
+        (number, size, count) = self._segments.pop(0)
+        if self._read_segment == number:
+            self._close_reader()
+        os.remove(self._path(number))
+        self._size -= size
+        self._count -= count
+        self.dropped += count
+
+    def _close_reader(self):
+        if self._reader is not None:
+            self._reader.close()
+        self._reader = None
+        self._read_segment = None
+        self._read_offset = 0
+
+    def peek(self, max_messages, max_bytes):
+        """ Read the oldest messages without removing them
+
+            Returns at least one message if the spool is not empty; the messages
+            are removed by a following call to consume().
+
+            :param max_messages:    Most messages to return
+            :param max_bytes:       Stop once this many bytes have been read
+
+            :return: List of messages, oldest first
+        """
+        msgs = []
+        if not self._count:
+            return msgs
+
+        (number, size, count) = self._segments[0]
+        if self._read_segment != number:
+            self._close_reader()
+            self._reader = open(self._path(number), 'rb')
+            self._read_segment = number
+
+        if self._writer is not None and number == self._segments[-1][0]:
+            self._writer.flush()
+
+        self._reader.seek(self._read_offset)
+        total = 0
+        while len(msgs) < max_messages and total < max_bytes:
+            header = self._reader.read(_LENGTH.size)
+            if len(header) < _LENGTH.size:
+                break
+            msg = self._reader.read(_LENGTH.unpack(header)[0])
+            msgs.append(msg)
+            total += len(msg)
+
+        return msgs
+
+    def consume(self, msgs):
+        """ Remove messages returned by peek()
+
+            :param msgs:    The list returned by peek(), or its leading part
+        """
+        segment = self._segments[0]
+        for msg in msgs:
+            self._read_offset += _LENGTH.size + len(msg)
+        segment[2] -= len(msgs)
+        self._count -= len(msgs)
+
+        if segment[2] == 0:
+            # finished with this segment
+            self._close_reader()
+            if self._writer is not None and segment is self._segments[-1]:
+                self._writer.close()
+                self._writer = None
+            self._segments.pop(0)
+            self._size -= segment[1]
+            os.remove(self._path(segment[0]))
+
+    def close(self):
+        if self._read_offset:
+            with open(os.path.join(self._dir, _POSITION), 'w') as f:
+                f.write("%d %d\n" % (self._read_segment, self._read_offset))
+        self._close_reader()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+""" Worker supervision
+
+  The main process starts the listener, decoder and sender processes through
+  a Supervisor, which checks on them from the main loop and starts a new
+  process in place of any that exited without being asked to, for instance
+  after an uncaught exception or being killed.  A worker that keeps failing
+  is restarted after a delay doubling up to RESTART_MAX seconds, reset once
+  it has run for RESTART_MAX seconds.
+
+  A replacement process is forked from the main process, whose copies of the
+  shared ring buffers' private positions date from before the first worker
+  started; each worker is registered with a resume function that brings them
+  up to date first, so the replacement takes up where the process it
+  replaces left off.
+
+  A worker killed while it holds a lock shared with the others, such as a
+  ring buffer's producer lock, would leave them waiting for good, and its
+  replacement with them.  Those locks are Worker_locks, made in the main
+  process before the workers are started, which record the process holding
+  them; the supervisor releases any that a worker held as soon as it finds
+  the worker dead.
+"""
+import multiprocessing
+import os
+import time
+
+RESTART_MIN = 1
+RESTART_MAX = 60
+
+# every Worker_lock made, for the supervisor to release
+_worker_locks = []
+
+
+class Worker_lock(object):
+    """ multiprocessing.Lock recording the process that holds it
+
+        Offers acquire(), release() and the context manager protocol of a Lock.
+    """
+
+    def __init__(self):
+        self._lock = multiprocessing.Lock()
+        self._owner = multiprocessing.RawValue('l', 0)      # pid of the holder, 0 when free
+        _worker_locks.append(self)
+
+    def acquire(self, block=True, timeout=None):
+        """ Take the lock
+
+            :param block:       Wait for it rather than returning False at once
+            :param timeout:     Most seconds to wait, None for no limit
+
+            :return: True if taken
+        """
+        if not self._lock.acquire(block, timeout):
+            return False
+        self._owner.value = os.getpid()
+        return True
+
+    def release(self):
+        self._owner.value = 0
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def recover(self, pid):
+        """ Release the lock if a process that has exited holds it
+
+            :param pid:     Process id of the exited process
+
+            :return: True if it held the lock
+        """
+        if pid is None or self._owner.value != pid:
+            return False
+        self._owner.value = 0
+        self._lock.release()
+        return True
+
+
+class _Worker(object):
+    __slots__ = ('name', 'group', 'factory', 'resume', 'process', 'started', 'restarts', 'delay', 'due')
+
+    def __init__(self, name, group, factory, resume):
+        self.name = name
+        self.group = group
+        self.factory = factory
+        self.resume = resume
+        self.process = None
+        self.started = 0
+        self.restarts = 0
+        self.delay = RESTART_MIN
+        self.due = None         # time a restart is due, while the worker is down
+
+
+class Supervisor(object):
+    """ Starts worker processes and restarts those that die """
+
+    def __init__(self, log):
+        """ Constructor
+
+            :param log:     Logger to report restarts to
+        """
+        self.LOG = log
+        self._workers = []
+
+    def start(self, name, group, factory, resume=None):
+        """ Start a worker
+
+            :param name:        Name to report it by
+            :param group:       Name of the group it is stopped with, see stop()
+            :param factory:     Function returning a new process for it, not yet started
+            :param resume:      Function called before a replacement process is started
+        """
+        worker = _Worker(name, group, factory, resume)
+        self._workers.append(worker)
+        self._start(worker)
+
+    def _start(self, worker):
+        worker.process = worker.factory()
+        worker.process.start()
+        worker.started = time.time()
+
+    def check(self):
+        """ Restart the workers that have exited, called from the main loop """
+        now = time.time()
+        for worker in self._workers:
+            if worker.process.is_alive():
+                continue
+
+            if worker.due is None:
+                if now - worker.started >= RESTART_MAX:
+                    worker.delay = RESTART_MIN
+                worker.due = now + worker.delay
+                self.LOG.error("%s exited with code %s, restarting in %d seconds" %
+                               (worker.name, worker.process.exitcode, worker.delay))
+                worker.delay = min(worker.delay * 2, RESTART_MAX)
+                # the other workers are not to wait for it until it is restarted
+                for lock in _worker_locks:
+                    if lock.recover(worker.process.pid):
+                        self.LOG.warning("%s exited holding a shared lock, released" % worker.name)
+
+            if now >= worker.due:
+                worker.process.join()
+                if worker.resume is not None:
+                    worker.resume()
+                self._start(worker)
+                worker.restarts += 1
+                worker.due = None
+                self.LOG.info("%s restarted (%d restarts)" % (worker.name, worker.restarts))
+
+    def stop(self, group):
+        """ Ask the workers of a group to exit """
+        for worker in self._workers:
+            if worker.group == group and worker.process.is_alive():
+                worker.process.stop()
+
+    def counters(self):
+        """ The restarts of every worker, as Metrics.render() counters """
+        return [("bmp_proxy_worker_restarts_total", "Times a worker process was restarted after exiting",
+                 {'worker': worker.name}, lambda worker=worker: worker.restarts) for worker in self._workers]
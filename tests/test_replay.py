@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+""" RIB dump tests
+
+  A collector is fed a dump of a peer's routes while the peer keeps changing
+  them, each change forwarded live as soon as it is made, and must end up
+  with the routes the proxy holds.
+"""
+import os
+import random
+import struct
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import replay
+from bgpparse import Attribute_cache
+from bmpparse import BMP_message, BMP_Route_Monitoring
+from rib import RIB_store
+
+
+def bmp_update(withdrawn=b'', attrs=b'', nlri=b''):
+    body = struct.pack('!H', len(withdrawn)) + withdrawn + struct.pack('!H', len(attrs)) + attrs + nlri
+    bgp = b'\xff' * 16 + struct.pack('!HB', 19 + len(body), 2) + body
+    header = struct.pack('!BBQ12xIIIII', 0, 0, 0, 0x0a000001, 65001, 0x0a000001, 0, 0)
+    return struct.pack('!BIB', 3, 6 + len(header) + len(bgp), BMP_Route_Monitoring) + header + bgp
+
+
+def prefix(route):
+    (address, length) = route
+    return struct.pack('!BI', length, address)[:1 + (length + 7) // 8]
+
+
+def attribute_set(med):
+    return (struct.pack('!BBBB', 0x40, 1, 1, 0) + struct.pack('!BBBBBI', 0x40, 2, 6, 2, 1, 65001) +
+            struct.pack('!BBBI', 0x40, 3, 4, 0x0a000001) + struct.pack('!BBBI', 0x80, 4, 4, med))
+
+
+def routes_of(store):
+    ((key, rib),) = store.peers()
+    return dict(((address, length), attributes.raw) for (address, length, attributes) in rib.routes)
+
+
+def test_dump_during_churn(monkeypatch):
+    rng = random.Random(1)
+    # a batch per route, so that every change is made between batches
+    monkeypatch.setattr(replay, 'DUMP_PREFIXES', 1)
+
+    table = list(set((rng.getrandbits(24) << 8, 24) for i in range(2000)))
+    attributes = [attribute_set(med) for med in range(10)]
+    (proxy, collector) = (RIB_store(100000), RIB_store(100000))
+    (proxy_cache, collector_cache) = (Attribute_cache(100), Attribute_cache(100))
+    for route in table:
+        proxy.update('router', BMP_message(bmp_update(attrs=rng.choice(attributes), nlri=prefix(route)), proxy_cache))
+
+    changes = 0
+    for raw_msg in replay.rib_dump(proxy):
+        collector.update('router', BMP_message(raw_msg, collector_cache))
+
+        # withdraw, change or announce again a route, dumped already or not
+        for i in range(rng.randint(0, 2)):
+            route = rng.choice(table)
+            if rng.random() < 0.5:
+                live = bmp_update(withdrawn=prefix(route))
+            else:
+                live = bmp_update(attrs=rng.choice(attributes), nlri=prefix(route))
+            proxy.update('router', BMP_message(live, proxy_cache))
+            collector.update('router', BMP_message(live, collector_cache))
+            changes += 1
+
+    assert changes > 1000
+    assert routes_of(collector) == routes_of(proxy)
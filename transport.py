@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+""" Compressed transport between proxies
+
+  A proxy forwarding to another bmp-proxy over a costly link, rather than to a
+  collector, can compress what it sends with the collector setting
+  'transport: zlib'.  The BMP stream is then sent as frames, each holding a
+  batch of messages compressed with zlib: a 4 byte magic and a 4 byte length
+  followed by that many bytes of compressed data.  One compression stream
+  runs across the frames of a connection, so that each batch is compressed
+  with what came before it as the dictionary, and every frame is flushed so
+  that it can be expanded as soon as it arrives.
+
+  The receiving proxy's listener, when its 'accept_compressed' setting is on,
+  recognises the magic at the start of a connection (a BMP stream starts with
+  version 3) and expands the frames back into the BMP stream, which is then
+  processed and forwarded as any other.  A frame may expand to no more than
+  MAX_FRAME_LENGTH bytes, so that a small frame cannot make the listener
+  allocate without bound.
+"""
+import struct
+import zlib
+
+TRANSPORT_BMP = 'bmp'
+TRANSPORT_ZLIB = 'zlib'
+
+FRAME_MAGIC = b'BMPZ'
+MAX_FRAME_LENGTH = 0x4000000    # bytes in a frame, compressed or expanded; more means a corrupt stream
+
+_frame_header = struct.Struct('!4sI')
+
+
+class Compressor(object):
+    """ Packs batches of BMP messages into compressed frames, for one connection """
+
+    def __init__(self, level=zlib.Z_DEFAULT_COMPRESSION):
+        """ Constructor
+
+            :param level:   zlib compression level, 0 (none) to 9 (most), -1 for the default
+        """
+        self._zlib = zlib.compressobj(level)
+        self.bytes_in = 0       # BMP bytes framed
+        self.bytes_out = 0      # bytes of frames made
+
+    def frame(self, data):
+        """ A frame holding data, a whole number of BMP messages """
+        payload = self._zlib.compress(data) + self._zlib.flush(zlib.Z_SYNC_FLUSH)
+        self.bytes_in += len(data)
+        self.bytes_out += _frame_header.size + len(payload)
+        return _frame_header.pack(FRAME_MAGIC, len(payload)) + payload
+
+
+class Decompressor(object):
+    """ Expands the frames received on one connection back into the BMP stream """
+
+    def __init__(self):
+        self._zlib = zlib.decompressobj()
+        self._buf = bytearray()
+        self.bytes_in = 0       # bytes of frames received
+        self.bytes_out = 0      # BMP bytes expanded
+
+    def feed(self, data):
+        """ Add bytes received
+
+            :param data:    Bytes as received, any part of one or more frames
+
+            :return: the BMP bytes expanded from the frames completed
+
+            :raises ValueError: if data is not a compressed stream
+        """
+        self._buf += data
+        self.bytes_in += len(data)
+        out = []
+        offset = 0
+        while len(self._buf) - offset >= _frame_header.size:
+            (magic, length) = _frame_header.unpack_from(self._buf, offset)
+            if magic != FRAME_MAGIC or length > MAX_FRAME_LENGTH:
+                raise ValueError("compressed transport framing error (magic %r, length %d)" % (magic, length))
+            if len(self._buf) - offset - _frame_header.size < length:
+                break
+            start = offset + _frame_header.size
+            try:
+                data = self._zlib.decompress(bytes(self._buf[start:start + length]), MAX_FRAME_LENGTH)
+            except zlib.error as e:
+                raise ValueError("compressed transport data error: %s" % e)
+            if self._zlib.unconsumed_tail:
+                # the output stopped at the limit with input left over
+                raise ValueError("compressed transport frame expands past %d bytes" % MAX_FRAME_LENGTH)
+            out.append(data)
+            offset = start + length
+
+        if offset:
+            del self._buf[:offset]
+        data = b''.join(out)
+        self.bytes_out += len(data)
+        return data